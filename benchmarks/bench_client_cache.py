@@ -0,0 +1,60 @@
+"""
+Compare the client setup cost of a cold and a warm Lambda container, with and
+without the module level client cache.
+
+    PYTHONPATH=lambda python benchmarks/bench_client_cache.py --invocations 20
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import boto3
+
+import backuplambda
+
+SERVICES = ('ec2', 'rds', 'sns')
+
+
+def setup_without_cache(regions):
+    for region_name in regions:
+        session = boto3.session.Session()
+        for service in SERVICES:
+            session.client(service, region_name=region_name)
+
+
+def setup_with_cache(regions):
+    for region_name in regions:
+        for service in SERVICES:
+            backuplambda.get_client(service, region_name)
+
+
+def time_invocations(setup, regions, invocations):
+    timings = []
+    for _ in range(invocations):
+        started = time.time()
+        setup(regions)
+        timings.append(time.time() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--invocations', type=int, default=20)
+    parser.add_argument('--regions', default='ap-southeast-2,us-east-1,eu-west-1')
+    args = parser.parse_args()
+    regions = args.regions.split(',')
+
+    backuplambda.clear_cache()
+    for label, setup in (('without cache', setup_without_cache), ('with cache', setup_with_cache)):
+        timings = time_invocations(setup, regions, args.invocations)
+        warm = timings[1:] or timings
+        print('%(label)-14s cold %(cold)8.1fms  warm %(warm)8.1fms' % {
+            'label': label,
+            'cold': timings[0] * 1000,
+            'warm': sum(warm) / len(warm) * 1000
+        })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Run the backup lambda end to end against synthetic fleets served by an in-process
+fake of EC2, RDS, STS and the Resource Groups Tagging API, and report wall time, peak memory and API calls per operation.
+
+    PYTHONPATH=lambda python benchmarks/bench_fleet.py --sizes 100,1000,10000
+    PYTHONPATH=lambda python benchmarks/bench_fleet.py --sizes 100,1000 --update-baseline
+    PYTHONPATH=lambda python benchmarks/bench_fleet.py --sizes 100,1000 --check
+
+--check compares the run with benchmarks/baseline.json and exits non zero when a fleet
+makes more API calls than the baseline, or is slower or bigger than the tolerance allows.
+"""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import backuplambda  # noqa: E402
+from fake_aws import build_fleet  # noqa: E402
+from ratelimit import DEFAULT_RATES  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+REGION = 'ap-southeast-2'
+
+
+SERVICES = ('ec2', 'rds', 'sts', 'resourcegroupstaggingapi')
+
+
+def attach_fleet(fake):
+    backuplambda.clear_cache()
+    fake.attach_session(backuplambda.get_session(REGION))
+    # Created up front like in a warm container, so model loading stays out of the numbers
+    for service in SERVICES:
+        backuplambda.get_client(service, REGION)
+        backuplambda.get_client(service, REGION, retries=False)
+
+
+def run_fleet(size, latency, workers, mode, rate, group_by_instance=False, discovery=None):
+    fake = build_fleet(REGION, size, latency=latency)
+    attach_fleet(fake)
+
+    event = {
+        'period_label': 'day',
+        'period_format': '%a%H',
+        'regions': [REGION],
+        'tag_name': 'MakeSnapshot',
+        'tag_value': 'True',
+        'keep_count': 7,
+        'workers': workers,
+        'mode': mode,
+        'rate_limits': dict((key, rate) for key in DEFAULT_RATES),
+        'ec2_group_by_instance': group_by_instance,
+    }
+    if discovery:
+        event['discovery'] = discovery
+
+    tracemalloc.start()
+    started = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = json.loads(backuplambda.lambda_handler(event))
+    elapsed = time.time() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'seconds': round(elapsed, 3),
+        'peak_mb': round(peak / 1024.0 / 1024.0, 2),
+        'calls': dict(sorted(fake.calls.items())),
+        'total_calls': sum(fake.calls.values()),
+    }
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    regressions = []
+    for size, result in results.items():
+        expected = baseline.get(size)
+        if expected is None:
+            continue
+        for operation, count in result['calls'].items():
+            if count > expected['calls'].get(operation, 0):
+                regressions.append('%s volumes: %s made %d calls, baseline %d' % (
+                    size, operation, count, expected['calls'].get(operation, 0)))
+        if result['seconds'] > expected['seconds'] * (1 + time_tolerance):
+            regressions.append('%s volumes: took %.2fs, baseline %.2fs' % (size, result['seconds'],
+                                                                            expected['seconds']))
+        if result['peak_mb'] > expected['peak_mb'] * (1 + memory_tolerance):
+            regressions.append('%s volumes: peaked at %.1fMB, baseline %.1fMB' % (size, result['peak_mb'],
+                                                                                   expected['peak_mb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000', help='fleet sizes in volumes')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--mode', default='backup', choices=('backup', 'plan'))
+    parser.add_argument('--rate', type=float, default=100000.0,
+                        help='calls per second allowed for every mutating API, the defaults would dominate the run')
+    parser.add_argument('--group-by-instance', action='store_true',
+                        help='snapshot the volumes of an instance with one create_snapshots call')
+    parser.add_argument('--discovery', choices=('tagging',),
+                        help='find the tagged resources with the Resource Groups Tagging API')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--time-tolerance', type=float, default=0.5)
+    parser.add_argument('--memory-tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # The clients are real, they just never leave the process
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    results = {}
+    for size in args.sizes.split(','):
+        result = run_fleet(int(size), args.latency, args.workers, args.mode, args.rate, args.group_by_instance,
+                           args.discovery)
+        results[size] = result
+        print('%(size)6s volumes  %(seconds)8.2fs  peak %(peak_mb)8.1fMB  %(total_calls)7d calls' % dict(
+            result, size=size))
+        for operation, count in result['calls'].items():
+            print('    %-40s %7d' % (operation, count))
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        for size, result in results.items():
+            baseline[size] = dict((k, result[k]) for k in ('seconds', 'peak_mb', 'calls'))
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Baseline written to %s' % args.baseline)
+
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
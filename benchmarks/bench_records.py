@@ -0,0 +1,94 @@
+"""
+Compare the memory held by a snapshot inventory of the listed response dicts with one
+of the compact SnapshotRecord objects built from them page by page.
+
+    PYTHONPATH=lambda python benchmarks/bench_records.py --snapshots 100000
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from backuplambda import EC2BackupManager
+
+PAGE_SIZE = 1000
+
+
+def synthetic_pages(snapshot_count, snapshots_per_volume):
+    """
+    describe_snapshots pages shaped like the ones botocore parses, datetimes included
+    """
+    rnd = random.Random(42)
+    now = datetime.now(timezone.utc)
+    page = []
+    for i in range(snapshot_count):
+        volume_id = 'vol-%017x' % (i // snapshots_per_volume)
+        age = i % snapshots_per_volume
+        page.append({
+            'SnapshotId': 'snap-%017x' % i,
+            'VolumeId': volume_id,
+            'Description': 'day_snapshot %s_day_%s by snapshot script at %s' % (volume_id, age, now),
+            'StartTime': now - timedelta(days=age, seconds=rnd.randint(0, 3600)),
+            'State': 'completed',
+            'Progress': '100%',
+            'OwnerId': '123456789012',
+            'VolumeSize': 100,
+            'Encrypted': False,
+            'StorageTier': 'standard',
+            'Tags': [{'Key': 'BackupPeriod:day', 'Value': str(age)},
+                     {'Key': 'MakeSnapshot', 'Value': 'True'},
+                     {'Key': 'Name', 'Value': 'data-%s' % volume_id}],
+        })
+        if len(page) == PAGE_SIZE:
+            yield {'Snapshots': page}
+            page = []
+    if page:
+        yield {'Snapshots': page}
+
+
+def build_index(mgr, pages, compact):
+    index = {}
+    for page in pages:
+        for snap in page['Snapshots']:
+            index.setdefault(snap['VolumeId'], []).append(mgr.snapshot_record(snap) if compact else snap)
+    return index
+
+
+def measure(snapshot_count, snapshots_per_volume, compact):
+    mgr = EC2BackupManager(region_name='ap-southeast-2', period='day', tag_name='MakeSnapshot',
+                           tag_value='True', date_suffix='0', keep_count=7)
+
+    tracemalloc.start()
+    started = time.time()
+    index = build_index(mgr, synthetic_pages(snapshot_count, snapshots_per_volume), compact)
+    elapsed = time.time() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert sum(len(snapshots) for snapshots in index.values()) == snapshot_count
+    return elapsed, retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--snapshots', type=int, default=100000)
+    parser.add_argument('--per-volume', type=int, default=50)
+    args = parser.parse_args()
+
+    for label, compact in (('response dicts', False), ('records', True)):
+        elapsed, retained, peak = measure(args.snapshots, args.per_volume, compact)
+        print('%(label)-15s %(snapshots)s snapshots in %(elapsed).2fs: retained %(retained).1fMB, '
+              'peak %(peak).1fMB' % {
+                  'label': label,
+                  'snapshots': args.snapshots,
+                  'elapsed': elapsed,
+                  'retained': retained / 1024.0 / 1024.0,
+                  'peak': peak / 1024.0 / 1024.0
+              })
+
+
+if __name__ == '__main__':
+    main()
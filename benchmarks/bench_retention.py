@@ -0,0 +1,48 @@
+"""
+Time the retention planner against a large synthetic snapshot inventory.
+
+    PYTHONPATH=lambda python benchmarks/bench_retention.py --records 1000000
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+from retention import RetentionPolicy, plan_retention
+
+DAY = 86400
+
+
+def synthetic_records(record_count, snapshots_per_resource, now):
+    rnd = random.Random(42)
+    for i in range(record_count):
+        resource_id = 'vol-%08x' % (i // snapshots_per_resource)
+        # One snapshot a day going back in time, with some jitter
+        created = now - (i % snapshots_per_resource) * DAY - rnd.randint(0, 3600)
+        yield resource_id, 'snap-%010x' % i, created, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--per-resource', type=int, default=400)
+    args = parser.parse_args()
+
+    records = list(synthetic_records(args.records, args.per_resource, int(time.time())))
+    policy = RetentionPolicy.grandfather_father_son({'day': 7, 'week': 4, 'month': 12})
+
+    started = time.time()
+    keep, delete = plan_retention(records, policy)
+    elapsed = time.time() - started
+
+    print('Planned %(records)s snapshots in %(elapsed).2fs: keep %(keep)s, delete %(delete)s' % {
+        'records': len(records),
+        'elapsed': elapsed,
+        'keep': len(keep),
+        'delete': len(delete)
+    })
+
+
+if __name__ == '__main__':
+    main()
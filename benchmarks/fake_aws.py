@@ -0,0 +1,454 @@
+"""
+An in-process fake of the EC2, RDS, STS and Resource Groups Tagging API calls the backup
+lambda makes.
+
+The fake hooks into the botocore event system of real boto3 clients: parameters are
+validated and serialised by botocore as usual, then the `before-call` handler answers
+instead of sending an HTTP request. Every other botocore event still fires, so the
+call accounting and instrumentation of the lambda see the same calls they would see
+against AWS.
+"""
+from __future__ import print_function
+
+import itertools
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+ACCOUNT_ID = '123456789012'
+
+
+class FakeHttpResponse(object):
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+
+def response(**body):
+    body['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': 0}
+    return body
+
+
+def error(code, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message},
+                        'ResponseMetadata': {'HTTPStatusCode': 400, 'RetryAttempts': 0}}, code)
+
+
+def tag_dict(tags):
+    return dict((tag['Key'], tag['Value']) for tag in tags or [])
+
+
+def matches_filters(item, filters, field_map):
+    for flt in filters or []:
+        name, values = flt['Name'], flt['Values']
+        if name.startswith('tag:'):
+            value = tag_dict(item.get('Tags')).get(name[4:])
+        elif name == 'tag-key':
+            if not set(values) & set(tag_dict(item.get('Tags'))):
+                return False
+            continue
+        else:
+            value = item.get(field_map.get(name, name))
+        if not any(value == v or (v.endswith('*') and str(value).startswith(v[:-1])) for v in values):
+            return False
+    return True
+
+
+def paginate(items, predicate, params, token_key='NextToken', size_key='MaxResults', default_size=1000):
+    """
+    One page of the items matching the predicate. The token is the position in `items` to
+    carry on from, so a full listing scans the items once rather than once per page.
+    """
+    items = list(items)
+    position = int(params.get(token_key) or 0)
+    size = int(params.get(size_key) or default_size)
+    page = []
+    while position < len(items) and len(page) < size:
+        if predicate(items[position]):
+            page.append(dict(items[position]))
+        position += 1
+    return page, str(position) if position < len(items) else None
+
+
+class FakeAWS(object):
+    """
+    :param latency: seconds to sleep on every call, to model the round trip to AWS
+    :param page_size: default page size of the describe calls
+    """
+
+    def __init__(self, region_name, latency=0.0, page_size=1000):
+        self.region_name = region_name
+        self.latency = latency
+        self.page_size = page_size
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.now = datetime.now(timezone.utc)
+
+        self.volumes = {}
+        self.instances = {}
+        self.snapshots = {}
+        self.db_instances = {}
+        self.db_clusters = {}
+        self.db_snapshots = {}
+        self.db_cluster_snapshots = {}
+
+    # Wiring
+
+    def attach(self, client):
+        service = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register('before-parameter-build.' + service, self.capture_params)
+        client.meta.events.register('before-call.' + service, self.handle)
+        return client
+
+    def attach_session(self, session):
+        # Every client the boto3 session creates from now on, whatever its service or config
+        session.events.register('before-parameter-build', self.capture_params)
+        session.events.register('before-call', self.handle)
+        return session
+
+    @staticmethod
+    def capture_params(params, context, **kwargs):
+        context['fake_aws_params'] = params
+
+    def handle(self, event_name, context, **kwargs):
+        _, service, operation = event_name.split('.')
+        with self.lock:
+            self.calls['%s.%s' % (service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        method = getattr(self, '%s_%s' % (service.replace('-', '_'), operation))
+        try:
+            with self.lock:
+                return FakeHttpResponse(), method(context.get('fake_aws_params', {}))
+        except ClientError as e:
+            return FakeHttpResponse(400), e.response
+
+    def new_id(self, prefix):
+        return '%s-%012x' % (prefix, next(self.ids))
+
+    # Fleet building
+
+    def add_volume(self, tags, instance_id=None):
+        volume_id = self.new_id('vol')
+        attachments = []
+        if instance_id:
+            # The first volume of an instance is its root volume
+            instance = self.instances.setdefault(instance_id, {'InstanceId': instance_id,
+                                                               'RootDeviceName': '/dev/xvda',
+                                                               'BlockDeviceMappings': []})
+            mappings = instance['BlockDeviceMappings']
+            device = '/dev/xvda' if not mappings else '/dev/sd%s' % chr(ord('f') + len(mappings) - 1)
+            mappings.append({'DeviceName': device, 'Ebs': {'VolumeId': volume_id, 'Status': 'attached'}})
+            attachments.append({'InstanceId': instance_id, 'VolumeId': volume_id, 'Device': device,
+                                'State': 'attached'})
+        self.volumes[volume_id] = {
+            'VolumeId': volume_id,
+            'Size': 100,
+            'State': 'in-use' if instance_id else 'available',
+            'Attachments': attachments,
+            'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        }
+        return volume_id
+
+    def add_snapshot(self, volume_id, description, start_time, tags=None, state='completed'):
+        snapshot_id = self.new_id('snap')
+        self.snapshots[snapshot_id] = {
+            'SnapshotId': snapshot_id,
+            'VolumeId': volume_id,
+            'Description': description,
+            'StartTime': start_time,
+            'State': state,
+            'OwnerId': ACCOUNT_ID,
+            'VolumeSize': 100,
+            'Tags': [{'Key': k, 'Value': v} for k, v in (tags or {}).items()],
+        }
+        return snapshot_id
+
+    def db_arn(self, kind, identifier):
+        return 'arn:aws:rds:%s:%s:%s:%s' % (self.region_name, ACCOUNT_ID, kind, identifier)
+
+    def add_db_instance(self, identifier, tags, cluster_id=None):
+        instance = {
+            'DBInstanceIdentifier': identifier,
+            'DBInstanceArn': self.db_arn('db', identifier),
+            'DBInstanceStatus': 'available',
+            'Engine': 'postgres',
+            'TagList': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        }
+        if cluster_id:
+            instance['DBClusterIdentifier'] = cluster_id
+        self.db_instances[identifier] = instance
+
+    def add_db_cluster(self, identifier, tags):
+        self.db_clusters[identifier] = {
+            'DBClusterIdentifier': identifier,
+            'DBClusterArn': self.db_arn('cluster', identifier),
+            'Status': 'available',
+            'Engine': 'aurora-postgresql',
+            'TagList': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        }
+
+    def add_db_snapshot(self, identifier, snapshot_id, create_time, cluster=False):
+        if cluster:
+            self.db_cluster_snapshots[snapshot_id] = {
+                'DBClusterSnapshotIdentifier': snapshot_id,
+                'DBClusterIdentifier': identifier,
+                'SnapshotCreateTime': create_time,
+                'SnapshotType': 'manual',
+                'Status': 'available',
+            }
+        else:
+            self.db_snapshots[snapshot_id] = {
+                'DBSnapshotIdentifier': snapshot_id,
+                'DBInstanceIdentifier': identifier,
+                'SnapshotCreateTime': create_time,
+                'SnapshotType': 'manual',
+                'Status': 'available',
+            }
+
+    # STS
+
+    def sts_GetCallerIdentity(self, params):
+        return response(Account=ACCOUNT_ID, Arn='arn:aws:iam::%s:user/benchmark' % ACCOUNT_ID, UserId='benchmark')
+
+    # EC2
+
+    def page(self, key, items, predicate, params, token_key='NextToken', size_key='MaxResults', default_size=None):
+        page, next_token = paginate(items, predicate, params, token_key, size_key, default_size or self.page_size)
+        body = {key: page}
+        if next_token:
+            body[token_key] = next_token
+        return response(**body)
+
+    def ec2_DescribeVolumes(self, params):
+        filters = params.get('Filters')
+        volume_ids = params.get('VolumeIds')
+        return self.page('Volumes', self.volumes.values(),
+                         lambda v: matches_filters(v, filters, {'volume-id': 'VolumeId'})
+                         and (not volume_ids or v['VolumeId'] in volume_ids), params)
+
+    def ec2_DescribeSnapshots(self, params):
+        filters = params.get('Filters')
+        snapshot_ids = params.get('SnapshotIds')
+        field_map = {'volume-id': 'VolumeId', 'description': 'Description', 'snapshot-id': 'SnapshotId',
+                     'status': 'State'}
+        return self.page('Snapshots', self.snapshots.values(),
+                         lambda s: matches_filters(s, filters, field_map)
+                         and (not snapshot_ids or s['SnapshotId'] in snapshot_ids), params)
+
+    def ec2_DescribeTags(self, params):
+        resource_ids = set()
+        for flt in params.get('Filters', []):
+            if flt['Name'] == 'resource-id':
+                resource_ids.update(flt['Values'])
+        tags = []
+        for resource_id in resource_ids:
+            resource = self.volumes.get(resource_id) or self.snapshots.get(resource_id) or {}
+            for tag in resource.get('Tags', []):
+                tags.append({'ResourceId': resource_id, 'Key': tag['Key'], 'Value': tag['Value']})
+        return response(Tags=tags)
+
+    def ec2_CreateSnapshot(self, params):
+        if params['VolumeId'] not in self.volumes:
+            raise error('InvalidVolume.NotFound', params['VolumeId'])
+        tags = {}
+        for spec in params.get('TagSpecifications', []):
+            tags.update(tag_dict(spec['Tags']))
+        snapshot_id = self.add_snapshot(params['VolumeId'], params.get('Description', ''), self.now,
+                                        tags=tags, state='pending')
+        return response(**dict(self.snapshots[snapshot_id]))
+
+    def ec2_DescribeInstances(self, params):
+        instances = [dict(self.instances[instance_id]) for instance_id in params.get('InstanceIds', [])
+                     if instance_id in self.instances]
+        return response(Reservations=[{'Instances': instances}])
+
+    def ec2_CreateSnapshots(self, params):
+        spec = params['InstanceSpecification']
+        instance = self.instances.get(spec['InstanceId'])
+        if instance is None:
+            raise error('InvalidInstanceID.NotFound', spec['InstanceId'])
+        excluded = set(spec.get('ExcludeDataVolumeIds', []))
+        tags = {}
+        for tag_spec in params.get('TagSpecifications', []):
+            tags.update(tag_dict(tag_spec['Tags']))
+
+        snapshots = []
+        for mapping in instance['BlockDeviceMappings']:
+            volume_id = mapping['Ebs']['VolumeId']
+            if mapping['DeviceName'] == instance['RootDeviceName']:
+                if spec.get('ExcludeBootVolume'):
+                    continue
+            elif volume_id in excluded:
+                continue
+            snapshot_tags = tag_dict(self.volumes[volume_id]['Tags']) if params.get('CopyTagsFromSource') else {}
+            snapshot_tags.update(tags)
+            snapshot_id = self.add_snapshot(volume_id, params.get('Description', ''), self.now, tags=snapshot_tags,
+                                            state='pending')
+            snapshots.append(dict(self.snapshots[snapshot_id]))
+        return response(Snapshots=snapshots)
+
+    def ec2_CreateTags(self, params):
+        for resource_id in params['Resources']:
+            resource = self.snapshots.get(resource_id) or self.volumes.get(resource_id)
+            if resource is None:
+                raise error('InvalidID', resource_id)
+            tags = tag_dict(resource.get('Tags'))
+            tags.update(tag_dict(params['Tags']))
+            resource['Tags'] = [{'Key': k, 'Value': v} for k, v in tags.items()]
+        return response()
+
+    def ec2_DeleteSnapshot(self, params):
+        if self.snapshots.pop(params['SnapshotId'], None) is None:
+            raise error('InvalidSnapshot.NotFound', params['SnapshotId'])
+        return response()
+
+    def ec2_ModifySnapshotAttribute(self, params):
+        return response()
+
+    # RDS
+
+    def rds_DescribeDBInstances(self, params):
+        filters = params.get('Filters')
+        instances = sorted(self.db_instances.values(), key=lambda i: i['DBInstanceIdentifier'])
+        return self.page('DBInstances', instances,
+                         lambda i: matches_filters(i, filters, {'db-instance-id': 'DBInstanceIdentifier'}),
+                         params, 'Marker', 'MaxRecords', 100)
+
+    def rds_DescribeDBClusters(self, params):
+        filters = params.get('Filters')
+        clusters = sorted(self.db_clusters.values(), key=lambda c: c['DBClusterIdentifier'])
+        return self.page('DBClusters', clusters,
+                         lambda c: matches_filters(c, filters, {'db-cluster-id': 'DBClusterIdentifier'}),
+                         params, 'Marker', 'MaxRecords', 100)
+
+    def rds_ListTagsForResource(self, params):
+        for resource in itertools.chain(self.db_instances.values(), self.db_clusters.values()):
+            if params['ResourceName'] in (resource.get('DBInstanceArn'), resource.get('DBClusterArn')):
+                return response(TagList=list(resource['TagList']))
+        return response(TagList=[])
+
+    def rds_DescribeDBSnapshots(self, params):
+        identifier = params.get('DBInstanceIdentifier')
+        snapshot_type = params.get('SnapshotType')
+        return self.page('DBSnapshots', self.db_snapshots.values(),
+                         lambda s: (not identifier or s['DBInstanceIdentifier'] == identifier)
+                         and (not snapshot_type or s['SnapshotType'] == snapshot_type),
+                         params, 'Marker', 'MaxRecords', 100)
+
+    def rds_DescribeDBClusterSnapshots(self, params):
+        identifier = params.get('DBClusterIdentifier')
+        snapshot_type = params.get('SnapshotType')
+        return self.page('DBClusterSnapshots', self.db_cluster_snapshots.values(),
+                         lambda s: (not identifier or s['DBClusterIdentifier'] == identifier)
+                         and (not snapshot_type or s['SnapshotType'] == snapshot_type),
+                         params, 'Marker', 'MaxRecords', 100)
+
+    def rds_CreateDBSnapshot(self, params):
+        if params['DBSnapshotIdentifier'] in self.db_snapshots:
+            raise error('DBSnapshotAlreadyExists', params['DBSnapshotIdentifier'])
+        self.add_db_snapshot(params['DBInstanceIdentifier'], params['DBSnapshotIdentifier'], self.now)
+        snapshot = self.db_snapshots[params['DBSnapshotIdentifier']]
+        snapshot.update(Status='creating', TagList=params.get('Tags', []))
+        del snapshot['SnapshotCreateTime']
+        return response(DBSnapshot=dict(snapshot))
+
+    def rds_CreateDBClusterSnapshot(self, params):
+        if params['DBClusterSnapshotIdentifier'] in self.db_cluster_snapshots:
+            raise error('DBClusterSnapshotAlreadyExistsFault', params['DBClusterSnapshotIdentifier'])
+        self.add_db_snapshot(params['DBClusterIdentifier'], params['DBClusterSnapshotIdentifier'], self.now,
+                             cluster=True)
+        snapshot = self.db_cluster_snapshots[params['DBClusterSnapshotIdentifier']]
+        snapshot.update(Status='creating', TagList=params.get('Tags', []))
+        del snapshot['SnapshotCreateTime']
+        return response(DBClusterSnapshot=dict(snapshot))
+
+    def rds_DeleteDBSnapshot(self, params):
+        snapshot = self.db_snapshots.pop(params['DBSnapshotIdentifier'], None)
+        if snapshot is None:
+            raise error('DBSnapshotNotFound', params['DBSnapshotIdentifier'])
+        return response(DBSnapshot=snapshot)
+
+    def rds_DeleteDBClusterSnapshot(self, params):
+        snapshot = self.db_cluster_snapshots.pop(params['DBClusterSnapshotIdentifier'], None)
+        if snapshot is None:
+            raise error('DBClusterSnapshotNotFoundFault', params['DBClusterSnapshotIdentifier'])
+        return response(DBClusterSnapshot=snapshot)
+
+    def rds_ModifyDBSnapshotAttribute(self, params):
+        return response()
+
+    def rds_ModifyDBClusterSnapshotAttribute(self, params):
+        return response()
+
+
+    # Resource Groups Tagging API
+
+    def tagged_resources(self):
+        for volume in self.volumes.values():
+            arn = 'arn:aws:ec2:%s:%s:volume/%s' % (self.region_name, ACCOUNT_ID, volume['VolumeId'])
+            yield 'ec2:volume', arn, volume['Tags']
+        for instance in self.db_instances.values():
+            yield 'rds:db', instance['DBInstanceArn'], instance['TagList']
+        for cluster in self.db_clusters.values():
+            yield 'rds:cluster', cluster['DBClusterArn'], cluster['TagList']
+
+    def resource_groups_tagging_api_GetResources(self, params):
+        resource_types = params.get('ResourceTypeFilters')
+        tag_filters = params.get('TagFilters') or []
+
+        def matches(mapping):
+            tags = tag_dict(mapping['Tags'])
+            return ((not resource_types or mapping['ResourceType'] in resource_types)
+                    and all(flt['Key'] in tags and (not flt.get('Values') or tags[flt['Key']] in flt['Values'])
+                            for flt in tag_filters))
+
+        mappings = ({'ResourceType': resource_type, 'ResourceARN': arn, 'Tags': tags}
+                    for resource_type, arn, tags in self.tagged_resources())
+        page, next_token = paginate(mappings, matches, params, 'PaginationToken', 'ResourcesPerPage', 100)
+        for mapping in page:
+            del mapping['ResourceType']
+        # An empty token marks the last page
+        return response(ResourceTagMappingList=page, PaginationToken=next_token or '')
+
+
+def build_fleet(region_name, volumes, snapshots_per_volume=(10, 100), period='day', tag=('MakeSnapshot', 'True'),
+                latency=0.0, seed=42):
+    """
+    A fake account with `volumes` tagged volumes, each with a random number of snapshots
+    of the period, plus one RDS instance per 20 volumes and one Aurora cluster per 100.
+    """
+    import random
+    rnd = random.Random(seed)
+    fake = FakeAWS(region_name, latency=latency)
+    tags = {tag[0]: tag[1]}
+
+    for i in range(volumes):
+        instance_id = 'i-%012x' % (i // 4) if i % 5 else None
+        volume_id = fake.add_volume(dict(tags, Name='data-%d' % i), instance_id=instance_id)
+        for age in range(rnd.randint(*snapshots_per_volume)):
+            fake.add_snapshot(volume_id,
+                              '%s_snapshot %s_%s_x by snapshot script' % (period, volume_id, period),
+                              fake.now - timedelta(days=age + 1))
+
+    for i in range(max(1, volumes // 20)):
+        identifier = 'db-%05d' % i
+        fake.add_db_instance(identifier, tags)
+        for age in range(rnd.randint(5, 20)):
+            fake.add_db_snapshot(identifier, '%s-%s-%d' % (period, identifier, age), fake.now - timedelta(days=age + 1))
+
+    for i in range(max(1, volumes // 100)):
+        identifier = 'cluster-%05d' % i
+        fake.add_db_cluster(identifier, tags)
+        fake.add_db_instance(identifier + '-1', {}, cluster_id=identifier)
+        for age in range(rnd.randint(5, 20)):
+            fake.add_db_snapshot(identifier, '%s-%s-%d' % (period, identifier, age), fake.now - timedelta(days=age + 1),
+                                 cluster=True)
+
+    return fake
@@ -1,31 +1,859 @@
 from __future__ import print_function
 
+import itertools
 import json
 import logging
+import re
 import sys
+import tempfile
 import traceback
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import os
-import functools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from instrumentation import DEFAULT_NAMESPACE, Instrumentation
+from ratelimit import RateLimiter
+from retention import RetentionPolicy, plan_retention
+from sharding import HashRing
+
+# SNS rejects messages over 256KB, leave room for the subject and attributes
+SNS_MAX_BYTES = 250 * 1024
+
+# Seconds to wait for a shard invoked by the coordinator, a little over the longest Lambda timeout
+SHARD_READ_TIMEOUT = 910
+
+# Returned by RDS for a snapshot identifier that is already taken
+SNAPSHOT_EXISTS_ERROR_CODES = ('DBSnapshotAlreadyExists', 'DBClusterSnapshotAlreadyExistsFault')
+
+ERROR_ACTIONS = ('error', 'create_failed', 'share_failed', 'copy_failed')
+
+# A snapshot can only be shared once it has completed, the states of the snapshots waiting
+# to be shared are checked this often, for up to SHARE_WAIT_SECONDS after the resources are done
+SHARE_POLL_SECONDS = 15
+SHARE_WAIT_SECONDS = 600
+
+# Snapshots are tagged "BackupPeriod:<period label>" = <date suffix>, so the schedule a
+# snapshot belongs to does not have to be parsed from its description or name
+PERIOD_TAG_PREFIX = 'BackupPeriod:'
+
+# AWS allows 50 user tags on a snapshot, the period tags come first and the copied
+# resource tags fill the rest
+MAX_SNAPSHOT_TAGS = 50
+
+# Copies in the copy region are tagged with their source, so they can be rotated like the
+# source snapshots and no snapshot is copied twice
+COPY_SOURCE_TAG = 'BackupSourceSnapshot'
+COPY_RESOURCE_TAG = 'BackupSourceResource'
+COPY_TIME_TAG = 'BackupSourceTime'
+
+# Snapshots are tagged with the accounts they were shared with, so a later run shares the
+# kept snapshots a run could not share
+SHARED_TAG = 'BackupSharedWith'
+
+# The finest unit of time each period_format directive shows, in seconds. A date suffix
+# stands for a window of these units, a snapshot counts for the suffix only from the same window
+DAY_SECONDS = 24 * 3600
+PERIOD_UNITS = dict([(d, 1) for d in 'ScXT'] + [(d, 60) for d in 'MR'] + [(d, 3600) for d in 'HIkl'] +
+                    [(d, DAY_SECONDS) for d in 'aAdejuwxD'] + [(d, 7 * DAY_SECONDS) for d in 'UWV'] +
+                    [(d, 28 * DAY_SECONDS) for d in 'bBhm'] + [(d, 365 * DAY_SECONDS) for d in 'yYGC'])
+
+# How far back a continuation looks for the window of the date suffix it carries
+PERIOD_LOOKBACK_SECONDS = 8 * DAY_SECONDS
+
+# Sessions, clients and account metadata live at module level so they survive
+# between invocations of a warm Lambda container
+_cache_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+_metadata = {}
+
+# The manager that last took a client on each thread. Managers share the cached clients, the
+# tagging and copy region clients and, with in process shards, every client, so each call is
+# tagged with the manager of its thread and counted by that manager only
+_api_caller = threading.local()
+
+METADATA_TTL = 3600
+
+
+def get_session(region_name):
+    with _cache_lock:
+        session = _sessions.get(region_name)
+        if session is None:
+            session = boto3.session.Session(region_name=region_name)
+            _sessions[region_name] = session
+        return session
+
+
+def get_client(service, region_name, retries=True):
+    """
+    :param retries: False for a client that makes every call once, for the calls the
+                    RateLimiter retries itself
+    """
+    # Creating clients from a session is not thread safe, so it happens under the lock
+    with _cache_lock:
+        client = _clients.get((service, region_name, retries))
+        if client is None:
+            config = None if retries else Config(retries={'total_max_attempts': 1})
+            client = get_session(region_name).client(service, region_name=region_name, config=config)
+            _clients[(service, region_name, retries)] = client
+        return client
+
+
+def get_cached_metadata(key, loader, ttl=METADATA_TTL):
+    now = time.time()
+    with _cache_lock:
+        entry = _metadata.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+    value = loader()
+    with _cache_lock:
+        _metadata[key] = (now + ttl, value)
+    return value
+
+
+def get_caller_identity(region_name):
+    def load():
+        identity = get_client('sts', region_name).get_caller_identity()
+        return {'Account': identity['Account'], 'Arn': identity['Arn']}
+
+    return get_cached_metadata('caller_identity', load)
+
+
+def clear_cache():
+    with _cache_lock:
+        _sessions.clear()
+        _clients.clear()
+        _metadata.clear()
+
+
+class CheckpointStore(object):
+    """
+    Keeps the progress of a run between invocations, so a run that stops before the
+    Lambda deadline can carry on where it left off
+    """
+
+    def load(self, key):
+        pass
+
+    def save(self, key, state):
+        pass
+
+    def clear(self, key):
+        pass
+
+
+class LocalFileCheckpointStore(CheckpointStore):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key):
+        try:
+            with open(self.path_for(key)) as checkpoint:
+                return json.load(checkpoint)
+        except IOError:
+            return None
+
+    def save(self, key, state):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Write then rename, so an interrupted save never leaves half a checkpoint behind
+        tmp_path = self.path_for(key) + '.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump(state, checkpoint)
+        os.rename(tmp_path, self.path_for(key))
+
+    def clear(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except OSError:
+            pass
+
+
+class S3CheckpointStore(CheckpointStore):
+    def __init__(self, bucket, prefix='checkpoints/', region_name=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region_name = region_name
+
+    @property
+    def conn(self):
+        return get_client('s3', self.region_name)
+
+    def load(self, key):
+        try:
+            body = self.conn.get_object(Bucket=self.bucket, Key=self.prefix + key + '.json')['Body']
+        except self.conn.exceptions.NoSuchKey:
+            return None
+        return json.loads(body.read().decode('utf-8'))
+
+    def save(self, key, state):
+        self.conn.put_object(Bucket=self.bucket, Key=self.prefix + key + '.json', Body=json.dumps(state))
+
+    def clear(self, key):
+        self.conn.delete_object(Bucket=self.bucket, Key=self.prefix + key + '.json')
+
+
+class RunLedger(object):
+    """
+    The resources snapshotted for the current date suffix of each schedule, so a retried
+    invocation skips them rather than taking a second snapshot. The snapshot inventory
+    tells most of it, see BaseBackupManager.due_schedules, the store keeps the snapshots
+    of this run for a retry that can't see them in the listing yet.
+
+    :param store: a CheckpointStore, or None to rely on the inventory only
+    """
+
+    def __init__(self, schedules, store=None):
+        self.current = set((schedule.period, schedule.date_suffix) for schedule in schedules)
+        self.store = store
+        self.entries = set()
+        self.new_entries = False
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        if self.store is None:
+            return
+        state = self.store.load(key) or {}
+        with self.lock:
+            # Entries of an earlier date suffix are dropped here and left out of the next save
+            for period, date_suffix, resource_id in state.get('entries', []):
+                if (period, date_suffix) in self.current:
+                    self.entries.add((period, date_suffix, resource_id))
+
+    def record(self, period, date_suffix, resource_id):
+        with self.lock:
+            self.entries.add((period, date_suffix, resource_id))
+            self.new_entries = True
+
+    def recorded(self, period, date_suffix, resource_id):
+        with self.lock:
+            return (period, date_suffix, resource_id) in self.entries
+
+    def save(self, key):
+        if self.store is None or not self.new_entries:
+            return
+        with self.lock:
+            entries = sorted(self.entries)
+        self.store.save(key, {'entries': [list(entry) for entry in entries]})
+
+
+class SnapshotExists(Exception):
+    """
+    The snapshot a create would have taken is already there, taken by an earlier attempt
+    or a concurrent invocation of the same run
+    """
+
+    def __init__(self, snapshot, snapshot_id):
+        super(SnapshotExists, self).__init__('Snapshot %s already exists' % snapshot_id)
+        self.snapshot = snapshot
+
+
+class ResultLog(object):
+    """
+    Streams one JSON line per action to a spooled temporary file, so the detail of a run
+    never has to be held in memory. The records of one resource are written as a block,
+    the (offset, length) of the block is all that is needed to read them back in any order.
+    """
+
+    def __init__(self, echo=True, max_memory=1024 * 1024):
+        self.stream = tempfile.SpooledTemporaryFile(max_size=max_memory, mode='w+b')
+        self.echo = echo
+        self.lock = threading.Lock()
+
+    def write(self, records):
+        lines = [json.dumps(record, sort_keys=True, default=str) for record in records]
+        if self.echo:
+            for line in lines:
+                print(line)
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        with self.lock:
+            self.stream.seek(0, os.SEEK_END)
+            offset = self.stream.tell()
+            self.stream.write(data)
+        return offset, len(data)
+
+    def records(self, blocks=None):
+        # Reads under the lock one block at a time, writers may still be appending
+        if blocks is None:
+            with self.lock:
+                self.stream.seek(0, os.SEEK_END)
+                blocks = [(0, self.stream.tell())]
+        for offset, length in blocks:
+            with self.lock:
+                self.stream.seek(offset)
+                data = self.stream.read(length)
+            for line in data.decode('utf-8').splitlines():
+                yield json.loads(line)
+
+    def close(self):
+        self.stream.close()
+
+
+def format_record(record):
+    fields = [record['resource_id'], record['action']]
+    for key in ('snapshot_name', 'description', 'tags', 'snapshots', 'keep', 'error'):
+        if key in record:
+            fields.append('%s=%s' % (key, record[key]))
+    if record.get('planned'):
+        fields.append('(planned)')
+    return '    ' + ' '.join(str(field) for field in fields)
+
+
+def render_report(header, records, max_bytes=SNS_MAX_BYTES):
+    """
+    Render a header followed by one line per record, split into messages of at most
+    max_bytes, each starting with the header.
+    """
+    header = header + '\n'
+    header_size = len(header.encode('utf-8'))
+    chunk = [header]
+    size = header_size
+    for record in records:
+        line = format_record(record) + '\n'
+        line_size = len(line.encode('utf-8'))
+        if line_size > max_bytes - header_size:
+            line = line.encode('utf-8')[:max_bytes - header_size - 4].decode('utf-8', 'ignore') + '...\n'
+            line_size = len(line.encode('utf-8'))
+        if size + line_size > max_bytes:
+            yield ''.join(chunk)
+            chunk = [header]
+            size = header_size
+        chunk.append(line)
+        size += line_size
+    yield ''.join(chunk)
+
+
+class Schedule(object):
+    """
+    A backup schedule: its snapshots carry the period label and the date suffix of the
+    run that took them, and the newest keep_count of them are kept for each resource.
+
+    :param started: the start of the window of the date suffix, see period_start, None when
+                    the suffix was given without its period_format
+    """
+
+    def __init__(self, period, date_suffix, keep_count, started=None):
+        self.period = period
+        self.date_suffix = date_suffix
+        self.keep_count = int(keep_count)
+        self.started = started
+
+
+class SnapshotRecord(object):
+    """
+    A listed snapshot as kept in the inventory, in place of the response dict with its
+    dozens of keys and datetimes. The resolve_* methods of the managers read both.
+
+    :param periods: (period label, date suffix) pairs, the suffix is empty for snapshots
+                    matched on their name
+    :param created: creation time as epoch seconds, None while an RDS snapshot is being created
+    :param resource_type: 'volume', 'db' or 'cluster'
+    :param shared: the accounts the snapshot was shared with, from its SHARED_TAG
+    """
+    __slots__ = ('snapshot_id', 'resource_id', 'name', 'periods', 'created', 'state', 'resource_type', 'shared')
+
+    def __init__(self, snapshot_id, resource_id, name, periods, created, state, resource_type, shared=None):
+        self.snapshot_id = snapshot_id
+        self.resource_id = resource_id
+        self.name = name
+        self.periods = periods
+        self.created = created
+        self.state = state
+        self.resource_type = resource_type
+        self.shared = shared
+
+
+class CopyTarget(object):
+    """
+    Copy new snapshots to another region for disaster recovery.
+
+    :param region_name: the region to copy to
+    :param max_in_flight: copies in progress at once per service, AWS limits the number of
+                          concurrent copies to a destination region. The managers of every
+                          source region of an invocation share the one target, and the limit
+                          counts the copies of all of them
+    :param kms_key_id: key to encrypt the copies with, needed for encrypted snapshots
+    :param poll_seconds: wait between checks on the source snapshots and the copies
+    :param wait_seconds: stop starting copies after this long, the Lambda deadline also stops them.
+                         The snapshots left are copied by the next run
+    """
+
+    def __init__(self, region_name, max_in_flight=20, kms_key_id=None, poll_seconds=15, wait_seconds=600,
+                 clock=time.time, sleep=time.sleep):
+        self.region_name = region_name
+        self.max_in_flight = max(1, int(max_in_flight))
+        # Kept snapshots without a copy queued by a run per manager, the next runs take the rest
+        self.max_backfill = 2 * self.max_in_flight
+        self.kms_key_id = kms_key_id
+        self.poll_seconds = poll_seconds
+        self.wait_seconds = wait_seconds
+        self.clock = clock
+        self.sleep = sleep
+        # Copy ids in progress and copies being started, per service
+        self.in_flight = {}
+        self.starting = {}
+        self.lock = threading.Lock()
+
+    def track(self, service, copy_ids):
+        with self.lock:
+            self.in_flight.setdefault(service, set()).update(copy_ids)
+
+    def in_flight_ids(self, service):
+        with self.lock:
+            return sorted(self.in_flight.get(service, ()))
+
+    def finished(self, service, copy_id):
+        with self.lock:
+            self.in_flight.get(service, set()).discard(copy_id)
+
+    def room(self, service):
+        # The number of copies that could start now
+        with self.lock:
+            return max(0, self.max_in_flight - len(self.in_flight.get(service, ())) - self.starting.get(service, 0))
+
+    def reserve(self, service):
+        """
+        Take a slot for a copy about to start, False when max_in_flight copies are already in progress
+
+        :param service: the service of the copy
+        """
+        with self.lock:
+            if len(self.in_flight.get(service, ())) + self.starting.get(service, 0) >= self.max_in_flight:
+                return False
+            self.starting[service] = self.starting.get(service, 0) + 1
+            return True
+
+    def release(self, service, copy_id=None):
+        """
+        Give back a slot taken by reserve, keeping it for the copy if one started
+
+        :param service: the service of the copy
+        :param copy_id: the id of the copy started, None if it failed to start
+        """
+        with self.lock:
+            self.starting[service] -= 1
+            if copy_id is not None:
+                self.in_flight.setdefault(service, set()).add(copy_id)
 
 
 class BaseBackupManager(object):
-    def __init__(self, period, tag_name, tag_value, date_suffix, keep_count):
+    service = None
+
+    # Event keys lambda_handler passes to the constructor of the manager, by keyword argument
+    event_options = {'share_accounts': 'share_accounts', 'discovery': 'discovery'}
+
+    # Resource types to ask the Resource Groups Tagging API for, see tagged_resources
+    tagging_resource_types = ()
+
+    def __init__(self, period, tag_name, tag_value, date_suffix, keep_count, workers=1, plan_only=False,
+                 deadline=None, checkpoint_store=None, rate_limiter=None, share_accounts=None, copy_target=None,
+                 schedules=None, ledger_store=None, resource_ids=None, shard=None, discovery=None):
 
         # Message to return result
         self.message = ""
         self.errmsg = ""
 
+        # A plan only run makes read calls only and records the actions it would take in self.plan
+        self.plan_only = plan_only
+        self.plan = []
+        self.metrics = {}
+
+        # One JSON record per action, self.message only keeps the summary
+        self.result_log = None
+        self.report_blocks = []
+
         self.period = period
         self.tag_name = tag_name
         self.tag_value = tag_value
         self.date_suffix = date_suffix
         self.keep_count = keep_count
+        self.run_started = datetime.now(timezone.utc)
+
+        # Every schedule of the run shares one discovery and inventory pass, the first one is
+        # the period above. A resource is snapshotted for the schedules that have no snapshot
+        # with the current date suffix yet.
+        self.schedules = list(schedules) if schedules else [Schedule(period, date_suffix, keep_count)]
+        # Ids of the snapshots taken by this run, they don't count when deciding what is due
+        self.created_ids = set()
+        # The resources already snapshotted for the current date suffixes, so retries skip them
+        self.ledger = RunLedger(self.schedules, store=ledger_store)
+
+        # A shard of a coordinated run discovers and backs up only these resource ids
+        self.resource_ids = set(resource_ids) if resource_ids is not None else None
+        self.shard = shard
+
+        # 'tagging' finds the tagged resources of every type with the Resource Groups Tagging
+        # API, falling back to the describe calls of the service when it can't be used
+        self.discovery = discovery
+
+        # Number of resources processed in parallel, guard shared state with the lock
+        self.workers = max(1, int(workers))
+        self.lock = threading.RLock()
+
+        # Account wide snapshot inventory of SnapshotRecord, keyed by backupable id
+        self.snapshot_index = None
+        self.record_periods = {}
+        self.api_calls = 0
+        self.api_calls_saved = 0
+
+        # Per API call and per phase timings, emitted as CloudWatch metrics by the handler
+        self.instrumentation = Instrumentation()
+
+        self.region_name = None
+        self._conn = None
+        self._copy_conn = None
+        self._tagging_conn = None
+        # Clients without botocore retries for the mutating calls, see call_mutating
+        self._mutating_conn = None
+        self._copy_mutating_conn = None
+        # Clients with the API call counters registered on them
+        self.watched_clients = []
+
+        # Stop taking new resources once time.time() passes the deadline, and keep the ids
+        # of the finished resources in the checkpoint store for the next invocation
+        self.deadline = deadline
+        self.checkpoint_store = checkpoint_store
+        self.completed = set()
+        self.skipped = 0
+        self.stopped_early = False
+
+        # Shared between the managers of one invocation, so limits hold per service and region
+        self.rate_limiter = rate_limiter or RateLimiter()
+
+        # New snapshots are shared with these accounts by a pool of their own once they complete,
+        # so sharing runs alongside the creates rather than after each one. EXT_ACCOUNT is the
+        # older setting. See share_when_completed.
+        if share_accounts is None:
+            share_accounts = os.environ.get('EXT_ACCOUNT')
+        self.share_accounts = parse_accounts(share_accounts)
+        self.shared_with = ','.join(sorted(self.share_accounts))
+        self.share_executor = None
+        self.share_futures = []
+        self.share_waiter = None
+        self.share_records = []
+        self.pending_shares = []
+        self.shares_closed = threading.Event()
+        self.share_poll_seconds = SHARE_POLL_SECONDS
+        self.share_wait_seconds = SHARE_WAIT_SECONDS
+
+        # New snapshots, and kept snapshots without a copy, are copied to the copy target region
+        # once the resources are done. See run_copy_stage.
+        self.copy_target = copy_target
+        self.pending_copies = []
+        self.copy_candidates = []
+
+    @property
+    def conn(self):
+        # Connect to AWS using the credentials provided above or in Environment vars or using IAM role.
+        if self._conn is None:
+            print('Connecting to AWS')
+            self._conn = get_client(self.service, self.region_name)
+        self.watch_api_calls(self._conn)
+        return self._conn
+
+    @property
+    def copy_conn(self):
+        if self._copy_conn is None:
+            self._copy_conn = get_client(self.service, self.copy_target.region_name)
+        self.watch_api_calls(self._copy_conn)
+        return self._copy_conn
+
+    @property
+    def mutating_conn(self):
+        if self._mutating_conn is None:
+            self._mutating_conn = get_client(self.service, self.region_name, retries=False)
+        self.watch_api_calls(self._mutating_conn)
+        return self._mutating_conn
+
+    @property
+    def copy_mutating_conn(self):
+        if self._copy_mutating_conn is None:
+            self._copy_mutating_conn = get_client(self.service, self.copy_target.region_name, retries=False)
+        self.watch_api_calls(self._copy_mutating_conn)
+        return self._copy_mutating_conn
+
+    @property
+    def tagging_conn(self):
+        if self._tagging_conn is None:
+            self._tagging_conn = get_client('resourcegroupstaggingapi', self.region_name)
+        self.watch_api_calls(self._tagging_conn)
+        return self._tagging_conn
+
+    def tagged_resources(self):
+        """
+        The ARN and tags of every resource of this service carrying the backup tag, from one
+        paginated get_resources call for all the resource types.
+
+        :return: the ResourceTagMappingList entries, or None when the Tagging API can't be
+            used and the describe calls of the service have to be used instead
+        """
+        if self.discovery != 'tagging':
+            return None
+
+        mappings = []
+        try:
+            paginator = self.tagging_conn.get_paginator('get_resources')
+            for page in paginator.paginate(TagFilters=[{'Key': self.tag_name, 'Values': [self.tag_value]}],
+                                           ResourceTypeFilters=list(self.tagging_resource_types),
+                                           ResourcesPerPage=100):
+                mappings.extend(page['ResourceTagMappingList'])
+        except ClientError as e:
+            print('Tagging API discovery failed, falling back to %(service)s discovery: %(error)s' % {
+                'service': self.service,
+                'error': e
+            })
+            return None
+
+        if self.resource_ids is not None:
+            mappings = [mapping for mapping in mappings
+                        if arn_resource_id(mapping['ResourceARN']) in self.resource_ids]
+        return mappings
+
+    def watch_api_calls(self, client):
+        # Every client is taken through a property that lands here, on the thread about to call it
+        _api_caller.manager = self
+        with self.lock:
+            if any(watched is client for watched in self.watched_clients):
+                return
+            self.watched_clients.append(client)
+        # Tagging the call comes before the before-call handlers of any manager
+        client.meta.events.register('before-parameter-build', self.tag_api_call)
+        self.instrumentation.watch(client)
+        client.meta.events.register('before-call', self.count_api_call)
+
+    def unwatch_api_calls(self):
+        # Clients outlive the manager in a warm container, don't leave the handler behind
+        with self.lock:
+            clients, self.watched_clients = self.watched_clients, []
+        for client in clients:
+            client.meta.events.unregister('before-parameter-build', self.tag_api_call)
+            client.meta.events.unregister('before-call', self.count_api_call)
+            self.instrumentation.unwatch(client)
+        if getattr(_api_caller, 'manager', None) is self:
+            _api_caller.manager = None
+
+    def tag_api_call(self, context, **kwargs):
+        if getattr(_api_caller, 'manager', None) is self:
+            context['instrumentation'] = self.instrumentation
+
+    def count_api_call(self, context, **kwargs):
+        if context.get('instrumentation') is self.instrumentation:
+            with self.lock:
+                self.api_calls += 1
+
+    def call_mutating(self, operation, **kwargs):
+        # Throttled calls are retried by the rate limiter instead of failing the resource. The
+        # client doesn't retry them first, so the limiter sees and counts every throttle
+        return self.rate_limiter.call(self.service, self.region_name, operation,
+                                      getattr(self.mutating_conn, operation), **kwargs)
+
+    def call_mutating_in_copy_region(self, operation, **kwargs):
+        return self.rate_limiter.call(self.service, self.copy_target.region_name, operation,
+                                      getattr(self.copy_mutating_conn, operation), **kwargs)
+
+    def count_saved_api_calls(self, count):
+        with self.lock:
+            self.api_calls_saved += count
+
+    def load_snapshot_inventory(self):
+        pass
+
+    def checkpoint_key(self):
+        key = '%(service)s-%(region)s-%(schedules)s' % {
+            'service': self.service,
+            'region': self.region_name,
+            'schedules': '-'.join('%s-%s' % (schedule.period, schedule.date_suffix) for schedule in self.schedules)
+        }
+        if self.shard is not None:
+            key += '-shard-%s' % self.shard
+        return key
+
+    def load_checkpoint(self):
+        if self.checkpoint_store is None:
+            return
+        state = self.checkpoint_store.load(self.checkpoint_key())
+        if state:
+            self.completed = set(state['completed'])
+            print('Resuming from checkpoint with %(count)s resources already done' % {
+                'count': len(self.completed)
+            })
+
+    def ledger_key(self):
+        # One ledger per service, region and set of schedules, so the events of other schedules
+        # don't overwrite it. It only keeps the entries of the current date suffixes
+        key = '%(service)s-%(region)s-%(periods)s-ledger' % {
+            'service': self.service,
+            'region': self.region_name,
+            'periods': '-'.join(schedule.period for schedule in self.schedules)
+        }
+        if self.shard is not None:
+            key += '-shard-%s' % self.shard
+        return key
+
+    def save_checkpoint(self):
+        if self.checkpoint_store is None:
+            return
+        if self.stopped_early:
+            self.checkpoint_store.save(self.checkpoint_key(), {'completed': sorted(self.completed)})
+        else:
+            self.checkpoint_store.clear(self.checkpoint_key())
+
+    def out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def resource_id_chunks(self, size):
+        # None to discover every tagged resource, else the ids of the shard in chunks for the id filters
+        if self.resource_ids is None:
+            return [None]
+        resource_ids = sorted(self.resource_ids)
+        return [resource_ids[start:start + size] for start in range(0, len(resource_ids), size)]
 
-    def lookup_period_prefix(self):
-        return self.period
+    def pending_backupables(self, backupables):
+        for backup_item in backupables:
+            if self.out_of_time():
+                print('Stopping before the Lambda deadline, the remaining resources are left for the next run')
+                self.stopped_early = True
+                return
+            if self.resource_ids is not None and self.resolve_backupable_id(backup_item) not in self.resource_ids:
+                continue
+            if self.resolve_backupable_id(backup_item) in self.completed:
+                self.skipped += 1
+                continue
+            yield backup_item
+
+    def index_snapshot(self, resource_id, snapshot):
+        with self.lock:
+            self.snapshot_index.setdefault(resource_id, []).append(snapshot)
+
+    def mark_created(self, snapshot):
+        with self.lock:
+            self.created_ids.add(self.resolve_snapshot_id(snapshot))
+
+    def lookup_period_prefix(self, period=None):
+        return period or self.period
+
+    @staticmethod
+    def period_tags(schedules):
+        return dict((PERIOD_TAG_PREFIX + schedule.period, schedule.date_suffix) for schedule in schedules)
+
+    def snapshot_tags(self, resource_id, resource_tags, due):
+        tags = self.period_tags(due)
+        # One more for the share tag, added once the snapshot is shared
+        room = MAX_SNAPSHOT_TAGS - len(tags) - (1 if self.share_accounts else 0)
+        copied = [key for key in resource_tags if key not in tags]
+        if len(copied) > room:
+            print('  Copying %(room)s of the %(count)s tags of %(resource_id)s, snapshots take at most %(max)s' % {
+                'room': room,
+                'count': len(copied),
+                'resource_id': resource_id,
+                'max': MAX_SNAPSHOT_TAGS
+            })
+        snapshot_tags = OrderedDict((key, resource_tags[key]) for key in copied[:room])
+        snapshot_tags.update(tags)
+        return snapshot_tags
+
+    def primary_schedule(self, tags):
+        # The schedule a new snapshot is named after, the first one it is tagged for
+        for schedule in self.schedules:
+            if PERIOD_TAG_PREFIX + schedule.period in tags:
+                return schedule
+        return self.schedules[0]
+
+    def retention_policy(self):
+        return RetentionPolicy.rotation(OrderedDict((schedule.period, schedule.keep_count)
+                                                    for schedule in self.schedules))
+
+    def rotation_labels(self, snapshot):
+        # The schedules of this run the snapshot belongs to, in schedule order
+        periods = self.snapshot_periods(snapshot)
+        return tuple(schedule.period for schedule in self.schedules if schedule.period in periods)
+
+    def snapshot_periods(self, snapshot):
+        tags = self.resolve_snapshot_tags(snapshot)
+        periods = set(key[len(PERIOD_TAG_PREFIX):] for key in tags if key.startswith(PERIOD_TAG_PREFIX))
+        if not periods:
+            # Taken before snapshots were tagged, only the description or name tells
+            name = self.resolve_snapshot_name(snapshot)
+            for schedule in self.schedules:
+                if name.startswith(self.lookup_period_prefix(schedule.period)):
+                    periods.add(schedule.period)
+        return periods
+
+    def due_schedules(self, backup_id, snapshots):
+        """
+        The schedules a new snapshot of the resource is taken for. A schedule is due unless
+        its newest snapshot already carries the current date suffix and was taken in the
+        window of the suffix, the snapshots taken by this run don't count, or the ledger has
+        the resource for the suffix.
+        """
+        newest = {}
+        for snap in snapshots:
+            if self.resolve_snapshot_id(snap) in self.created_ids:
+                continue
+            epoch = self.rotation_epoch(snap)
+            for period in self.snapshot_periods(snap):
+                if period not in newest or epoch > newest[period][0]:
+                    newest[period] = (epoch, snap)
+
+        due = []
+        for schedule in self.schedules:
+            if self.ledger.recorded(schedule.period, schedule.date_suffix, backup_id):
+                continue
+            if schedule.period in newest:
+                epoch, snap = newest[schedule.period]
+                tags = self.resolve_snapshot_tags(snap)
+                # "Mon" a week ago or "week-41" a year ago is the same suffix of an earlier window
+                if tags.get(PERIOD_TAG_PREFIX + schedule.period) == schedule.date_suffix and \
+                        (schedule.started is None or epoch >= schedule.started.timestamp()):
+                    continue
+            due.append(schedule)
+        return due
+
+    def resolve_snapshot_tags(self, snapshot):
+        return {}
+
+    @staticmethod
+    def record_tags(record):
+        # Only the period and share tags are kept in a record
+        tags = dict((PERIOD_TAG_PREFIX + period, date_suffix) for period, date_suffix in record.periods)
+        if record.shared is not None:
+            tags[SHARED_TAG] = record.shared
+        return tags
+
+    def snapshot_record(self, snapshot):
+        # Built straight from the listed page, so the page can be freed once it is indexed
+        periods = tuple(sorted((key[len(PERIOD_TAG_PREFIX):], value)
+                               for key, value in self.resolve_snapshot_tags(snapshot).items()
+                               if key.startswith(PERIOD_TAG_PREFIX)))
+        if not periods:
+            periods = tuple((period, '') for period in sorted(self.snapshot_periods(snapshot)))
+        # Most snapshots of a schedule share their periods, keep one tuple of each
+        periods = self.record_periods.setdefault(periods, periods)
+        tags = self.resolve_snapshot_tags(snapshot)
+
+        return SnapshotRecord(snapshot_id=self.resolve_snapshot_id(snapshot),
+                              resource_id=self.resolve_backupable_id(snapshot),
+                              name=self.resolve_snapshot_name(snapshot),
+                              periods=periods,
+                              created=None if self.snapshot_in_progress(snapshot)
+                              else int(self.resolve_snapshot_epoch(snapshot)),
+                              state=self.resolve_snapshot_state(snapshot),
+                              resource_type=self.resolve_resource_type(snapshot),
+                              shared=tags.get(SHARED_TAG))
+
+    def resolve_snapshot_state(self, snapshot):
+        pass
 
     def get_resource_tags(self, resource_id):
         pass
@@ -45,184 +873,906 @@ class BaseBackupManager(object):
     def resolve_backupable_id(self, resource):
         pass
 
+    def shard_key(self, resource):
+        """
+        The key a resource is hashed by when the resources are split over shards.
+        """
+        return self.resolve_backupable_id(resource)
+
     def resolve_snapshot_name(self, resource):
         pass
 
     def resolve_snapshot_time(self, resource):
         return resource['StartTime']
 
-    def process_backup(self):
+    def resolve_snapshot_epoch(self, resource):
+        if isinstance(resource, SnapshotRecord):
+            return resource.created if resource.created is not None else self.run_started.timestamp()
+        snapshot_time = self.resolve_snapshot_time(resource)
+        if snapshot_time.tzinfo is None:
+            snapshot_time = snapshot_time.replace(tzinfo=timezone.utc)
+        return snapshot_time.timestamp()
+
+    def snapshot_in_progress(self, snapshot):
+        # A snapshot with no creation time yet, see rotation_epoch
+        return False
+
+    def rotation_epoch(self, snapshot):
+        # Snapshots still being created are the newest of their resource, whatever the clock says
+        if self.snapshot_in_progress(snapshot):
+            return float('inf')
+        return self.resolve_snapshot_epoch(snapshot)
+
+    def start_run(self):
         # Setup logging
-        start_message = 'Started taking %(period)s snapshots at %(date)s' % {
-            'period': self.period,
+        start_message = 'Started %(verb)s %(period)s snapshots at %(date)s' % {
+            'verb': 'planning' if self.plan_only else 'taking',
+            'period': ', '.join(schedule.period for schedule in self.schedules),
             'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
         }
-        self.message = start_message + "\n\n"
+        self.message = start_message + "\n"
+        self.run_started = datetime.now(timezone.utc)
+        self.plan = []
+        self.shares_closed.clear()
+        self.result_log = ResultLog()
+        self.report_blocks = []
         print(start_message)
 
+    def run_items(self, func, items):
+        if self.workers > 1:
+            return self.run_concurrently(func, items)
+        return [func(item) for item in items]
+
+    def queue_share(self, snapshot, candidate=False):
+        # Candidates are older snapshots kept by the rotation, shared only if they were not yet
+        if not self.share_accounts or self.plan_only:
+            return
+        if candidate and self.resolve_snapshot_tags(snapshot).get(SHARED_TAG) == self.shared_with:
+            return
+        with self.lock:
+            self.pending_shares.append(snapshot)
+            if self.share_waiter is None:
+                self.share_executor = ThreadPoolExecutor(max_workers=self.workers)
+                self.share_waiter = threading.Thread(target=self.share_when_completed)
+                self.share_waiter.daemon = True
+                self.share_waiter.start()
+
+    def share_when_completed(self):
+        """
+        Runs on a thread of its own: checks the states of the snapshots waiting to be shared
+        with one call per poll, and hands the completed ones to the share pool. Stops once
+        the resources are done and nothing is waiting, or SHARE_WAIT_SECONDS after that.
+        """
+        waiting = OrderedDict()
+        closed_at = None
+        while True:
+            with self.lock:
+                for snapshot in self.pending_shares:
+                    waiting[self.resolve_snapshot_id(snapshot)] = snapshot
+                self.pending_shares = []
+            if closed_at is None and self.shares_closed.is_set():
+                closed_at = time.time()
+
+            if waiting:
+                try:
+                    states = self.snapshot_states(self.conn, list(waiting))
+                except Exception as e:
+                    print('Error checking the snapshots to share: %s' % e)
+                    states = {}
+                for snapshot_id, state in states.items():
+                    if state == 'pending' or snapshot_id not in waiting:
+                        continue
+                    snapshot = waiting.pop(snapshot_id)
+                    if state == 'completed':
+                        future = self.share_executor.submit(self.share_new_snapshot, snapshot)
+                        with self.lock:
+                            self.share_futures.append(future)
+                    else:
+                        with self.lock:
+                            self.share_records.append(self.share_record(snapshot, 'share_failed',
+                                                                        error='Snapshot ended up in state ' + state))
+
+            if not waiting and closed_at is not None:
+                return
+            if closed_at is not None and (time.time() - closed_at >= self.share_wait_seconds or self.out_of_time()):
+                # Not an error, they are kept without the share tag and a later run shares them
+                print('%(count)s snapshots did not complete in time to be shared' % {'count': len(waiting)})
+                with self.lock:
+                    self.share_records.extend(self.share_record(snapshot, 'share_pending')
+                                              for snapshot in waiting.values())
+                return
+            if closed_at is None:
+                # Woken up early when the resources are done
+                self.shares_closed.wait(self.share_poll_seconds)
+            else:
+                time.sleep(self.share_poll_seconds)
+
+    def share_record(self, snapshot, action, **fields):
+        record = {
+            'service': self.service,
+            'region': self.region_name,
+            'resource_id': self.resolve_backupable_id(snapshot),
+            'action': action,
+            'snapshot_id': self.resolve_snapshot_id(snapshot),
+            'accounts': self.share_accounts,
+        }
+        record.update(fields)
+        return record
+
+    def share_new_snapshot(self, snapshot):
+        record = self.share_record(snapshot, 'share')
+        try:
+            with self.instrumentation.phase('share'):
+                self.share_snapshot(snapshot, self.share_accounts)
+        except Exception as e:
+            print('Error sharing %(snapshot_id)s: %(error)s' % {
+                'snapshot_id': record['snapshot_id'],
+                'error': e
+            })
+            record.update(action='share_failed', error=str(e))
+            return record
+
+        try:
+            self.set_resource_tags(snapshot, {SHARED_TAG: self.shared_with})
+        except Exception as e:
+            # Shared all the same, a later run shares it again and tags it then
+            print('Error tagging %(snapshot_id)s as shared: %(error)s' % {
+                'snapshot_id': record['snapshot_id'],
+                'error': e
+            })
+        return record
+
+    def wait_for_shares(self):
+        with self.lock:
+            waiter = self.share_waiter
+        if waiter is None:
+            return []
+        self.shares_closed.set()
+        waiter.join()
+
+        with self.lock:
+            executor, futures, records = self.share_executor, self.share_futures, self.share_records
+            self.share_executor, self.share_futures, self.share_records = None, [], []
+            self.share_waiter = None
+        executor.shutdown(wait=True)
+        records = records + [future.result() for future in futures]
+        return sorted(records, key=lambda r: (r['resource_id'], r['snapshot_id']))
+
+    def queue_copy(self, snapshot, candidate=False):
+        # Candidates are older snapshots kept by the rotation, copied only if they have no copy yet
+        if self.copy_target is None or self.plan_only:
+            return
+        with self.lock:
+            (self.copy_candidates if candidate else self.pending_copies).append(snapshot)
+
+    def copy_record(self, snapshot, action, **fields):
+        record = {
+            'service': self.service,
+            'region': self.region_name,
+            'resource_id': self.resolve_backupable_id(snapshot),
+            'action': action,
+            'snapshot_id': self.resolve_snapshot_id(snapshot),
+            'copy_region': self.copy_target.region_name,
+        }
+        record.update(fields)
+        return record
+
+    def load_copy_inventory(self):
+        """
+        The copies of the schedules of the run in the copy region, as (resource_id, copy, source epoch, state) tuples
+        """
+        copies = []
+        for copy in self.list_copy_snapshots():
+            tags = self.resolve_snapshot_tags(copy)
+            if COPY_SOURCE_TAG not in tags or not self.rotation_labels(copy):
+                continue
+            epoch = float(tags[COPY_TIME_TAG]) if COPY_TIME_TAG in tags else self.resolve_snapshot_epoch(copy)
+            copies.append((tags.get(COPY_RESOURCE_TAG), copy, epoch, self.copy_state(copy)))
+        return copies
+
+    def run_copy_stage(self, resource_ids):
+        """
+        Copy the new snapshots of the run, and the kept snapshots of the processed resources
+        that have no copy yet, to the copy region. Then rotate the copies of those resources.
+
+        :return: the copy records for the result log
+        """
+        with self.lock:
+            snapshots, candidates = self.pending_copies, self.copy_candidates
+            self.pending_copies, self.copy_candidates = [], []
+        if self.copy_target is None or self.plan_only:
+            return []
+
+        print('Copying snapshots to %(region)s' % {'region': self.copy_target.region_name})
+        with self.instrumentation.phase('copy'):
+            copies = self.load_copy_inventory()
+            copied = set(self.resolve_snapshot_tags(copy)[COPY_SOURCE_TAG] for _, copy, _, _ in copies)
+            in_flight = [self.resolve_snapshot_id(copy) for _, copy, _, state in copies if state == 'pending']
+
+            # The new snapshots first, then a limited backfill of the kept ones
+            queue = OrderedDict()
+            backfill = 0
+            deferred = 0
+            for candidate, snapshot in [(False, s) for s in snapshots] + [(True, s) for s in candidates]:
+                snapshot_id = self.resolve_snapshot_id(snapshot)
+                if not snapshot_id or snapshot_id in copied or snapshot_id in queue:
+                    continue
+                if candidate:
+                    if backfill >= self.copy_target.max_backfill:
+                        deferred += 1
+                        continue
+                    backfill += 1
+                queue[snapshot_id] = snapshot
+            if deferred:
+                print('Leaving %(count)s kept snapshots without a copy to the next runs' % {'count': deferred})
+
+            records, started = self.copy_snapshots(list(queue.values()), in_flight)
+            copies.extend(started)
+            records.extend(self.rotate_copies(copies, resource_ids))
+        return records
+
+    def copy_snapshots(self, snapshots, in_flight_ids):
+        """
+        Start a copy of each snapshot once it completes, keeping at most max_in_flight
+        copies in progress, counting the copies already in progress in the copy region
+        and those started by the managers of the other source regions.
+        """
+        target = self.copy_target
+        give_up = target.clock() + target.wait_seconds if target.wait_seconds is not None else None
+        queue = list(snapshots)
+        target.track(self.service, in_flight_ids)
+        copy_records = {}
+        records = []
+        started = []
+
+        while queue:
+            if self.out_of_time() or (give_up is not None and target.clock() >= give_up):
+                print('Stopped waiting to copy %(count)s snapshots' % {'count': len(queue)})
+                break
+
+            # Any manager can see a copy finish, whichever region it was started from
+            in_flight = target.in_flight_ids(self.service)
+            if in_flight:
+                for copy_id, state in self.snapshot_states(self.copy_conn, in_flight).items():
+                    if state == 'pending' or copy_id not in in_flight:
+                        continue
+                    target.finished(self.service, copy_id)
+                    record = copy_records.pop(copy_id, None)
+                    if record is not None and state == 'error':
+                        record.update(action='copy_failed', error='The copy failed in ' + target.region_name)
+
+            # Only the head of the queue that could start now is checked, snapshots still
+            # pending go to the back so the ones behind them get their turn
+            head = queue[:target.room(self.service)]
+            if head:
+                states = self.snapshot_states(self.conn, [self.resolve_snapshot_id(s) for s in head])
+                for snapshot in head:
+                    state = states.get(self.resolve_snapshot_id(snapshot), 'error')
+                    if state == 'pending':
+                        queue.remove(snapshot)
+                        queue.append(snapshot)
+                        continue
+                    if state == 'error':
+                        queue.remove(snapshot)
+                        records.append(self.copy_record(snapshot, 'copy_failed',
+                                                        error='The source snapshot is not available'))
+                        continue
+                    if not target.reserve(self.service):
+                        break
+                    queue.remove(snapshot)
+                    try:
+                        copy = self.copy_snapshot_to_target(snapshot)
+                    except Exception as e:
+                        target.release(self.service)
+                        print('Error copying %(snapshot_id)s: %(error)s' % {
+                            'snapshot_id': self.resolve_snapshot_id(snapshot),
+                            'error': e
+                        })
+                        records.append(self.copy_record(snapshot, 'copy_failed', error=str(e)))
+                        continue
+                    copy_id = self.resolve_snapshot_id(copy)
+                    target.release(self.service, copy_id)
+                    record = self.copy_record(snapshot, 'copy', copy_id=copy_id)
+                    records.append(record)
+                    copy_records[copy_id] = record
+                    started.append((self.resolve_backupable_id(snapshot), copy,
+                                    self.resolve_snapshot_epoch(snapshot), 'pending'))
+
+            if queue:
+                target.sleep(target.poll_seconds)
+
+        # Not an error, the next run finds them without a copy and copies them then
+        for snapshot in queue:
+            records.append(self.copy_record(snapshot, 'copy_pending'))
+        return records, started
+
+    def rotate_copies(self, copies, resource_ids):
+        resource_ids = set(resource_ids)
+        by_id = {}
+        entries = []
+        for resource_id, copy, epoch, _ in copies:
+            if resource_id in resource_ids:
+                copy_id = self.resolve_snapshot_id(copy)
+                by_id[copy_id] = (resource_id, copy)
+                entries.append((resource_id, copy_id, epoch, self.rotation_labels(copy)))
+
+        _, deletes = plan_retention(entries, self.retention_policy())
+
+        records = []
+        for copy_id in deletes:
+            resource_id, copy = by_id[copy_id]
+            record = {
+                'service': self.service,
+                'region': self.copy_target.region_name,
+                'resource_id': resource_id,
+                'action': 'copy_delete',
+                'snapshot_id': copy_id,
+            }
+            try:
+                self.delete_copy(copy)
+            except Exception as e:
+                record.update(action='copy_failed', error=str(e))
+            records.append(record)
+        return records
+
+    def copy_tags(self, snapshot):
+        tags = dict((k, v) for k, v in self.resolve_snapshot_tags(snapshot).items() if not k.startswith('aws:'))
+        # The period tags come with the source, untagged sources only have a name to go by
+        for period in self.snapshot_periods(snapshot):
+            tags.setdefault(PERIOD_TAG_PREFIX + period, '')
+        tags[COPY_SOURCE_TAG] = self.resolve_snapshot_id(snapshot)
+        tags[COPY_RESOURCE_TAG] = self.resolve_backupable_id(snapshot)
+        tags[COPY_TIME_TAG] = str(int(self.resolve_snapshot_epoch(snapshot)))
+        return tags
+
+    def finish_run(self, results):
+        copy_records = self.run_copy_stage(sorted(r['id'] for r in results if r['success']))
+        share_records = self.wait_for_shares()
+        self.unwatch_api_calls()
+
         # Counters
         total_creates = 0
         total_deletes = 0
         count_errors = 0
+        errors = []
 
         # Number of snapshots to keep
         count_success = 0
         count_total = 0
 
-        backupables = self.get_backable_resources()
-        for backup_item in backupables:
-
+        # Report in resource order so the output of two runs can be compared
+        for item_result in sorted(results, key=lambda r: r['id']):
             count_total += 1
-            backup_id = self.resolve_backupable_id(backup_item)
-
-            self.message += 'Processing backup item %(id)s\n' % {
-                'id': backup_id
-            }
-
-            try:
-                tags_volume = self.get_resource_tags(backup_item)
-                description = '%(period)s_snapshot %(item_id)s_%(period)s_%(date_suffix)s by snapshot script at %(date)s' % {
-                    'period': self.period,
-                    'item_id': backup_id,
-                    'date_suffix': self.date_suffix,
-                    'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
-                }
-                try:
-                    self.snapshot_resource(resource=backup_item, description=description, tags=tags_volume)
-                    self.message += '    New Snapshot created with description: %s and tags: %s\n' % (
-                        description, str(tags_volume))
-                    total_creates += 1
-                except Exception as e:
-                    print("Unexpected error:", sys.exc_info()[0])
-                    print(e)
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                              limit=2, file=sys.stdout)
-                    pass
-
-                snapshots = self.list_snapshots_for_resource(resource=backup_item)
-                deletelist = []
-
-                # Sort the list based on the dates of the objects
-                snapshots.sort(key=functools.cmp_to_key(self.date_compare))
-
-                for snap in snapshots:
-                    sndesc = self.resolve_snapshot_name(snap)
-                    if sndesc.startswith(self.lookup_period_prefix()):
-                        deletelist.append(snap)
-                    else:
-                        print('  Skipping other backup schedule: ' + sndesc)
-
-                self.message += "\n    Current backups in rotation (keeping {0})\n".format(self.keep_count)
-                self.message += "    ---------------------------\n"
-
-                for snap in deletelist:
-                    self.message += "    {0} - {1}\n".format(self.resolve_snapshot_name(snap),
-                                                             self.resolve_snapshot_time(snap))
-                self.message += "    ---------------------------\n"
-
-                deletelist.sort(key=functools.cmp_to_key(self.date_compare))
-                delta = len(deletelist) - self.keep_count
-
-                for i in range(delta):
-                    self.message += '    Deleting snapshot ' + self.resolve_snapshot_name(deletelist[i]) + '\n'
-                    self.delete_snapshot(deletelist[i])
-                    total_deletes += 1
-                    # time.sleep(3)
-            except Exception as ex:
-                print("Unexpected error:", sys.exc_info()[0])
-                print(ex)
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                          limit=2, file=sys.stdout)
-                logging.error('Error in processing volume with id: ' + backup_id)
-                self.errmsg += 'Error in processing volume with id: ' + backup_id
+            total_creates += item_result['creates']
+            total_deletes += item_result['deletes']
+            self.report_blocks.append(item_result['log_block'])
+            self.plan.extend(item_result['actions'])
+            if item_result['success']:
+                count_success += 1
+                self.completed.add(item_result['id'])
+            else:
+                errors.append(item_result['errmsg'])
                 count_errors += 1
+
+        # Shares and copies are reported after the resources, and do not fail their resource
+        total_shared = 0
+        total_shares_pending = 0
+        total_share_errors = 0
+        total_copies = 0
+        total_copies_pending = 0
+        total_copy_deletes = 0
+        total_copy_errors = 0
+        for records in (copy_records, share_records):
+            if records:
+                self.report_blocks.append(self.result_log.write(records))
+        for record in share_records:
+            if record['action'] == 'share':
+                total_shared += 1
+            elif record['action'] == 'share_pending':
+                total_shares_pending += 1
             else:
-                count_success += 1
+                errors.append('Error in sharing snapshot with id: ' + record['snapshot_id'])
+                total_share_errors += 1
+        for record in copy_records:
+            if record['action'] == 'copy':
+                total_copies += 1
+            elif record['action'] == 'copy_delete':
+                total_copy_deletes += 1
+            elif record['action'] == 'copy_pending':
+                total_copies_pending += 1
+            else:
+                errors.append('Error in copying snapshot with id: ' + record['snapshot_id'])
+                total_copy_errors += 1
+        self.errmsg += ''.join(errors)
 
-        result = '\nFinished making snapshots at %(date)s with %(count_success)s snapshots of %(count_total)s possible.\n\n' % {
+        result = 'Finished %(verb)s snapshots at %(date)s with %(count_success)s snapshots of %(count_total)s possible.\n' % {
+            'verb': 'planning' if self.plan_only else 'making',
             'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S'),
             'count_success': count_success,
             'count_total': count_total
         }
 
+        throttled = self.rate_limiter.throttle_count(self.service, self.region_name)
+
         self.message += result
         self.message += "\nTotal snapshots created: " + str(total_creates)
         self.message += "\nTotal snapshots errors: " + str(count_errors)
-        self.message += "\nTotal snapshots deleted: " + str(total_deletes) + "\n"
+        self.message += "\nTotal snapshots deleted: " + str(total_deletes)
+        if self.share_accounts:
+            self.message += "\nTotal snapshots shared: " + str(total_shared)
+            self.message += "\nTotal snapshots left to share in a later run: " + str(total_shares_pending)
+            self.message += "\nTotal snapshot share errors: " + str(total_share_errors)
+        if self.copy_target is not None:
+            self.message += "\nTotal snapshots copied to " + self.copy_target.region_name + ": " + str(total_copies)
+            self.message += "\nTotal snapshots left to copy in a later run: " + str(total_copies_pending)
+            self.message += "\nTotal copies deleted: " + str(total_copy_deletes)
+            self.message += "\nTotal snapshot copy errors: " + str(total_copy_errors)
+        self.message += "\nTotal resources skipped (done in an earlier run): " + str(self.skipped)
+        if self.stopped_early:
+            self.message += "\nStopped before the Lambda deadline, the next run continues from here"
+        self.message += "\nTotal AWS API calls: " + str(self.api_calls)
+        self.message += "\nTotal AWS API calls throttled: " + str(throttled)
+        self.message += "\nTotal AWS API calls saved: " + str(self.api_calls_saved) + "\n"
+
+        self.metrics = OrderedDict([
+            ("total_resources", count_total),
+            ("total_creates", total_creates),
+            ("total_errors", count_errors),
+            ("total_deletes", total_deletes),
+            ("total_shared", total_shared),
+            ("total_shares_pending", total_shares_pending),
+            ("total_share_errors", total_share_errors),
+            ("total_copies", total_copies),
+            ("total_copies_pending", total_copies_pending),
+            ("total_copy_deletes", total_copy_deletes),
+            ("total_copy_errors", total_copy_errors),
+            ("total_skipped", self.skipped),
+            ("total_stopped_early", int(self.stopped_early)),
+            ("total_api_calls", self.api_calls),
+            ("total_api_calls_saved", self.api_calls_saved),
+            ("total_throttled", throttled),
+        ])
+        return self.metrics
+
+    def fail_run(self, error):
+        """
+        Report a run stopped by an error outside of any one resource, an AccessDenied on
+        discovery in an opt-in region for example, as one error of the service and region.
+
+        :return: the metrics of the failed run
+        """
+        print('Error in %(service)s in %(region)s: %(error)s' % {
+            'service': self.service,
+            'region': self.region_name,
+            'error': error
+        })
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2, file=sys.stdout)
+        if self.result_log is None:
+            self.start_run()
+
+        self.report_blocks.append(self.result_log.write([{
+            'service': self.service,
+            'region': self.region_name,
+            'resource_id': '*',
+            'action': 'error',
+            'error': str(error),
+        }]))
+        # Snapshots taken before the error are still shared, with a later run if need be
+        share_records = self.wait_for_shares()
+        if share_records:
+            self.report_blocks.append(self.result_log.write(share_records))
+        self.unwatch_api_calls()
+
+        self.errmsg += 'Error in processing %s in %s' % (self.service, self.region_name)
+        self.message += 'Stopped on an error: %s\n' % error
+        self.metrics = OrderedDict([
+            ("total_resources", 0),
+            ("total_creates", 0),
+            ("total_errors", 1),
+            ("total_deletes", 0),
+            ("total_api_calls", self.api_calls),
+        ])
+        return self.metrics
 
+    def process_backup(self):
+        self.start_run()
+
+        self.load_checkpoint()
+        self.ledger.load(self.ledger_key())
+
+        # One inventory pass for the whole run instead of one listing per resource
+        with self.instrumentation.phase('list'):
+            self.load_snapshot_inventory()
+
+        backupables = self.pending_backupables(self.instrumentation.timed('discovery',
+                                                                          self.get_backable_resources()))
+        results = self.run_items(self.backup_resource, backupables)
+
+        metrics = self.finish_run(results)
+        self.save_checkpoint()
+        self.ledger.save(self.ledger_key())
+        return metrics
+
+    def apply_plan(self, actions):
+        """
+        Run the create and delete actions of a plan made by a plan_only run, without
+        repeating discovery. A create goes through the ledger and the snapshot inventory like
+        in process_backup, so a plan applied twice or after a backup run takes no second
+        snapshot for the same date suffix.
+
+        :param actions: action dicts as found in self.plan, actions for other services
+                        or regions are ignored
+        :return: the same metrics as process_backup
+        """
+        self.start_run()
+        self.ledger.load(self.ledger_key())
+
+        grouped = OrderedDict()
+        for action in actions:
+            if action['service'] == self.service and action['region'] == self.region_name:
+                grouped.setdefault(action['resource_id'], []).append(action)
+
+        results = self.run_items(self.apply_resource_actions, grouped.items())
+
+        metrics = self.finish_run(results)
+        self.ledger.save(self.ledger_key())
+        return metrics
+
+    def run_concurrently(self, func, items):
+        # Unlike executor.map this pulls from items lazily and keeps only a bounded
+        # number of them in flight, so discovery pages are consumed as they are processed
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = set()
+            for item in items:
+                if len(in_flight) >= self.workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    results.extend(future.result() for future in done)
+                in_flight.add(executor.submit(func, item))
+
+            done, _ = wait(in_flight)
+            results.extend(future.result() for future in done)
+        return results
+
+    def report_records(self):
+        # The records of the run in resource order
+        return self.result_log.records(self.report_blocks)
+
+    def render_report(self, max_bytes=SNS_MAX_BYTES):
+        return render_report(self.message, self.report_records(), max_bytes)
+
+    @staticmethod
+    def new_item_result(backup_id):
         return {
-            "total_resources": count_total,
-            "total_creates": total_creates,
-            "total_errors": count_errors,
-            "total_deletes": total_deletes,
+            'id': backup_id,
+            'records': [],
+            'errmsg': '',
+            'creates': 0,
+            'deletes': 0,
+            'success': True,
+            'actions': [],
+        }
+
+    def log_record(self, item_result, action, **fields):
+        record = {
+            'service': self.service,
+            'region': self.region_name,
+            'resource_id': item_result['id'],
+            'action': action,
+        }
+        record.update(fields)
+        item_result['records'].append(record)
+
+    def close_item_result(self, item_result):
+        item_result['log_block'] = self.result_log.write(item_result.pop('records'))
+        return item_result
+
+    def add_plan_action(self, item_result, action, resource, **fields):
+        # Only a plan keeps its actions, a backup run would hold one per snapshot of the fleet
+        if self.plan_only:
+            item_result['actions'].append(self.build_action(action, resource, **fields))
+
+    def build_action(self, action, resource, **fields):
+        record = {
+            'service': self.service,
+            'region': self.region_name,
+            'action': action,
+            'resource_id': self.resolve_backupable_id(resource),
+            'resource_type': self.resolve_resource_type(resource),
         }
+        record.update(fields)
+        return record
+
+    def backup_resource(self, backup_item):
+        # Runs on a worker thread when workers > 1, so only touch shared state under self.lock
+        backup_id = self.resolve_backupable_id(backup_item)
+        item_result = self.new_item_result(backup_id)
+
+        try:
+            # Listed before the create, so the snapshots already taken decide which schedules are due
+            with self.instrumentation.phase('list'):
+                snapshots = self.list_snapshots_for_resource(resource=backup_item)
+            due = self.due_schedules(backup_id, snapshots)
+
+            if not due:
+                print('  No schedule is due for ' + backup_id)
+                self.log_record(item_result, 'not_due')
+            else:
+                # One snapshot for every due schedule, named after the first of them
+                tags_volume = self.snapshot_tags(backup_id, self.get_resource_tags(backup_item), due)
+                description = '%(period)s_snapshot %(item_id)s_%(period)s_%(date_suffix)s by snapshot script at %(date)s' % {
+                    'period': due[0].period,
+                    'item_id': backup_id,
+                    'date_suffix': due[0].date_suffix,
+                    'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
+                }
+                self.add_plan_action(item_result, 'create', backup_item, description=description, tags=tags_volume)
+                if self.plan_only:
+                    snapshots.append(self.planned_snapshot(backup_item, description, tags_volume))
+                    self.log_record(item_result, 'create', description=description, tags=tags_volume, planned=True)
+                    item_result['creates'] += 1
+                else:
+                    try:
+                        with self.instrumentation.phase('create'):
+                            current_snap = self.snapshot_resource(resource=backup_item, description=description,
+                                                                  tags=tags_volume)
+                        self.mark_created(current_snap)
+                        self.record_snapshot_taken(backup_id, due, current_snap, snapshots)
+                        self.log_record(item_result, 'create', description=description, tags=tags_volume)
+                        item_result['creates'] += 1
+                    except SnapshotExists as e:
+                        print('  ' + str(e))
+                        self.record_snapshot_taken(backup_id, due, e.snapshot, snapshots)
+                        self.log_record(item_result, 'exists', snapshot_id=self.resolve_snapshot_id(e.snapshot),
+                                        snapshot_name=self.resolve_snapshot_name(e.snapshot))
+                    except Exception as e:
+                        self.log_record(item_result, 'create_failed', description=description, error=str(e))
+                        print("Unexpected error:", sys.exc_info()[0])
+                        print(e)
+                        exc_type, exc_value, exc_traceback = sys.exc_info()
+                        traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                                  limit=2, file=sys.stdout)
+                        pass
+
+            rotation = [snap for snap in snapshots if self.rotation_labels(snap)]
+            if len(rotation) < len(snapshots):
+                print('  Skipping %(count)s snapshots of other backup schedules' % {
+                    'count': len(snapshots) - len(rotation)
+                })
+
+            # Sort once on a precomputed key, oldest first
+            rotation.sort(key=self.rotation_epoch)
+
+            self.log_record(item_result, 'rotation', snapshots=len(rotation),
+                            keep=self.keep_count if len(self.schedules) == 1 else
+                            ','.join('%s:%s' % (schedule.period, schedule.keep_count) for schedule in self.schedules))
+
+            # Each schedule keeps its own newest snapshots, a snapshot goes once no schedule keeps it
+            keeps, deletes = plan_retention([(backup_id, i, self.rotation_epoch(snap),
+                                              self.rotation_labels(snap))
+                                             for i, snap in enumerate(rotation)], self.retention_policy())
+            for i in keeps:
+                self.queue_share(rotation[i], candidate=True)
+                self.queue_copy(rotation[i], candidate=True)
+
+            for i in sorted(deletes):
+                snap = rotation[i]
+                if self.snapshot_in_progress(snap):
+                    # Can't be deleted before it completes, the next run rotates it
+                    print('  Keeping %(snapshot_id)s until it completes' % {
+                        'snapshot_id': self.resolve_snapshot_id(snap)
+                    })
+                    continue
+                self.add_plan_action(item_result, 'delete', backup_item,
+                                     snapshot_id=self.resolve_snapshot_id(snap),
+                                     snapshot_name=self.resolve_snapshot_name(snap))
+                self.log_record(item_result, 'delete',
+                                snapshot_id=self.resolve_snapshot_id(snap),
+                                snapshot_name=self.resolve_snapshot_name(snap),
+                                planned=self.plan_only)
+                if not self.plan_only:
+                    with self.instrumentation.phase('delete'):
+                        self.delete_snapshot(snap)
+                item_result['deletes'] += 1
+                # time.sleep(3)
+        except Exception as ex:
+            print("Unexpected error:", sys.exc_info()[0])
+            print(ex)
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                      limit=2, file=sys.stdout)
+            logging.error('Error in processing volume with id: ' + backup_id)
+            self.log_record(item_result, 'error', error=str(ex))
+            item_result['errmsg'] = 'Error in processing volume with id: ' + backup_id
+            item_result['success'] = False
+
+        return self.close_item_result(item_result)
+
+    def record_snapshot_taken(self, backup_id, due, snapshot, snapshots):
+        for schedule in due:
+            self.ledger.record(schedule.period, schedule.date_suffix, backup_id)
+        # Volumes snapshotted together with their instance can already be in the listing
+        snapshot_id = self.resolve_snapshot_id(snapshot)
+        if not any(self.resolve_snapshot_id(snap) == snapshot_id for snap in snapshots):
+            snapshots.append(snapshot)
+
+    def apply_resource_actions(self, grouped_actions):
+        backup_id, actions = grouped_actions
+        item_result = self.new_item_result(backup_id)
+
+        try:
+            for action in actions:
+                if action['action'] == 'create':
+                    resource = self.resource_from_action(action)
+                    with self.instrumentation.phase('list'):
+                        snapshots = self.list_snapshots_for_resource(resource=resource)
+                    # Only the schedules the plan was made for, and only while they are still due
+                    due = [schedule for schedule in self.due_schedules(backup_id, snapshots)
+                           if action['tags'].get(PERIOD_TAG_PREFIX + schedule.period) == schedule.date_suffix]
+                    if not due:
+                        print('  No schedule is due for ' + backup_id)
+                        self.log_record(item_result, 'not_due')
+                        continue
+                    try:
+                        with self.instrumentation.phase('create'):
+                            current_snap = self.snapshot_resource(resource=resource,
+                                                                  description=action['description'],
+                                                                  tags=action['tags'])
+                    except SnapshotExists as e:
+                        print('  ' + str(e))
+                        self.record_snapshot_taken(backup_id, due, e.snapshot, snapshots)
+                        self.log_record(item_result, 'exists', snapshot_id=self.resolve_snapshot_id(e.snapshot),
+                                        snapshot_name=self.resolve_snapshot_name(e.snapshot))
+                        continue
+                    self.mark_created(current_snap)
+                    self.record_snapshot_taken(backup_id, due, current_snap, snapshots)
+                    self.log_record(item_result, 'create', description=action['description'], tags=action['tags'])
+                    item_result['creates'] += 1
+                elif action['action'] == 'delete':
+                    with self.instrumentation.phase('delete'):
+                        self.delete_snapshot(self.snapshot_from_action(action))
+                    self.log_record(item_result, 'delete',
+                                    snapshot_id=action['snapshot_id'],
+                                    snapshot_name=action['snapshot_name'])
+                    item_result['deletes'] += 1
+        except Exception as ex:
+            print("Unexpected error:", sys.exc_info()[0])
+            print(ex)
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                      limit=2, file=sys.stdout)
+            logging.error('Error in applying plan for volume with id: ' + backup_id)
+            self.log_record(item_result, 'error', error=str(ex))
+            item_result['errmsg'] = 'Error in applying plan for volume with id: ' + backup_id
+            item_result['success'] = False
+
+        return self.close_item_result(item_result)
+
+    def planned_snapshot(self, resource, description, tags):
+        pass
+
+    def resolve_resource_type(self, resource):
+        pass
+
+    def resolve_snapshot_id(self, snapshot):
+        pass
+
+    def resource_from_action(self, action):
+        pass
+
+    def snapshot_from_action(self, action):
+        pass
 
     def delete_snapshot(self, snapshot):
         pass
 
+    def snapshot_states(self, conn, snapshot_ids):
+        pass
+
+    def copy_snapshot_to_target(self, snapshot):
+        pass
+
+    def list_copy_snapshots(self):
+        pass
+
+    def copy_state(self, snapshot):
+        pass
+
+    def delete_copy(self, snapshot):
+        pass
+
 
 class EC2BackupManager(BaseBackupManager):
-    def __init__(self, region_name, period, tag_name, tag_value, date_suffix, keep_count):
+    service = 'ec2'
+    tagging_resource_types = ('ec2:volume',)
+
+    event_options = dict(BaseBackupManager.event_options, ec2_group_by_instance='group_by_instance')
+
+    def __init__(self, region_name, period, tag_name, tag_value, date_suffix, keep_count, workers=1, plan_only=False,
+                 deadline=None, checkpoint_store=None, rate_limiter=None, share_accounts=None, copy_target=None,
+                 conn=None, group_by_instance=False, schedules=None, ledger_store=None, resource_ids=None, shard=None,
+                 discovery=None):
         super(EC2BackupManager, self).__init__(period=period,
                                                tag_name=tag_name,
                                                tag_value=tag_value,
                                                date_suffix=date_suffix,
-                                               keep_count=keep_count)
-
-        # Connect to AWS using the credentials provided above or in Environment vars or using IAM role.
-        print('Connecting to AWS')
-        self.conn = boto3.client('ec2', region_name=region_name)
-
-    @staticmethod
-    def date_compare(snap1, snap2):
-        if snap1['StartTime'] < snap2['StartTime']:
-            return -1
-        elif snap1['StartTime'] == snap2['StartTime']:
-            return 0
-        return 1
-
-    def lookup_period_prefix(self):
-        return self.period + "_snapshot"
+                                               keep_count=keep_count,
+                                               workers=workers,
+                                               plan_only=plan_only,
+                                               deadline=deadline,
+                                               checkpoint_store=checkpoint_store,
+                                               rate_limiter=rate_limiter,
+                                               share_accounts=share_accounts,
+                                               copy_target=copy_target,
+                                               schedules=schedules,
+                                               ledger_store=ledger_store,
+                                               resource_ids=resource_ids,
+                                               shard=shard,
+                                               discovery=discovery)
+
+        # The client is created on first use, see BaseBackupManager.conn
+        self.region_name = region_name
+        self._conn = conn
+        self._mutating_conn = conn
+
+        # Snapshot the tagged volumes of an instance together, with one create_snapshots call.
+        # By instance id: the root and attached volume ids, the tagged volumes found so far,
+        # and the state of the create_snapshots call
+        self.group_by_instance = group_by_instance
+        self.instance_volumes = {}
+        self.tagged_volumes = {}
+        self.instance_snapshots = {}
+
+    def lookup_period_prefix(self, period=None):
+        return (period or self.period) + "_snapshot"
 
     def get_resource_tags(self, resource):
         resource_id = self.resolve_backupable_id(resource)
         resource_tags = {}
-        if resource_id:
+        if 'Tags' in resource:
+            # describe_volumes already returned the tags, no need to look them up again
+            tags = resource['Tags']
+            self.count_saved_api_calls(1)
+        elif resource_id:
             tags = self.conn.describe_tags(Filters=[{"Name": "resource-id",
-                                                     "Values": [resource_id]}])
-            for tag in tags["Tags"]:
-                # Tags starting with 'aws:' are reserved for internal use
-                if not tag['Key'].startswith('aws:'):
-                    resource_tags[tag['Key']] = tag['Value']
+                                                     "Values": [resource_id]}])["Tags"]
+        else:
+            tags = []
+
+        for tag in tags:
+            # Tags starting with 'aws:' are reserved for internal use
+            if not tag['Key'].startswith('aws:'):
+                resource_tags[tag['Key']] = tag['Value']
         return resource_tags
 
     def set_resource_tags(self, resource, tags):
-        resource_id = resource['SnapshotId']
-        for tag_key, tag_value in tags.items():
-            print('Tagging %(resource_id)s with [%(tag_key)s: %(tag_value)s]' % {
-                'resource_id': resource_id,
-                'tag_key': tag_key,
-                'tag_value': tag_value
-            })
+        resource_id = self.resolve_snapshot_id(resource)
+        if not tags:
+            return
 
-            self.conn.create_tags(Resources=[resource_id],
-                                  Tags=[{"Key": tag_key, "Value": tag_value}])
+        print('Tagging %(resource_id)s with %(tags)s' % {
+            'resource_id': resource_id,
+            'tags': tags
+        })
+
+        self.call_mutating('create_tags',
+                           Resources=[resource_id],
+                           Tags=[{"Key": tag_key, "Value": tag_value} for tag_key, tag_value in tags.items()])
 
-    def share_snapshot(self, resource, ext_account):
-        resource_id = resource['SnapshotId']
-        print('Sharing %(resource_id)s with %(ext_account)s' % {
+    def share_snapshot(self, resource, accounts):
+        resource_id = self.resolve_snapshot_id(resource)
+        print('Sharing %(resource_id)s with %(accounts)s' % {
             'resource_id': resource_id,
-            'ext_account': ext_account
+            'accounts': ', '.join(accounts)
         })
 
-        self.conn.modify_snapshot_attribute(SnapshotId=resource_id,
-                              Attribute='createVolumePermission',
-                              OperationType='add',
-                              UserIds=[
-                                  ext_account
-                              ])
+        # Every account in one call
+        self.call_mutating('modify_snapshot_attribute',
+                           SnapshotId=resource_id,
+                           Attribute='createVolumePermission',
+                           OperationType='add',
+                           UserIds=list(accounts))
 
     def get_backable_resources(self):
         # Get all the volumes that match the tag criteria
@@ -230,120 +1780,435 @@ class EC2BackupManager(BaseBackupManager):
             'tag_name': self.tag_name,
             'tag_value': self.tag_value
         })
-        volumes = self.conn.describe_volumes(Filters=[{"Name": 'tag:' + self.tag_name,
-                                                       "Values": [self.tag_value]}])["Volumes"]
+        count = 0
+        # Grouping by instance needs the attachments, which only describe_volumes returns
+        mappings = None if self.group_by_instance else self.tagged_resources()
+        if mappings is not None:
+            for mapping in mappings:
+                count += 1
+                yield {'VolumeId': arn_resource_id(mapping['ResourceARN']), 'Tags': mapping['Tags']}
+            print('Found %(count)s volumes to manage' % {'count': count})
+            return
+
+        # Stream the volumes page by page, so snapshotting starts as soon as the first page arrives
+        paginator = self.conn.get_paginator('describe_volumes')
+        for chunk in self.resource_id_chunks(200):
+            filters = [{"Name": 'tag:' + self.tag_name, "Values": [self.tag_value]}]
+            if chunk is not None:
+                filters.append({"Name": 'volume-id', "Values": chunk})
+            for page in paginator.paginate(Filters=filters):
+                if self.group_by_instance and not self.plan_only:
+                    self.load_instance_groups(page['Volumes'])
+                for volume in page['Volumes']:
+                    count += 1
+                    yield volume
+
+        print('Found %(count)s volumes to manage' % {'count': count})
 
-        print('Found %(count)s volumes to manage' % {'count': len(volumes)})
+    @staticmethod
+    def attached_instance(volume):
+        # Volumes attached to several instances (multi-attach) are snapshotted on their own
+        attachments = volume.get('Attachments', [])
+        if len(attachments) == 1:
+            return attachments[0]['InstanceId']
+        return None
+
+    def fits_tag_limit(self, volume):
+        # create_snapshots copies every tag of the volume, with the period tags that can be too many
+        tags = [tag for tag in volume.get('Tags', []) if not tag['Key'].startswith('aws:')]
+        return len(tags) + len(self.schedules) <= MAX_SNAPSHOT_TAGS
+
+    def load_instance_groups(self, volumes):
+        """
+        Group a page of tagged volumes by the instance they are attached to, and look up
+        the block devices of instances not seen on an earlier page in one call.
+        """
+        instance_ids = set()
+        with self.lock:
+            for volume in volumes:
+                instance_id = self.attached_instance(volume)
+                if instance_id and self.fits_tag_limit(volume):
+                    self.tagged_volumes.setdefault(instance_id, set()).add(volume['VolumeId'])
+                    if instance_id not in self.instance_volumes:
+                        instance_ids.add(instance_id)
+        if not instance_ids:
+            return
+
+        for page in self.conn.get_paginator('describe_instances').paginate(InstanceIds=sorted(instance_ids)):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    root = None
+                    attached = set()
+                    for mapping in instance.get('BlockDeviceMappings', []):
+                        if 'Ebs' not in mapping:
+                            continue
+                        attached.add(mapping['Ebs']['VolumeId'])
+                        if mapping['DeviceName'] == instance.get('RootDeviceName'):
+                            root = mapping['Ebs']['VolumeId']
+                    with self.lock:
+                        self.instance_volumes[instance['InstanceId']] = (root, attached)
+
+    def snapshot_instance_volume(self, instance_id, volume_id, period_tags):
+        """
+        The snapshot of the volume taken together with the other tagged volumes of its
+        instance. The first worker to get here makes the create_snapshots call, the others
+        wait for it. None if the volume was not part of the call.
+        """
+        with self.lock:
+            group = self.instance_snapshots.get(instance_id)
+            owner = group is None
+            if owner:
+                group = {'done': threading.Event(), 'snapshots': {}, 'error': None}
+                self.instance_snapshots[instance_id] = group
+
+        if owner:
+            try:
+                members = self.instance_group_members(instance_id, volume_id, period_tags)
+                group['snapshots'] = self.create_instance_snapshots(instance_id, members, period_tags)
+            except Exception as e:
+                group['error'] = e
+            finally:
+                group['done'].set()
+        else:
+            group['done'].wait()
+
+        if group['error'] is not None:
+            raise group['error']
+        return group['snapshots'].get(volume_id)
+
+    def instance_group_members(self, instance_id, volume_id, period_tags):
+        """
+        The tagged volumes of the instance to snapshot with the volume: the ones this run
+        still has to back up that are due for the same schedules. The others are left out
+        of the call, and snapshotted on their own if they are due at all.
+        """
+        periods = set(key[len(PERIOD_TAG_PREFIX):] for key in period_tags)
+        with self.lock:
+            tagged = set(self.tagged_volumes.get(instance_id, ()))
+            completed = set(self.completed)
+
+        members = set([volume_id])
+        for sibling_id in tagged - members - completed:
+            if self.resource_ids is not None and sibling_id not in self.resource_ids:
+                continue
+            due = self.due_schedules(sibling_id, self.list_snapshots_for_resource({'VolumeId': sibling_id}))
+            if set(schedule.period for schedule in due) == periods:
+                members.add(sibling_id)
+        return members
+
+    def create_instance_snapshots(self, instance_id, tagged, period_tags):
+        root, attached = self.instance_volumes[instance_id]
+        instance_spec = {
+            'InstanceId': instance_id,
+            'ExcludeBootVolume': root is not None and root not in tagged
+        }
+        excluded = sorted(attached - tagged - set([root]))
+        if excluded:
+            instance_spec['ExcludeDataVolumeIds'] = excluded
+
+        schedule = self.primary_schedule(period_tags)
+        description = '%(period)s_snapshot %(instance_id)s_%(period)s_%(date_suffix)s by snapshot script at %(date)s' % {
+            'period': schedule.period,
+            'instance_id': instance_id,
+            'date_suffix': schedule.date_suffix,
+            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
+        }
+        print('Snapshotting %(count)s volumes of %(instance_id)s together' % {
+            'count': len(attached & tagged),
+            'instance_id': instance_id
+        })
 
-        return volumes
+        # The volume tags are copied by EC2, only the period tags of the first volume are added
+        response = self.call_mutating('create_snapshots',
+                                      InstanceSpecification=instance_spec,
+                                      Description=description,
+                                      CopyTagsFromSource='volume',
+                                      TagSpecifications=[{
+                                          'ResourceType': 'snapshot',
+                                          'Tags': [{"Key": tag_key, "Value": tag_value}
+                                                   for tag_key, tag_value in period_tags.items()]
+                                      }])
+
+        snapshots = {}
+        for snap in response['Snapshots']:
+            snapshots[snap['VolumeId']] = snap
+            self.mark_created(snap)
+            if self.snapshot_index is not None:
+                self.index_snapshot(snap['VolumeId'], self.snapshot_record(snap))
+        self.count_saved_api_calls(max(0, len(snapshots) - 1))
+        return snapshots
 
     def snapshot_resource(self, resource, description, tags):
-        current_snap = self.conn.create_snapshot(VolumeId=self.resolve_backupable_id(resource),
-                                                 Description=description)
-        self.set_resource_tags(current_snap, tags)
-        try:
-            ext_account = (os.environ['EXT_ACCOUNT'])
-            self.share_snapshot(current_snap, ext_account)
-        except KeyError:
-            pass
+        current_snap = None
+        instance_id = self.attached_instance(resource) if self.group_by_instance and self.fits_tag_limit(resource) \
+            else None
+        if instance_id and instance_id in self.instance_volumes:
+            period_tags = dict((k, v) for k, v in tags.items() if k.startswith(PERIOD_TAG_PREFIX))
+            current_snap = self.snapshot_instance_volume(instance_id, self.resolve_backupable_id(resource), period_tags)
+
+        if current_snap is None:
+            current_snap = self.snapshot_volume(resource, description, tags)
+
+        # Without tags on create every copied volume tag took a create_tags call of its own,
+        # the period tags are new and save nothing
+        copied = len([key for key in tags if not key.startswith(PERIOD_TAG_PREFIX)])
+        applied = dict((tag['Key'], tag['Value']) for tag in current_snap.get('Tags', []))
+        missing = dict((k, v) for k, v in tags.items() if applied.get(k) != v)
+        if missing:
+            self.set_resource_tags(current_snap, missing)
+            self.count_saved_api_calls(max(0, copied - 1))
+        else:
+            self.count_saved_api_calls(copied)
+        self.queue_share(current_snap)
+        self.queue_copy(current_snap)
+        return current_snap
+
+    def snapshot_volume(self, resource, description, tags):
+        create_args = {
+            'VolumeId': self.resolve_backupable_id(resource),
+            'Description': description
+        }
+        if tags:
+            # Tag the snapshot as part of the create call rather than one create_tags per key
+            create_args['TagSpecifications'] = [{
+                'ResourceType': 'snapshot',
+                'Tags': [{"Key": tag_key, "Value": tag_value} for tag_key, tag_value in tags.items()]
+            }]
+
+        current_snap = self.call_mutating('create_snapshot', **create_args)
+        if self.snapshot_index is not None:
+            self.index_snapshot(current_snap['VolumeId'], self.snapshot_record(current_snap))
+        return current_snap
+
+    def load_snapshot_inventory(self):
+        print('Building snapshot inventory for the account')
+        self.snapshot_index = {}
+        paginator = self.conn.get_paginator('describe_snapshots')
+        count = 0
+        # Tagged snapshots keep the period prefix in their description, so one listing
+        # filtered on the description covers them and the untagged ones taken before.
+        # Filters are ANDed, a tag filter would leave the untagged ones out. The values of
+        # one filter are ORed, so every schedule of the run shares the listing.
+        for page in paginator.paginate(OwnerIds=['self'],
+                                       Filters=[{'Name': 'description',
+                                                 'Values': self.description_filter()}]):
+            for snap in page['Snapshots']:
+                self.index_snapshot(snap['VolumeId'], self.snapshot_record(snap))
+                count += 1
+
+        print('Indexed %(count)s snapshots across %(volumes)s volumes' % {
+            'count': count,
+            'volumes': len(self.snapshot_index)
+        })
+
+    def description_filter(self):
+        return [self.lookup_period_prefix(schedule.period) + '*' for schedule in self.schedules]
 
     def list_snapshots_for_resource(self, resource):
-        snapshots = self.conn.describe_snapshots(Filters=[
-            {"Name": "volume-id",
-             "Values": [self.resolve_backupable_id(resource)]
-             }])
+        if self.snapshot_index is None:
+            self.load_snapshot_inventory()
 
-        return snapshots['Snapshots']
+        return list(self.snapshot_index.get(self.resolve_backupable_id(resource), []))
 
     def resolve_backupable_id(self, resource):
+        if isinstance(resource, SnapshotRecord):
+            return resource.resource_id
+        return resource["VolumeId"]
+
+    def shard_key(self, resource):
+        # The volumes of an instance stay on one shard so they can be snapshotted together
+        if self.group_by_instance:
+            return self.attached_instance(resource) or resource["VolumeId"]
         return resource["VolumeId"]
 
+    def resolve_resource_type(self, resource):
+        return 'volume'
+
+    def resolve_snapshot_id(self, snapshot):
+        if isinstance(snapshot, SnapshotRecord):
+            return snapshot.snapshot_id
+        return snapshot['SnapshotId']
+
+    def planned_snapshot(self, resource, description, tags):
+        return {
+            'SnapshotId': None,
+            'VolumeId': self.resolve_backupable_id(resource),
+            'Description': description,
+            'StartTime': self.run_started,
+            'Tags': [{"Key": tag_key, "Value": tag_value} for tag_key, tag_value in tags.items()]
+        }
+
+    def resource_from_action(self, action):
+        return {'VolumeId': action['resource_id']}
+
+    def snapshot_from_action(self, action):
+        return {
+            'SnapshotId': action['snapshot_id'],
+            'VolumeId': action['resource_id'],
+            'Description': action['snapshot_name']
+        }
+
     def resolve_snapshot_name(self, resource):
+        if isinstance(resource, SnapshotRecord):
+            return resource.name
         return resource['Description']
 
+    def resolve_snapshot_tags(self, snapshot):
+        if isinstance(snapshot, SnapshotRecord):
+            return self.record_tags(snapshot)
+        return dict((tag['Key'], tag['Value']) for tag in snapshot.get('Tags', []))
+
     def resolve_snapshot_time(self, resource):
         return resource['StartTime']
 
+    def resolve_snapshot_state(self, snapshot):
+        return snapshot.get('State')
+
     def delete_snapshot(self, snapshot):
-        self.conn.delete_snapshot(SnapshotId=snapshot["SnapshotId"])
+        self.call_mutating('delete_snapshot', SnapshotId=self.resolve_snapshot_id(snapshot))
+
+    def snapshot_states(self, conn, snapshot_ids):
+        # A snapshot-id filter rather than SnapshotIds, which fails the call if one is gone
+        states = {}
+        for start in range(0, len(snapshot_ids), 200):
+            paginator = conn.get_paginator('describe_snapshots')
+            for page in paginator.paginate(OwnerIds=['self'],
+                                           Filters=[{'Name': 'snapshot-id',
+                                                     'Values': snapshot_ids[start:start + 200]}]):
+                for snap in page['Snapshots']:
+                    states[snap['SnapshotId']] = snap['State'] if snap['State'] in ('pending', 'completed') \
+                        else 'error'
+        return states
+
+    def copy_snapshot_to_target(self, snapshot):
+        copy_args = {
+            'SourceRegion': self.region_name,
+            'SourceSnapshotId': self.resolve_snapshot_id(snapshot),
+            'Description': self.resolve_snapshot_name(snapshot),
+            'TagSpecifications': [{
+                'ResourceType': 'snapshot',
+                'Tags': [{"Key": tag_key, "Value": tag_value}
+                         for tag_key, tag_value in self.copy_tags(snapshot).items()]
+            }]
+        }
+        if self.copy_target.kms_key_id:
+            copy_args.update(Encrypted=True, KmsKeyId=self.copy_target.kms_key_id)
+
+        copy = self.call_mutating_in_copy_region('copy_snapshot', **copy_args)
+        return {'SnapshotId': copy['SnapshotId'], 'Description': copy_args['Description'],
+                'Tags': copy_args['TagSpecifications'][0]['Tags']}
+
+    def list_copy_snapshots(self):
+        paginator = self.copy_conn.get_paginator('describe_snapshots')
+        for page in paginator.paginate(OwnerIds=['self'],
+                                       Filters=[{'Name': 'tag-key', 'Values': [COPY_SOURCE_TAG]},
+                                                {'Name': 'description', 'Values': self.description_filter()}]):
+            for snap in page['Snapshots']:
+                yield snap
+
+    def copy_state(self, snapshot):
+        return snapshot['State'] if snapshot['State'] in ('pending', 'completed') else 'error'
+
+    def delete_copy(self, snapshot):
+        self.call_mutating_in_copy_region('delete_snapshot', SnapshotId=snapshot['SnapshotId'])
 
 
 class RDSBackupManager(BaseBackupManager):
-    account_number = None
+    service = 'rds'
+    tagging_resource_types = ('rds:db', 'rds:cluster')
 
-    def __init__(self, region_name, period, tag_name, tag_value, date_suffix, keep_count):
+    def __init__(self, region_name, period, tag_name, tag_value, date_suffix, keep_count, workers=1, plan_only=False,
+                 deadline=None, checkpoint_store=None, rate_limiter=None, share_accounts=None, copy_target=None,
+                 conn=None, schedules=None, ledger_store=None, resource_ids=None, shard=None,
+                 discovery=None):
         super(RDSBackupManager, self).__init__(period=period,
                                                tag_name=tag_name,
                                                tag_value=tag_value,
                                                date_suffix=date_suffix,
-                                               keep_count=keep_count)
-
-        # Connect to AWS using the credentials provided above or in Environment vars or using IAM role.
-        print('Connecting to AWS')
-        self.conn = boto3.client('rds', region_name=region_name)
-
-    @staticmethod
-    def date_compare(snap1, snap2):
-        now = datetime.utcnow().replace(tzinfo=timezone.utc)
-        if snap1.get('SnapshotCreateTime', now) < snap2.get('SnapshotCreateTime', now):
-            return -1
-        elif snap1.get('SnapshotCreateTime', now) == snap2.get('SnapshotCreateTime', now):
-            return 0
-        return 1
-
-    def lookup_period_prefix(self):
-        return self.period
+                                               keep_count=keep_count,
+                                               workers=workers,
+                                               plan_only=plan_only,
+                                               deadline=deadline,
+                                               checkpoint_store=checkpoint_store,
+                                               rate_limiter=rate_limiter,
+                                               share_accounts=share_accounts,
+                                               copy_target=copy_target,
+                                               schedules=schedules,
+                                               ledger_store=ledger_store,
+                                               resource_ids=resource_ids,
+                                               shard=shard,
+                                               discovery=discovery)
+
+        # The client is created on first use, see BaseBackupManager.conn
+        self.region_name = region_name
+        self._conn = conn
+        self._mutating_conn = conn
+
+        # Tag sets by ARN, so no database has its tags fetched more than once per run
+        self.tag_cache = {}
+
+    def lookup_period_prefix(self, period=None):
+        return period or self.period
 
     def get_resource_tags(self, resource):
-        resource_id = self.resolve_backupable_id(resource)
         resource_tags = {}
 
-        if 'DBClusterIdentifier' in resource:
-            rds_type = 'cluster'
-        else:
-            rds_type = 'db'
-
-        if resource_id:
-            arn = self.build_arn_for_id(resource_id, rds_type)
-            tags = self.conn.list_tags_for_resource(ResourceName=arn)['TagList']
-
-            for tag in tags:
+        if self.resolve_backupable_id(resource):
+            for tag in self.get_db_tags(resource):
                 # Tags starting with 'aws:' are reserved for internal use
                 if not tag['Key'].startswith('aws:'):
                     resource_tags[tag['Key']] = tag['Value']
         return resource_tags
 
-    # This seems to not be in use for RDS
+    def get_db_tags(self, db_instance):
+        arn = self.build_arn(db_instance)
+
+        with self.lock:
+            tags = self.tag_cache.get(arn)
+        if tags is None:
+            if 'TagList' in db_instance:
+                # describe_db_instances / describe_db_clusters already returned the tags
+                tags = db_instance['TagList']
+                self.count_saved_api_calls(1)
+            else:
+                tags = self.conn.list_tags_for_resource(ResourceName=arn)['TagList']
+            with self.lock:
+                self.tag_cache[arn] = tags
+        else:
+            self.count_saved_api_calls(1)
+
+        return tags
+
     def set_resource_tags(self, resource, tags):
-        resource_id = resource['SnapshotId']
-        for tag_key, tag_value in tags.items():
-            print('Tagging %(resource_id)s with [%(tag_key)s: %(tag_value)s]' % {
-                'resource_id': resource_id,
-                'tag_key': tag_key,
-                'tag_value': tag_value
-            })
+        # Tags of a snapshot, the resources themselves are never tagged
+        resource_id = self.resolve_snapshot_id(resource)
+        if not tags:
+            return
+
+        print('Tagging %(resource_id)s with %(tags)s' % {
+            'resource_id': resource_id,
+            'tags': tags
+        })
 
-            self.conn.create_tags(Resources=[resource_id],
-                                  Tags=[{"Key": tag_key, "Value": tag_value}])
+        self.call_mutating('add_tags_to_resource',
+                           ResourceName=self.build_snapshot_arn(resource),
+                           Tags=[{"Key": tag_key, "Value": tag_value} for tag_key, tag_value in tags.items()])
 
-    def share_snapshot(self, resource, ext_account):
-        print('Sharing RDS Snapshot with %(ext_account)s' % {
-            'ext_account': ext_account
+    def share_snapshot(self, resource, accounts):
+        print('Sharing RDS Snapshot with %(accounts)s' % {
+            'accounts': ', '.join(accounts)
         })
-        if 'DBClusterSnapshotIdentifier' in resource:
-            resource_id = resource['DBClusterSnapshotIdentifier']
-            self.conn.modify_db_cluster_snapshot_attribute(DBClusterSnapshotIdentifier=resource_id,
-                                  AttributeName='restore',
-                                  ValuesToAdd=[
-                                      ext_account
-                                  ])
+        resource_id = self.resolve_snapshot_id(resource)
+        if self.resolve_resource_type(resource) == 'cluster':
+            self.call_mutating('modify_db_cluster_snapshot_attribute',
+                               DBClusterSnapshotIdentifier=resource_id,
+                               AttributeName='restore',
+                               ValuesToAdd=list(accounts))
         else:
-            resource_id = resource['DBSnapshotIdentifier']
-            self.conn.modify_db_snapshot_attribute(DBSnapshotIdentifier=resource_id,
-                                  AttributeName='restore',
-                                  ValuesToAdd=[
-                                      ext_account
-                                  ])
+            self.call_mutating('modify_db_snapshot_attribute',
+                               DBSnapshotIdentifier=resource_id,
+                               AttributeName='restore',
+                               ValuesToAdd=list(accounts))
 
     def get_backable_resources(self):
         # Get all the RDSes that match the tag criteria
@@ -351,25 +2216,63 @@ class RDSBackupManager(BaseBackupManager):
             'tag_name': self.tag_name,
             'tag_value': self.tag_value
         })
-        found = []
+        count = 0
+
+        mappings = self.tagged_resources()
+        if mappings is not None:
+            for db_instance in self.get_tagged_databases(mappings):
+                count += 1
+                yield db_instance
+            print('Found %(count)s databases to manage' % {'count': count})
+            return
+
+        # A shard holds cluster and instance ids alike, both listings are filtered on all of them
+        chunks = self.resource_id_chunks(100)
 
         # Process Aurora clusters
-        all_clusters = self.conn.describe_db_clusters()['DBClusters']
-        for cluster in all_clusters:
-            if self.db_has_tag(cluster):
-                found.append(cluster)
+        for chunk in chunks:
+            filters = [{'Name': 'db-cluster-id', 'Values': chunk}] if chunk is not None else []
+            for page in self.conn.get_paginator('describe_db_clusters').paginate(Filters=filters):
+                for cluster in page['DBClusters']:
+                    if self.db_has_tag(cluster):
+                        count += 1
+                        yield cluster
 
         # Process non-Aurora DB instances
-        all_instances = self.conn.describe_db_instances()['DBInstances']
-        for db_instance in all_instances:
-            # prevent adding instances belonging to cluster
-            if 'DBClusterIdentifier' not in db_instance:
-                if self.db_has_tag(db_instance):
-                    found.append(db_instance)
-
-        print('Found %(count)s databases to manage' % {'count': len(found)})
+        for chunk in chunks:
+            filters = [{'Name': 'db-instance-id', 'Values': chunk}] if chunk is not None else []
+            for page in self.conn.get_paginator('describe_db_instances').paginate(Filters=filters):
+                for db_instance in page['DBInstances']:
+                    # prevent adding instances belonging to cluster
+                    if 'DBClusterIdentifier' not in db_instance:
+                        if self.db_has_tag(db_instance):
+                            count += 1
+                            yield db_instance
+
+        print('Found %(count)s databases to manage' % {'count': count})
+
+    def get_tagged_databases(self, mappings):
+        """
+        The clusters and instances found by the Tagging API. Clusters are built from their
+        ARN, instances are described in batches to leave out the members of a cluster.
+        """
+        instance_ids = []
+        for mapping in mappings:
+            arn = mapping['ResourceARN']
+            with self.lock:
+                self.tag_cache[arn] = mapping['Tags']
+            if arn.split(':')[5] == 'cluster':
+                yield {'DBClusterIdentifier': arn_resource_id(arn), 'DBClusterArn': arn}
+            else:
+                instance_ids.append(arn_resource_id(arn))
 
-        return found
+        for start in range(0, len(instance_ids), 100):
+            filters = [{'Name': 'db-instance-id', 'Values': instance_ids[start:start + 100]}]
+            for page in self.conn.get_paginator('describe_db_instances').paginate(Filters=filters):
+                for db_instance in page['DBInstances']:
+                    # prevent adding instances belonging to cluster
+                    if 'DBClusterIdentifier' not in db_instance:
+                        yield db_instance
 
     def snapshot_resource(self, resource, description, tags):
 
@@ -377,78 +2280,231 @@ class RDSBackupManager(BaseBackupManager):
         for k in tags:
             aws_tagset.append({"Key": k, "Value": tags[k]})
 
-        date = datetime.today().strftime('%d-%m-%Y-%H-%M-%S')
-        snapshot_id = self.period + '-' + self.resolve_backupable_id(resource) + "-" + date + "-" + self.date_suffix
+        snapshot_id = self.build_snapshot_id(resource, tags)
 
-        if 'DBClusterIdentifier' in resource:
-            current_snap = self.conn.create_db_cluster_snapshot(
-                DBClusterIdentifier=self.resolve_backupable_id(resource),
-                DBClusterSnapshotIdentifier=snapshot_id,
-                Tags=aws_tagset)['DBClusterSnapshot']
-        else:
-            current_snap = self.conn.create_db_snapshot(DBInstanceIdentifier=self.resolve_backupable_id(resource),
-                                                        DBSnapshotIdentifier=snapshot_id,
-                                                        Tags=aws_tagset)['DBSnapshot']
+        # RDS takes no client token, the snapshot identifier is the same for every attempt
+        # of a run so a second create fails rather than taking another snapshot
         try:
-            ext_account = (os.environ['EXT_ACCOUNT'])
-            self.share_snapshot(current_snap, ext_account)
-        except KeyError:
-            pass
+            if self.resolve_resource_type(resource) == 'cluster':
+                current_snap = self.call_mutating(
+                    'create_db_cluster_snapshot',
+                    DBClusterIdentifier=self.resolve_backupable_id(resource),
+                    DBClusterSnapshotIdentifier=snapshot_id,
+                    Tags=aws_tagset)['DBClusterSnapshot']
+            else:
+                current_snap = self.call_mutating('create_db_snapshot',
+                                                  DBInstanceIdentifier=self.resolve_backupable_id(resource),
+                                                  DBSnapshotIdentifier=snapshot_id,
+                                                  Tags=aws_tagset)['DBSnapshot']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in SNAPSHOT_EXISTS_ERROR_CODES:
+                raise
+            raise SnapshotExists(self.describe_snapshot(resource, snapshot_id), snapshot_id)
+        if self.snapshot_index is not None:
+            self.index_snapshot(self.snapshot_index_key(current_snap), self.snapshot_record(current_snap))
+        self.queue_share(current_snap)
+        self.queue_copy(current_snap)
+        return current_snap
+
+    def load_snapshot_inventory(self):
+        print('Building RDS snapshot inventory for the account')
+        self.snapshot_index = {}
+        count = 0
+        # One paginated pass over the manual snapshots of every database instead of one
+        # unpaginated listing per database, keeping the snapshots of this run's schedules only
+        for operation, key in (('describe_db_snapshots', 'DBSnapshots'),
+                               ('describe_db_cluster_snapshots', 'DBClusterSnapshots')):
+            for page in self.conn.get_paginator(operation).paginate(SnapshotType='manual'):
+                for snap in page[key]:
+                    if self.rotation_labels(snap):
+                        self.index_snapshot(self.snapshot_index_key(snap), self.snapshot_record(snap))
+                        count += 1
+
+        print('Indexed %(count)s snapshots across %(databases)s databases' % {
+            'count': count,
+            'databases': len(self.snapshot_index)
+        })
+
+    def snapshot_index_key(self, snapshot):
+        # Instance and cluster identifiers are separate namespaces
+        return self.resolve_resource_type(snapshot), self.resolve_backupable_id(snapshot)
 
     def list_snapshots_for_resource(self, resource):
-        if 'DBClusterIdentifier' in resource:
-            snapshots = self.conn.describe_db_cluster_snapshots(
-                DBClusterIdentifier=self.resolve_backupable_id(resource),
-                SnapshotType='manual')
-            return snapshots['DBClusterSnapshots']
-        else:
-            snapshots = self.conn.describe_db_snapshots(DBInstanceIdentifier=self.resolve_backupable_id(resource),
-                                                        SnapshotType='manual')
+        if self.snapshot_index is None:
+            self.load_snapshot_inventory()
 
-            return snapshots['DBSnapshots']
+        key = (self.resolve_resource_type(resource), self.resolve_backupable_id(resource))
+        return list(self.snapshot_index.get(key, []))
+
+    def describe_snapshot(self, resource, snapshot_id):
+        if self.resolve_resource_type(resource) == 'cluster':
+            return self.conn.describe_db_cluster_snapshots(
+                DBClusterSnapshotIdentifier=snapshot_id)['DBClusterSnapshots'][0]
+        return self.conn.describe_db_snapshots(DBSnapshotIdentifier=snapshot_id)['DBSnapshots'][0]
+
+    def build_snapshot_id(self, resource, tags):
+        # The day the window of the date suffix started rather than the time of the run, so a
+        # retry or a continuation on a later day builds the same identifier
+        schedule = self.primary_schedule(tags)
+        date = (schedule.started or self.run_started).strftime('%d-%m-%Y')
+        return schedule.period + '-' + self.resolve_backupable_id(resource) + "-" + date + "-" + schedule.date_suffix
 
     def resolve_backupable_id(self, resource):
+        if isinstance(resource, SnapshotRecord):
+            return resource.resource_id
         return resource.get("DBClusterIdentifier") or resource.get("DBInstanceIdentifier")
 
+    def resolve_resource_type(self, resource):
+        if isinstance(resource, SnapshotRecord):
+            return resource.resource_type
+        if 'DBClusterIdentifier' in resource and 'DBInstanceIdentifier' not in resource:
+            return 'cluster'
+        return 'db'
+
+    def resolve_snapshot_id(self, snapshot):
+        return self.resolve_snapshot_name(snapshot)
+
+    def planned_snapshot(self, resource, description, tags):
+        tag_list = [{"Key": tag_key, "Value": tag_value} for tag_key, tag_value in tags.items()]
+        if self.resolve_resource_type(resource) == 'cluster':
+            return {'DBClusterIdentifier': self.resolve_backupable_id(resource),
+                    'DBClusterSnapshotIdentifier': self.build_snapshot_id(resource, tags),
+                    'TagList': tag_list}
+        return {'DBInstanceIdentifier': self.resolve_backupable_id(resource),
+                'DBSnapshotIdentifier': self.build_snapshot_id(resource, tags),
+                'TagList': tag_list}
+
+    def resource_from_action(self, action):
+        if action['resource_type'] == 'cluster':
+            return {'DBClusterIdentifier': action['resource_id']}
+        return {'DBInstanceIdentifier': action['resource_id']}
+
+    def snapshot_from_action(self, action):
+        if action['resource_type'] == 'cluster':
+            return {'DBClusterIdentifier': action['resource_id'],
+                    'DBClusterSnapshotIdentifier': action['snapshot_id']}
+        return {'DBInstanceIdentifier': action['resource_id'],
+                'DBSnapshotIdentifier': action['snapshot_id']}
+
     def resolve_snapshot_name(self, resource):
+        if isinstance(resource, SnapshotRecord):
+            return resource.name
         return resource.get('DBClusterSnapshotIdentifier') or resource.get('DBSnapshotIdentifier')
 
+    def resolve_snapshot_tags(self, snapshot):
+        if isinstance(snapshot, SnapshotRecord):
+            return self.record_tags(snapshot)
+        # The RDS describe calls have no tag filters, the period is checked on the listed TagList
+        return dict((tag['Key'], tag['Value']) for tag in snapshot.get('TagList', []))
+
+    def resolve_snapshot_state(self, snapshot):
+        return snapshot.get('Status')
+
     def resolve_snapshot_time(self, resource):
-        now = datetime.utcnow()
-        return resource.get('SnapshotCreateTime', now)
+        # Snapshots still being created have no time yet, when copied they count as taken when the run started
+        return resource.get('SnapshotCreateTime', self.run_started)
+
+    def snapshot_in_progress(self, snapshot):
+        if isinstance(snapshot, SnapshotRecord):
+            return snapshot.state == 'creating' or snapshot.created is None
+        return snapshot.get('Status') == 'creating' or 'SnapshotCreateTime' not in snapshot
 
     def delete_snapshot(self, snapshot):
-        if 'DBClusterIdentifier' in snapshot:
-            self.conn.delete_db_cluster_snapshot(DBClusterSnapshotIdentifier=snapshot["DBClusterSnapshotIdentifier"])
+        if self.resolve_resource_type(snapshot) == 'cluster':
+            self.call_mutating('delete_db_cluster_snapshot',
+                               DBClusterSnapshotIdentifier=self.resolve_snapshot_id(snapshot))
         else:
-            self.conn.delete_db_snapshot(DBSnapshotIdentifier=snapshot["DBSnapshotIdentifier"])
+            self.call_mutating('delete_db_snapshot', DBSnapshotIdentifier=self.resolve_snapshot_id(snapshot))
 
-    def db_has_tag(self, db_instance):
-        arn = self.build_arn(db_instance)
-        tags = self.conn.list_tags_for_resource(ResourceName=arn)['TagList']
+    @staticmethod
+    def db_snapshot_state(snapshot):
+        status = snapshot.get('Status')
+        if status == 'available':
+            return 'completed'
+        if status in ('creating', 'copying', 'pending'):
+            return 'pending'
+        return 'error'
+
+    def snapshot_states(self, conn, snapshot_ids):
+        states = {}
+        for start in range(0, len(snapshot_ids), 100):
+            chunk = snapshot_ids[start:start + 100]
+            for page in conn.get_paginator('describe_db_snapshots').paginate(
+                    Filters=[{'Name': 'db-snapshot-id', 'Values': chunk}]):
+                for snap in page['DBSnapshots']:
+                    states[snap['DBSnapshotIdentifier']] = self.db_snapshot_state(snap)
+            for page in conn.get_paginator('describe_db_cluster_snapshots').paginate(
+                    Filters=[{'Name': 'db-cluster-snapshot-id', 'Values': chunk}]):
+                for snap in page['DBClusterSnapshots']:
+                    states[snap['DBClusterSnapshotIdentifier']] = self.db_snapshot_state(snap)
+        return states
+
+    def copy_snapshot_to_target(self, snapshot):
+        copy_args = {
+            'SourceRegion': self.region_name,
+            'Tags': [{"Key": tag_key, "Value": tag_value} for tag_key, tag_value in self.copy_tags(snapshot).items()]
+        }
+        if self.copy_target.kms_key_id:
+            copy_args['KmsKeyId'] = self.copy_target.kms_key_id
+
+        # A cross region copy names its source by ARN, the copy keeps the name of the source
+        name = self.resolve_snapshot_id(snapshot)
+        if self.resolve_resource_type(snapshot) == 'cluster':
+            return self.call_mutating_in_copy_region(
+                'copy_db_cluster_snapshot',
+                SourceDBClusterSnapshotIdentifier=self.build_snapshot_arn(snapshot),
+                TargetDBClusterSnapshotIdentifier=name,
+                **copy_args)['DBClusterSnapshot']
+
+        return self.call_mutating_in_copy_region(
+            'copy_db_snapshot',
+            SourceDBSnapshotIdentifier=self.build_snapshot_arn(snapshot),
+            TargetDBSnapshotIdentifier=name,
+            **copy_args)['DBSnapshot']
+
+    def list_copy_snapshots(self):
+        for page in self.copy_conn.get_paginator('describe_db_snapshots').paginate(SnapshotType='manual'):
+            for snap in page['DBSnapshots']:
+                yield snap
+        for page in self.copy_conn.get_paginator('describe_db_cluster_snapshots').paginate(SnapshotType='manual'):
+            for snap in page['DBClusterSnapshots']:
+                yield snap
+
+    def copy_state(self, snapshot):
+        return self.db_snapshot_state(snapshot)
+
+    def delete_copy(self, snapshot):
+        if 'DBClusterSnapshotIdentifier' in snapshot:
+            self.call_mutating_in_copy_region('delete_db_cluster_snapshot',
+                                              DBClusterSnapshotIdentifier=snapshot['DBClusterSnapshotIdentifier'])
+        else:
+            self.call_mutating_in_copy_region('delete_db_snapshot',
+                                              DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])
 
-        for tag in tags:
+    def db_has_tag(self, db_instance):
+        for tag in self.get_db_tags(db_instance):
             if tag['Key'] == self.tag_name and tag['Value'] == self.tag_value:
                 return True
 
         return False
 
     def resolve_account_number(self):
-
-        if self.account_number is None:
-            groups = self.conn.describe_db_security_groups()['DBSecurityGroups']
-            if groups is None or len(groups) == 0:
-                self.account_number = 0
-            else:
-                self.account_number = groups[0]['OwnerId']
-
-        return self.account_number
+        return get_caller_identity(self.region_name)['Account']
 
     def build_arn(self, instance):
-        if 'DBClusterIdentifier' in instance:
-            return instance['DBClusterArn']
+        if 'DBClusterIdentifier' in instance and 'DBInstanceIdentifier' not in instance:
+            return instance.get('DBClusterArn') or self.build_arn_for_id(instance['DBClusterIdentifier'], 'cluster')
         else:
-            return self.build_arn_for_id(instance['DBInstanceIdentifier'],'db')
+            return instance.get('DBInstanceArn') or self.build_arn_for_id(instance['DBInstanceIdentifier'], 'db')
+
+    def build_snapshot_arn(self, snapshot):
+        # Listed snapshots carry their ARN, an inventory record only has the name
+        if self.resolve_resource_type(snapshot) == 'cluster':
+            arn_key, rds_type = 'DBClusterSnapshotArn', 'cluster-snapshot'
+        else:
+            arn_key, rds_type = 'DBSnapshotArn', 'snapshot'
+        arn = None if isinstance(snapshot, SnapshotRecord) else snapshot.get(arn_key)
+        return arn or self.build_arn_for_id(self.resolve_snapshot_id(snapshot), rds_type)
 
     def build_arn_for_id(self, instance_id, rds_type):
         # "arn:aws:rds:<region>:<account number>:<resourcetype>:<name>"
@@ -458,104 +2514,582 @@ class RDSBackupManager(BaseBackupManager):
 
         return "arn:aws:rds:{0}:{1}:{2}:{3}".format(region, account_number, rds_type, instance_id)
 
-def lambda_handler(event, context={}):
+
+def arn_resource_id(arn):
+    # arn:aws:ec2:<region>:<account>:volume/<id> or arn:aws:rds:<region>:<account>:db:<id>
+    return arn.replace('/', ':').rsplit(':', 1)[-1]
+
+
+def parse_accounts(accounts):
+    # A list of account numbers, or one string of them separated by commas
+    if isinstance(accounts, str):
+        accounts = accounts.split(',')
+    return [account.strip() for account in accounts or [] if account.strip()]
+
+
+def load_plan(plan):
+    # A plan is either a list of actions or the JSON lines emitted by a plan run
+    if isinstance(plan, str):
+        return [json.loads(line) for line in plan.splitlines() if line.strip()]
+    return list(plan)
+
+
+def dump_plan(actions):
+    return "\n".join(json.dumps(action, sort_keys=True) for action in actions)
+
+
+def run_backup_manager(backup_mgr, plan_actions):
+    if plan_actions:
+        return backup_mgr.apply_plan(plan_actions)
+    return backup_mgr.process_backup()
+
+
+BACKUP_MANAGERS = OrderedDict([
+    ('ec2', EC2BackupManager),
+    ('rds', RDSBackupManager),
+])
+
+SNS_LABELS = {
+    'ec2': ('volumes', 'EC2'),
+    'rds': ('RDS', 'RDS'),
+}
+
+
+def resolve_regions(event, service):
+    # Service specific regions win, then the shared list, a single name is a list of one
+    regions = event.get(service + '_region_name') or event.get('regions') or event.get('region_name') or []
+    if isinstance(regions, str):
+        regions = [regions]
+    return list(regions)
+
+
+def merge_metrics(all_metrics):
+    merged = OrderedDict()
+    for metrics in all_metrics:
+        for key, value in metrics.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def sns_client_for(topic_arn):
+    # arn:aws:sns:<region>:<account number>:<name>
+    return get_client('sns', topic_arn.split(':')[3])
+
+
+def copy_target_from_event(event):
+    if not event.get('dr_region'):
+        return None
+    return CopyTarget(region_name=event['dr_region'],
+                      max_in_flight=event.get('dr_max_copies_in_flight', 20),
+                      kms_key_id=event.get('dr_kms_key_id'),
+                      poll_seconds=event.get('dr_poll_seconds', 15),
+                      wait_seconds=event.get('dr_wait_seconds', 600))
+
+
+def resolve_schedules(event):
     """
-    Example content
-        {
-            "period_label": "day",
-            "period_format": "%a%H",
+    The schedules of the event, the "schedules" list or else the single period_label,
+    period_format and keep_count. A continuation carries the date suffixes of the
+    invocation it continues, even if a period rolled over since.
+    """
+    if event.get('schedules'):
+        entries = event['schedules']
+    else:
+        entries = [{'period_label': event['period_label'],
+                    'period_format': event['period_format'],
+                    'keep_count': event['keep_count'],
+                    'date_suffix': event.get('date_suffix')}]
+
+    now = datetime.today()
+    schedules = []
+    for entry in entries:
+        date_suffix = entry.get('date_suffix') or now.strftime(entry['period_format'])
+        started = period_start(entry['period_format'], date_suffix, now) if entry.get('period_format') else None
+        schedules.append(Schedule(entry['period_label'], date_suffix, entry['keep_count'], started=started))
+    return schedules
+
+
+def period_start(period_format, date_suffix, now):
+    """
+    The start of the window of times up to now that period_format renders as date_suffix,
+    the day for "%a" or the Sunday of the week for "%U".
 
-            "region_name": "ap-southeast-2",
+    :return: a datetime, or None if the format has no date or time directive or the suffix
+             wasn't rendered within PERIOD_LOOKBACK_SECONDS
+    """
+    units = [PERIOD_UNITS[directive] for directive in re.findall(r'%([a-zA-Z])', period_format)
+             if directive in PERIOD_UNITS]
+    if not units:
+        return None
+    step = min(min(units), DAY_SECONDS)
+    fields = {1: ('microsecond',), 60: ('second', 'microsecond'), 3600: ('minute', 'second', 'microsecond'),
+              DAY_SECONDS: ('hour', 'minute', 'second', 'microsecond')}[step]
+    start = now.replace(**dict.fromkeys(fields, 0))
+    step = timedelta(seconds=step)
+
+    # A continuation carries the suffix of the invocation it continues, which can be a window back
+    for _ in range(int(PERIOD_LOOKBACK_SECONDS / step.total_seconds())):
+        if start.strftime(period_format) == date_suffix:
+            break
+        start -= step
+    else:
+        return None
+    while (start - step).strftime(period_format) == date_suffix:
+        start -= step
+    return start
+
+
+def checkpoint_store_from_event(event):
+    if event.get('checkpoint_bucket'):
+        return S3CheckpointStore(bucket=event['checkpoint_bucket'],
+                                 prefix=event.get('checkpoint_prefix', 'checkpoints/'))
+    if event.get('checkpoint_path'):
+        return LocalFileCheckpointStore(event['checkpoint_path'])
+    return None
+
+
+def resolve_deadline(event, context):
+    # Leave a margin for the resource in progress and for reporting
+    margin = event.get('time_margin_seconds', 30)
+    deadline = None
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is not None:
+        deadline = time.time() + get_remaining_time() / 1000.0 - margin
+
+    # A shard also has to return to its coordinator, which is waiting on it within a timeout of its own
+    coordinator_deadline = event.get('coordinator_deadline')
+    if coordinator_deadline is not None:
+        deadline = min(d for d in (deadline, coordinator_deadline - margin) if d is not None)
+    return deadline
+
+
+def continue_in_new_invocation(event, context):
+    continuation = dict(event)
+    continuation['continuation'] = event.get('continuation', 0) + 1
+    # A shard that continues is no longer awaited by its coordinator
+    continuation.pop('coordinator_deadline', None)
+    print('Continuing in a new invocation (%(count)s)' % {'count': continuation['continuation']})
+
+    function_arn = context.invoked_function_arn
+    get_client('lambda', function_arn.split(':')[3]).invoke(FunctionName=function_arn,
+                                                             InvocationType='Event',
+                                                             Payload=json.dumps(continuation))
+
+
+def publish_report(topic_arn, subject, messages):
+    # Long reports go out as several publishes, each under the SNS size limit
+    sns_boto = sns_client_for(topic_arn)
+    for part, message in enumerate(messages, 1):
+        sns_boto.publish(TopicArn=topic_arn, Message=message,
+                         Subject=subject if part == 1 else '%s (part %s)' % (subject, part))
+
+
+def combined_report(region_managers):
+    """
+    One report for every service and region of the run: the summaries of each manager
+    followed by all of their records.
 
-            "ec2_tag_name": "MakeSnapshot",
-            "ec2_tag_value": "True",
+    :param region_managers: (region_name, {service: manager}) pairs
+    :return: (subject, messages)
+    """
+    labels = []
+    summaries = []
+    blocks = []
+    for region_name, managers in region_managers:
+        for service, backup_mgr in managers.items():
+            service_label = SNS_LABELS[service][1]
+            if service_label not in labels:
+                labels.append(service_label)
+            summaries.append('%s in %s:\n%s' % (service_label, region_name, backup_mgr.message))
+            blocks.append(backup_mgr.report_records())
+
+    subject = 'Finished AWS %s snapshotting' % ' and '.join(labels)
+    return subject, render_report('\n'.join(summaries), itertools.chain.from_iterable(blocks))
+
+
+def combined_error_report(region_managers):
+    # The error records of every manager that had errors, None if there were none
+    failed = [(region_name, service, backup_mgr)
+              for region_name, managers in region_managers
+              for service, backup_mgr in managers.items() if backup_mgr.errmsg]
+    if not failed:
+        return None
+
+    header = 'Error in processing %s:' % ', '.join('%s in %s' % (SNS_LABELS[service][0], region_name)
+                                                    for region_name, service, _ in failed)
+    errors = (record
+              for _, _, backup_mgr in failed
+              for record in backup_mgr.report_records() if record['action'] in ERROR_ACTIONS)
+    return render_report(header, errors)
+
+
+class InProcessDispatcher(object):
+    """
+    Runs the shards of a coordinated run with lambda_handler in this process, for tests
+    and local runs.
+    """
 
-            "rds_tag_name": "Environment",
-            "rds_tag_value": "prod",
+    def invoke(self, event):
+        return json.loads(lambda_handler(event))
 
-            "arn": "blart",
 
-            "keep_count": 12
-        }
-    :param event:
-    :param context:
-    :return:
+class LambdaDispatcher(object):
+    """
+    Runs each shard of a coordinated run as a synchronous invocation of the function,
+    so every shard gets a Lambda timeout of its own.
     """
 
-    print("Received event: " + json.dumps(event, indent=2))
+    def __init__(self, function_arn):
+        self.function_arn = function_arn
+        region_name = function_arn.split(':')[3]
+        # A shard can run for the whole Lambda timeout, and a retry would run it twice
+        with _cache_lock:
+            self.client = get_session(region_name).client('lambda', region_name=region_name,
+                                                          config=Config(read_timeout=SHARD_READ_TIMEOUT,
+                                                                        retries={'max_attempts': 0}))
+
+    def invoke(self, event):
+        response = self.client.invoke(FunctionName=self.function_arn,
+                                      InvocationType='RequestResponse',
+                                      Payload=json.dumps(event))
+        payload = json.loads(response['Payload'].read())
+        if response.get('FunctionError'):
+            raise RuntimeError('Shard %s failed: %s' % (event['shard'], payload.get('errorMessage')))
+        # lambda_handler returns a JSON string, which Lambda encodes once more
+        return json.loads(payload) if isinstance(payload, str) else payload
+
+
+def discover_shards(jobs, schedules, shard_count, event=None):
+    """
+    Discover the tagged resources of every service and region once, and split their ids
+    over the shards by consistent hashing.
 
-    period = event["period_label"]
-    period_format = event["period_format"]
+    :param event: the event options of the managers, grouped volumes are hashed by their instance
+    :return: one {service: {region: [resource ids]}} dict per shard
+    """
+    event = event or {}
+    ring = HashRing(shard_count)
+    shards = [OrderedDict() for _ in range(shard_count)]
+    for region_name, service, tag_name, tag_value in jobs:
+        manager_class = BACKUP_MANAGERS[service]
+        options = dict((kwarg, event[key]) for key, kwarg in manager_class.event_options.items() if key in event)
+        backup_mgr = manager_class(region_name=region_name,
+                                   period=schedules[0].period,
+                                   tag_name=tag_name,
+                                   tag_value=tag_value,
+                                   date_suffix=schedules[0].date_suffix,
+                                   keep_count=schedules[0].keep_count,
+                                   schedules=schedules,
+                                   plan_only=True,
+                                   **options)
+        shard_ids = [[] for _ in range(shard_count)]
+        for resource in backup_mgr.get_backable_resources():
+            shard_ids[ring.shard_for(backup_mgr.shard_key(resource))].append(
+                backup_mgr.resolve_backupable_id(resource))
+        backup_mgr.unwatch_api_calls()
+
+        for shard, ids in enumerate(shard_ids):
+            if ids:
+                shards[shard].setdefault(service, OrderedDict())[region_name] = ids
+    return shards
+
+
+def coordinate_shards(event, jobs, schedules, shard_count, dispatcher, deadline=None):
+    """
+    Run discovery once, then run every non empty shard through the dispatcher at the same
+    time and add up their metrics.
 
-    ec2_tag_name = event.get('ec2_tag_name', None)
-    ec2_tag_value = event.get('ec2_tag_value', None)
+    :param event: the event for the shards, with the date suffixes of this run
+    :param deadline: the deadline of the coordinator, the shards stop in time to return by it
+    """
+    shards = discover_shards(jobs, schedules, shard_count, event=event)
+    shard_events = []
+    for shard, shard_resources in enumerate(shards):
+        if shard_resources:
+            # The coordinator sends the report, errors still go out from each shard
+            shard_event = dict(event, shard=shard, shard_resources=shard_resources)
+            shard_event.pop('arn', None)
+            if deadline is not None:
+                shard_event['coordinator_deadline'] = deadline
+            shard_events.append(shard_event)
+    print('Running %(count)s of %(total)s shards' % {'count': len(shard_events), 'total': shard_count})
+
+    def run_shard(shard_event):
+        record = OrderedDict([
+            ('shard', shard_event['shard']),
+            ('resources', sum(len(ids) for regions in shard_event['shard_resources'].values()
+                              for ids in regions.values())),
+        ])
+        try:
+            result = dispatcher.invoke(shard_event)
+        except Exception as e:
+            print('Error running shard %(shard)s: %(error)s' % {'shard': shard_event['shard'], 'error': e})
+            record['error'] = str(e)
+            return record, None
+        record['metrics'] = result['metrics']
+        record['continued'] = result.get('continued', False)
+        return record, result
+
+    outcomes = []
+    if shard_events:
+        with ThreadPoolExecutor(max_workers=len(shard_events)) as executor:
+            outcomes = list(executor.map(run_shard, shard_events))
+    records = [record for record, _ in outcomes]
+    results = [result for _, result in outcomes if result is not None]
+
+    service_names = [service for service in BACKUP_MANAGERS if any(service in r['services'] for r in results)]
+    summary = OrderedDict()
+    summary['shard_results'] = records
+    summary['services'] = OrderedDict((service, merge_metrics(r['services'][service]
+                                                              for r in results if service in r['services']))
+                                      for service in service_names)
+    summary['metrics'] = merge_metrics(r['metrics'] for r in results)
+    summary['metrics']['total_shard_errors'] = len(records) - len(results)
+    if event.get('mode') == 'plan':
+        summary['plan_actions'] = sum(r.get('plan_actions', 0) for r in results)
+    return summary
+
+
+def render_shard_report(summary):
+    lines = ['Finished %(count)s shards at %(date)s' % {
+        'count': len(summary['shard_results']),
+        'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
+    }]
+    for record in summary['shard_results']:
+        if 'error' in record:
+            lines.append('Shard %s (%s resources) failed: %s' % (record['shard'], record['resources'], record['error']))
+        else:
+            lines.append('Shard %s (%s resources): %s' % (record['shard'], record['resources'], ', '.join(
+                '%s=%s' % item for item in record['metrics'].items())))
+    lines.append('Total: ' + ', '.join('%s=%s' % item for item in summary['metrics'].items()))
+    return render_report('\n'.join(lines), [])
 
-    rds_tag_name = event.get('rds_tag_name', None)
-    rds_tag_value = event.get('rds_tag_value', None)
 
-    region_name = event['region_name']
+def lambda_handler(event, context={}, dispatcher=None):
+    """
+    Example content
+        {
+            "period_label": "day",
+            "period_format": "%a%H",
 
-    sns_arn = event.get('arn')
-    error_sns_arn = event.get('error_arn')
-    keep_count = event['keep_count']
+            "schedules": [
+                {"period_label": "day", "period_format": "%a", "keep_count": 7},
+                {"period_label": "week", "period_format": "%U", "keep_count": 4}
+            ],
 
-    date_suffix = datetime.today().strftime(period_format)
+            "regions": ["ap-southeast-2", "us-west-2"],
 
-    result = event
-    if ec2_tag_name and ec2_tag_value:
-        backup_mgr = EC2BackupManager(region_name=region_name,
-                                      period=period,
-                                      tag_name=ec2_tag_name,
-                                      tag_value=ec2_tag_value,
-                                      date_suffix=date_suffix,
-                                      keep_count=keep_count)
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
 
-        metrics = backup_mgr.process_backup()
+            "rds_tag_name": "Environment",
+            "rds_tag_value": "prod",
 
-        result["metrics"] = metrics
-        result["ec2_backup_result"] = backup_mgr.message
-        print('\n' + backup_mgr.message + '\n')
+            "arn": "blart",
 
-        sns_boto = None
+            "keep_count": 12,
 
-        # Connect to SNS
-        if sns_arn or error_sns_arn:
-            print('Connecting to SNS')
-            sns_boto = boto3.client('sns', region_name=region_name)
+            "workers": 8,
 
-        if error_sns_arn and backup_mgr.errmsg:
-            sns_boto.publish(TopicArn=error_sns_arn, Message='Error in processing volumes: ' + backup_mgr.errmsg,
-                             Subject='Error with AWS Snapshot')
+            "mode": "plan",
 
-        if sns_arn:
-            sns_boto.publish(TopicArn=sns_arn, Message=backup_mgr.message, Subject='Finished AWS EC2 snapshotting')
+            "checkpoint_bucket": "my-backup-checkpoints",
+            "max_continuations": 10,
 
-    if rds_tag_name and rds_tag_value:
-        backup_mgr = RDSBackupManager(region_name=region_name,
-                                      period=period,
-                                      tag_name=rds_tag_name,
-                                      tag_value=rds_tag_value,
-                                      date_suffix=date_suffix,
-                                      keep_count=keep_count)
+            "metrics_namespace": "AWSBackupLambda",
 
-        metrics = backup_mgr.process_backup()
+            "ec2_group_by_instance": true,
 
-        result["metrics"] = metrics
-        result["rds_backup_result"] = backup_mgr.message
-        print('\n' + backup_mgr.message + '\n')
+            "share_accounts": ["111111111111", "222222222222"],
 
-        sns_boto = None
+            "dr_region": "us-west-2",
+            "dr_max_copies_in_flight": 20,
 
-        # Connect to SNS
-        if sns_arn or error_sns_arn:
-            print('Connecting to SNS')
-            sns_boto = boto3.client('sns', region_name=region_name)
+            "shards": 8
+        }
+    :param event:
+    :param context:
+    :param dispatcher: runs the shards when "shards" is set, a LambdaDispatcher for the
+                       invoked function by default
+    :return:
+    """
 
-        if error_sns_arn and backup_mgr.errmsg:
-            sns_boto.publish(TopicArn=error_sns_arn, Message='Error in processing RDS: ' + backup_mgr.errmsg,
-                             Subject='Error with AWS Snapshot')
+    print("Received event: " + json.dumps(event, indent=2))
+
+    # Several schedules share one discovery and inventory pass, each resource is snapshotted
+    # for the schedules that are due
+    schedules = resolve_schedules(event)
+    primary = schedules[0]
 
-        if sns_arn:
-            sns_boto.publish(TopicArn=sns_arn, Message=backup_mgr.message, Subject='Finished AWS RDS snapshotting')
+    sns_arn = event.get('arn')
+    error_sns_arn = event.get('error_arn')
+    workers = event.get('workers', 1)
+
+    # 'plan' only reads and returns the actions it would take, 'apply' runs the actions of an earlier plan
+    mode = event.get('mode', 'backup')
+    plan_only = mode == 'plan'
+    plan_actions = load_plan(event.get('plan', [])) if mode == 'apply' else []
+    plan_services = set(action['service'] for action in plan_actions)
+
+    if event.get('schedules'):
+        continuation_event = dict(event, schedules=[dict(entry, date_suffix=schedule.date_suffix)
+                                                    for entry, schedule in zip(event['schedules'], schedules)])
+    else:
+        continuation_event = dict(event, date_suffix=primary.date_suffix)
+
+    deadline = resolve_deadline(event, context)
+    checkpoint_store = checkpoint_store_from_event(event) if mode == 'backup' else None
+    # An applied plan checks the ledger of the run like a backup does
+    ledger_store = checkpoint_store if mode != 'apply' else checkpoint_store_from_event(event)
+    copy_target = copy_target_from_event(event) if not plan_only else None
+
+    # One limiter for every region and service of this invocation, keyed by "<service>:<api class>"
+    rate_limiter = RateLimiter(rates=event.get('rate_limits'))
+
+    # Work out which services run in which regions
+    services = []
+    for service in BACKUP_MANAGERS:
+        tag_name = event.get(service + '_tag_name', event.get('tag_name'))
+        tag_value = event.get(service + '_tag_value', event.get('tag_value'))
+        if (tag_name and tag_value and mode != 'apply') or service in plan_services:
+            services.append((service, tag_name, tag_value, resolve_regions(event, service)))
+
+    all_regions = sorted(set(region for _, _, _, regions in services for region in regions))
+
+    # Every service in every region runs concurrently with its own clients, so the slow RDS
+    # snapshot calls overlap with the EC2 work
+    jobs = [(region_name, service, tag_name, tag_value)
+            for region_name in all_regions
+            for service, tag_name, tag_value, regions in services if region_name in regions]
+
+    # With "shards" this invocation only discovers the resources and runs each shard through
+    # the dispatcher, a shard event carries the resource ids it is limited to
+    shard_count = int(event.get('shards') or 1)
+    shard_resources = event.get('shard_resources')
+    if shard_count > 1 and shard_resources is None and mode != 'apply':
+        if dispatcher is None:
+            function_arn = getattr(context, 'invoked_function_arn', None)
+            dispatcher = LambdaDispatcher(function_arn) if function_arn else InProcessDispatcher()
+        summary = coordinate_shards(continuation_event, jobs, schedules, shard_count, dispatcher, deadline=deadline)
+        result = event
+        result.update(summary)
+        if sns_arn and not plan_only:
+            publish_report(sns_arn, 'Finished AWS sharded snapshotting', render_shard_report(summary))
+        if error_sns_arn and summary['metrics']['total_shard_errors']:
+            errors = [r for r in summary['shard_results'] if 'error' in r]
+            publish_report(error_sns_arn, 'Error with AWS Snapshot',
+                           render_report('Error in running %s shards:' % len(errors),
+                                         [{'resource_id': 'shard-%s' % r['shard'], 'action': 'error',
+                                           'error': r['error']} for r in errors]))
+        return json.dumps(result, indent=2)
+
+    if shard_resources is not None:
+        jobs = [job for job in jobs if shard_resources.get(job[1], {}).get(job[0])]
+
+    def run_job(job):
+        region_name, service, tag_name, tag_value = job
+        manager_class = BACKUP_MANAGERS[service]
+        options = dict((kwarg, event[key]) for key, kwarg in manager_class.event_options.items() if key in event)
+        backup_mgr = manager_class(region_name=region_name,
+                                   period=primary.period,
+                                   tag_name=tag_name,
+                                   tag_value=tag_value,
+                                   date_suffix=primary.date_suffix,
+                                   keep_count=primary.keep_count,
+                                   schedules=schedules,
+                                   ledger_store=ledger_store,
+                                   workers=workers,
+                                   plan_only=plan_only,
+                                   deadline=deadline,
+                                   checkpoint_store=checkpoint_store,
+                                   rate_limiter=rate_limiter,
+                                   copy_target=copy_target,
+                                   resource_ids=shard_resources[service][region_name] if shard_resources else None,
+                                   shard=event.get('shard'),
+                                   **options)
+
+        # One region or service failing as a whole is reported with the others, which carry on
+        try:
+            run_backup_manager(backup_mgr, plan_actions)
+        except Exception as e:
+            backup_mgr.fail_run(e)
+        print('\n' + backup_mgr.message + '\n')
+        return backup_mgr
+
+    if len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            finished = list(executor.map(run_job, jobs))
+    else:
+        finished = [run_job(job) for job in jobs]
+
+    # Back in region then service order, whichever finished first
+    region_managers = [(region_name, OrderedDict()) for region_name in all_regions]
+    by_region = dict(region_managers)
+    for (region_name, service, _, _), backup_mgr in zip(jobs, finished):
+        by_region[region_name][service] = backup_mgr
+
+    # A shard returns only its counts and messages to the coordinator, not the event it was sent
+    is_shard = event.get('shard') is not None
+    result = OrderedDict() if is_shard else event
+    result.pop('plan', None)
+    result["regions"] = OrderedDict()
+    plan = []
+    messages = OrderedDict()
+    for region_name, managers in region_managers:
+        result["regions"][region_name] = OrderedDict()
+        for service, backup_mgr in managers.items():
+            result["regions"][region_name][service] = backup_mgr.metrics
+            messages.setdefault(service, []).append(backup_mgr.message)
+            if plan_only:
+                plan.extend(backup_mgr.plan)
+
+    # Every region of a service added up, and the total of every service and region
+    result["services"] = OrderedDict(
+        (service, merge_metrics(region_metrics[service]
+                                for region_metrics in result["regions"].values() if service in region_metrics))
+        for service in BACKUP_MANAGERS if service in messages)
+    result["metrics"] = merge_metrics(result["services"].values())
+    for service, service_messages in messages.items():
+        result[service + "_backup_result"] = "\n".join(service_messages)
+
+    if (sns_arn or error_sns_arn) and not plan_only:
+        # Connect to SNS
+        print('Connecting to SNS')
+        # One report for all services and regions rather than one each
+        error_messages = combined_error_report(region_managers) if error_sns_arn else None
+        if error_messages:
+            publish_report(error_sns_arn, 'Error with AWS Snapshot', error_messages)
+
+        if sns_arn and jobs:
+            subject, report_messages = combined_report(region_managers)
+            publish_report(sns_arn, subject, report_messages)
+
+    if plan_only:
+        plan_lines = dump_plan(plan)
+        print(plan_lines)
+        if is_shard:
+            result["plan_actions"] = len(plan)
+        else:
+            result["plan"] = plan_lines
+
+    # CloudWatch Embedded Metric Format lines, set metrics_namespace to an empty string to turn them off
+    metrics_namespace = event.get('metrics_namespace', DEFAULT_NAMESPACE)
+    if metrics_namespace:
+        for region_name, managers in region_managers:
+            for service, backup_mgr in managers.items():
+                backup_mgr.instrumentation.emit(metrics_namespace, OrderedDict([('Service', service),
+                                                                                ('Region', region_name),
+                                                                                ('Mode', mode)]))
+
+    stopped_early = any(backup_mgr.stopped_early
+                        for _, managers in region_managers for backup_mgr in managers.values())
+    for _, managers in region_managers:
+        for backup_mgr in managers.values():
+            backup_mgr.result_log.close()
+
+    if stopped_early and checkpoint_store is not None and getattr(context, 'invoked_function_arn', None) \
+            and event.get('continuation', 0) < event.get('max_continuations', 10):
+        continue_in_new_invocation(continuation_event, context)
+        result["continued"] = True
 
     return json.dumps(result, indent=2)
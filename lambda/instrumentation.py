@@ -0,0 +1,190 @@
+from __future__ import print_function
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ratelimit import THROTTLE_ERROR_CODES
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is open ended
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+PHASES = ('discovery', 'list', 'create', 'delete', 'share', 'copy')
+
+DEFAULT_NAMESPACE = 'AWSBackupLambda'
+
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, latency_ms, retries, error_code):
+        self.calls += 1
+        self.retries += retries
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+        if error_code:
+            self.errors += 1
+            if error_code in THROTTLE_ERROR_CODES:
+                self.throttles += 1
+
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def histogram_dict(self):
+        labels = ['le_%d' % bound for bound in LATENCY_BUCKETS_MS] + ['gt_%d' % LATENCY_BUCKETS_MS[-1]]
+        return OrderedDict(zip(labels, self.histogram))
+
+
+class Instrumentation(object):
+    """
+    Per API operation call counts, latency histograms, retries and throttles taken from
+    the botocore events of the watched clients, and the time spent in each phase of a run.
+
+    Phase times are summed over the worker threads, so with workers > 1 they can add up
+    to more than the wall time of the run.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.operations = OrderedDict()
+        self.phases = OrderedDict((phase, [0, 0.0]) for phase in PHASES)
+
+    def watch(self, client):
+        client.meta.events.register('before-call', self.before_call)
+        client.meta.events.register('after-call', self.after_call)
+
+    def unwatch(self, client):
+        client.meta.events.unregister('before-call', self.before_call)
+        client.meta.events.unregister('after-call', self.after_call)
+
+    def before_call(self, context, **kwargs):
+        # A client watched by several instrumentations records each call once, with the one
+        # the call is tagged with or else the first to see it
+        if context.setdefault('instrumentation', self) is not self:
+            return
+        context['instrumentation_started'] = self.clock()
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        started = context.get('instrumentation_started')
+        if started is None or context.get('instrumentation') is not self:
+            return
+        latency_ms = (self.clock() - started) * 1000.0
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        error_code = parsed.get('Error', {}).get('Code') if http_response.status_code >= 300 else None
+        self.record_call(model.name, latency_ms, retries, error_code)
+
+    def record_call(self, operation, latency_ms, retries=0, error_code=None):
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.record(latency_ms, retries, error_code)
+
+    def record_phase(self, phase, seconds):
+        with self.lock:
+            entry = self.phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    @contextmanager
+    def phase(self, phase):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, self.clock() - started)
+
+    def timed(self, phase, iterable):
+        """
+        Wrap a generator so the time spent producing each item counts towards the phase,
+        and the time the consumer spends on it does not.
+        """
+        iterator = iter(iterable)
+        while True:
+            started = self.clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record_phase(phase, self.clock() - started)
+                return
+            self.record_phase(phase, self.clock() - started)
+            yield item
+
+    def emf_records(self, namespace, dimensions):
+        """
+        CloudWatch Embedded Metric Format records, one per API operation and one per phase.
+
+        :param dimensions: OrderedDict of dimension names and values shared by every record,
+                           for example service and region
+        """
+        timestamp = int(self.clock() * 1000)
+        dimension_names = list(dimensions)
+        records = []
+
+        with self.lock:
+            for operation, stats in self.operations.items():
+                record = OrderedDict(dimensions)
+                record['_aws'] = {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [dimension_names + ['Operation']],
+                        'Metrics': [
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'Retries', 'Unit': 'Count'},
+                            {'Name': 'Throttles', 'Unit': 'Count'},
+                            {'Name': 'LatencyAverage', 'Unit': 'Milliseconds'},
+                            {'Name': 'LatencyMax', 'Unit': 'Milliseconds'},
+                        ],
+                    }],
+                }
+                record['Operation'] = operation
+                record['Calls'] = stats.calls
+                record['Errors'] = stats.errors
+                record['Retries'] = stats.retries
+                record['Throttles'] = stats.throttles
+                record['LatencyAverage'] = round(stats.total_ms / stats.calls, 3)
+                record['LatencyMax'] = round(stats.max_ms, 3)
+                # Not a metric, but searchable with Logs Insights
+                record['LatencyHistogram'] = stats.histogram_dict()
+                records.append(record)
+
+            for phase, (count, seconds) in self.phases.items():
+                record = OrderedDict(dimensions)
+                record['_aws'] = {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [dimension_names + ['Phase']],
+                        'Metrics': [
+                            {'Name': 'PhaseDuration', 'Unit': 'Seconds'},
+                            {'Name': 'PhaseCount', 'Unit': 'Count'},
+                        ],
+                    }],
+                }
+                record['Phase'] = phase
+                record['PhaseDuration'] = round(seconds, 6)
+                record['PhaseCount'] = count
+                records.append(record)
+
+        return records
+
+    def emit(self, namespace, dimensions):
+        # Lambda ships stdout to CloudWatch Logs, which extracts the metrics from these lines
+        for record in self.emf_records(namespace, dimensions):
+            print(json.dumps(record))
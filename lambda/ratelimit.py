@@ -0,0 +1,178 @@
+from __future__ import print_function
+
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Error codes that mean "slow down" rather than "this failed"
+THROTTLE_ERROR_CODES = frozenset([
+    'RequestLimitExceeded',
+    'SnapshotCreationPerVolumeRateExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestThrottled',
+])
+
+# Mutating API calls share a bucket per class of call
+API_CLASSES = {
+    'create_snapshot': 'create',
+    'create_snapshots': 'create',
+    'create_db_snapshot': 'create',
+    'create_db_cluster_snapshot': 'create',
+    'copy_snapshot': 'copy',
+    'copy_db_snapshot': 'copy',
+    'copy_db_cluster_snapshot': 'copy',
+    'create_tags': 'tag',
+    'add_tags_to_resource': 'tag',
+    'delete_snapshot': 'delete',
+    'delete_db_snapshot': 'delete',
+    'delete_db_cluster_snapshot': 'delete',
+    'modify_snapshot_attribute': 'modify',
+    'modify_db_snapshot_attribute': 'modify',
+    'modify_db_cluster_snapshot_attribute': 'modify',
+}
+
+# Calls per second for each "<service>:<api class>", the EC2 numbers follow the
+# refill rates of the EC2 mutating and resource intensive request buckets
+DEFAULT_RATES = {
+    'ec2:create': 5,
+    'ec2:copy': 5,
+    'ec2:tag': 10,
+    'ec2:delete': 5,
+    'ec2:modify': 5,
+    'rds:create': 2,
+    'rds:copy': 2,
+    'rds:delete': 2,
+    'rds:modify': 2,
+}
+DEFAULT_RATE = 5
+
+
+def is_throttle(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket. The rate backs off when the service throttles and
+    creeps back up to the configured rate while calls succeed.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.1, clock=time.time, sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token even when there is none yet, and wait for it outside the lock
+            self.tokens -= 1
+            wait_for = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait_for > 0:
+            self.sleep(wait_for)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def on_success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter(object):
+    """
+    Rate limits mutating calls per service, region and API class, and retries throttled
+    calls with exponential backoff and full jitter until the retry budget of that API runs out.
+
+    :param rates: calls per second by "<service>:<api class>", see DEFAULT_RATES
+    :param max_attempts: attempts per call, including the first one
+    :param retry_budget: throttled retries allowed per API and region for the life of the limiter
+    """
+
+    def __init__(self, rates=None, max_attempts=8, base_delay=0.5, max_delay=20.0, retry_budget=200,
+                 clock=time.time, sleep=time.sleep, jitter=random.random):
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        self.clock = clock
+        self.sleep = sleep
+        self.jitter = jitter
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.retries_left = {}
+        self.throttles = {}
+
+    def bucket_for(self, service, region_name, api_class):
+        key = (service, region_name, api_class)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                rate = self.rates.get('%s:%s' % (service, api_class), DEFAULT_RATE)
+                bucket = TokenBucket(rate, clock=self.clock, sleep=self.sleep)
+                self.buckets[key] = bucket
+            return bucket
+
+    def count_throttle(self, service, region_name, operation):
+        key = (service, region_name, operation)
+        with self.lock:
+            self.throttles[key] = self.throttles.get(key, 0) + 1
+
+    def take_retry(self, service, region_name, operation):
+        key = (service, region_name, operation)
+        with self.lock:
+            left = self.retries_left.get(key, self.retry_budget)
+            if left <= 0:
+                return False
+            self.retries_left[key] = left - 1
+            return True
+
+    def throttle_count(self, service=None, region_name=None):
+        with self.lock:
+            return sum(count for (s, r, _), count in self.throttles.items()
+                       if (service is None or s == service) and (region_name is None or r == region_name))
+
+    def call(self, service, region_name, operation, func, **kwargs):
+        bucket = self.bucket_for(service, region_name, API_CLASSES.get(operation, operation))
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = func(**kwargs)
+            except ClientError as e:
+                if not is_throttle(e):
+                    raise
+                bucket.on_throttle()
+                self.count_throttle(service, region_name, operation)
+                attempt += 1
+                if attempt >= self.max_attempts or not self.take_retry(service, region_name, operation):
+                    raise
+                delay = self.jitter() * min(self.max_delay, self.base_delay * 2 ** attempt)
+                print('Throttled on %(operation)s, retrying in %(delay).1fs' % {
+                    'operation': operation,
+                    'delay': delay
+                })
+                self.sleep(delay)
+            else:
+                bucket.on_success()
+                return response
@@ -0,0 +1,124 @@
+from __future__ import print_function
+
+import time
+from operator import itemgetter
+
+SECONDS_PER_DAY = 86400
+
+
+def day_bucket(epoch):
+    return epoch // SECONDS_PER_DAY
+
+
+def week_bucket(epoch):
+    # 1970-01-01 was a Thursday, shift by 3 days so weeks start on a Monday
+    return (epoch // SECONDS_PER_DAY + 3) // 7
+
+
+def month_bucket(epoch):
+    t = time.gmtime(epoch)
+    return t.tm_year * 12 + t.tm_mon
+
+
+def year_bucket(epoch):
+    return time.gmtime(epoch).tm_year
+
+
+BUCKETS = {
+    'day': day_bucket,
+    'week': week_bucket,
+    'month': month_bucket,
+    'year': year_bucket,
+}
+
+
+class RetentionTier(object):
+    """
+    One level of a retention policy.
+
+    :param keep: number of snapshots (or buckets) to keep per resource
+    :param bucket: None to keep the newest `keep` snapshots, otherwise one of BUCKETS
+                   (or a callable taking an epoch) to keep the newest snapshot of each
+                   of the newest `keep` buckets
+    :param label: only snapshots carrying this label are managed by the tier
+    """
+
+    def __init__(self, keep, bucket=None, label=None):
+        self.keep = int(keep)
+        self.label = label
+        if bucket is None or callable(bucket):
+            self.bucket = bucket
+        else:
+            self.bucket = BUCKETS[bucket]
+
+
+class RetentionPolicy(object):
+    def __init__(self, tiers):
+        self.tiers = list(tiers)
+
+    @classmethod
+    def grandfather_father_son(cls, keep_counts, label=None):
+        """
+        Build a calendar based policy, for example {"day": 7, "week": 4, "month": 12}
+        """
+        return cls([RetentionTier(keep, bucket=name, label=label) for name, keep in keep_counts.items()])
+
+    @classmethod
+    def rotation(cls, keep_counts):
+        """
+        Build a label based policy, keeping the newest N snapshots of each label,
+        for example {"day": 14, "week": 12}
+        """
+        return cls([RetentionTier(keep, label=label) for label, keep in keep_counts.items()])
+
+
+def plan_retention(records, policy):
+    """
+    Work out which snapshots to keep and delete for every resource in one pass.
+
+    :param records: iterable of (resource_id, snapshot_id, created_epoch, labels) tuples,
+                    labels is a collection of labels or None
+    :param policy: RetentionPolicy
+    :return: (keep, delete) lists of snapshot ids, newest first per resource. Snapshots
+             that no tier manages appear in neither list.
+    """
+    tiers = policy.tiers
+    tier_count = len(tiers)
+
+    records = sorted(records, key=itemgetter(0, 2), reverse=True)
+
+    keep = []
+    delete = []
+
+    no_bucket = object()
+    current_resource = no_bucket
+    last_bucket = kept = None
+
+    for resource_id, snapshot_id, created, labels in records:
+        if resource_id != current_resource:
+            current_resource = resource_id
+            last_bucket = [no_bucket] * tier_count
+            kept = [0] * tier_count
+
+        managed = False
+        retained = False
+        for i in range(tier_count):
+            tier = tiers[i]
+            if tier.label is not None and (not labels or tier.label not in labels):
+                continue
+            managed = True
+            if kept[i] >= tier.keep:
+                continue
+
+            bucket = snapshot_id if tier.bucket is None else tier.bucket(created)
+            if bucket != last_bucket[i]:
+                last_bucket[i] = bucket
+                kept[i] += 1
+                retained = True
+
+        if retained:
+            keep.append(snapshot_id)
+        elif managed:
+            delete.append(snapshot_id)
+
+    return keep, delete
@@ -0,0 +1,45 @@
+from __future__ import print_function
+
+import bisect
+import hashlib
+
+# Points each shard gets on the ring, more points spread the resources more evenly
+DEFAULT_VIRTUAL_NODES = 100
+
+
+def hash_key(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of resource ids onto a fixed number of shards.
+
+    A resource stays on the same shard from one run to the next, and going from N to
+    N + 1 shards only moves about 1 / (N + 1) of the resources.
+    """
+
+    def __init__(self, shard_count, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        if shard_count < 1:
+            raise ValueError('A ring needs at least one shard')
+        self.shard_count = shard_count
+
+        points = sorted((hash_key('shard-%s-%s' % (shard, node)), shard)
+                        for shard in range(shard_count)
+                        for node in range(virtual_nodes))
+        self.points = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        # The first point clockwise from the key, wrapping around the end of the ring
+        i = bisect.bisect(self.points, hash_key(key)) % len(self.points)
+        return self.shards[i]
+
+    def split(self, keys):
+        """
+        :return: one list of keys per shard, in the order the keys came in
+        """
+        shards = [[] for _ in range(self.shard_count)]
+        for key in keys:
+            shards[self.shard_for(key)].append(key)
+        return shards
@@ -1,18 +1,28 @@
 import boto3
 import json
+import os
+import re
+import shutil
+import tempfile
+import threading
 import unittest
+import unittest.mock
 from backuplambda import *
-from moto import mock_ec2, mock_sns
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_ec2, mock_rds, mock_sns, mock_sts
+from instrumentation import Instrumentation
+from ratelimit import RateLimiter
+from sharding import HashRing
 
 
 def add_volume(tag_name, tag_value, region_name):
     ec2_boto = boto3.client('ec2', region_name=region_name)
 
-    ec2_boto.create_volume(Size=200, AvailabilityZone=region_name + "a")
+    volume = ec2_boto.create_volume(Size=200, AvailabilityZone=region_name + "a")
 
-    vols = ec2_boto.describe_volumes()
-
-    resource_id = vols["Volumes"][0]["VolumeId"]
+    resource_id = volume["VolumeId"]
     ec2_boto.create_tags(Resources=[resource_id],
                          Tags=[{"Key": tag_name, "Value": tag_value}])
 
@@ -23,27 +33,1261 @@ def add_volume_snapshot(resource_id, description, region_name):
     ec2_boto = boto3.client('ec2', region_name=region_name)
     current_snap = ec2_boto.create_snapshot(VolumeId=resource_id,
                                             Description=description)
+    return current_snap
+
+
+def add_db_instance(identifier, tag_name, tag_value, region_name):
+    rds_boto = boto3.client('rds', region_name=region_name)
+    rds_boto.create_db_instance(DBInstanceIdentifier=identifier,
+                                DBInstanceClass='db.t2.micro',
+                                Engine='postgres',
+                                MasterUsername='admin',
+                                MasterUserPassword='password1',
+                                AllocatedStorage=10,
+                                Tags=[{"Key": tag_name, "Value": tag_value}])
+
+
+def add_db_cluster(identifier, tag_name, tag_value, region_name):
+    rds_boto = boto3.client('rds', region_name=region_name)
+    rds_boto.create_db_cluster(DBClusterIdentifier=identifier,
+                               Engine='aurora-postgresql',
+                               MasterUsername='admin',
+                               MasterUserPassword='password1',
+                               Tags=[{"Key": tag_name, "Value": tag_value}])
 
 
 class EC2BackupManagerTest(unittest.TestCase):
+    def setUp(self):
+        # Clients are cached across invocations, start every test from a cold container
+        clear_cache()
+
     @mock_ec2
     def test_resolve_resource_bytag(self):
         add_volume("Snapshot", "True", "ap-southeast-1")
         add_volume("Name", "Anotherone", "ap-southeast-1")
 
-        mgr = EC2BackupManager(ec2_region_name="ap-southeast-1",
+        mgr = EC2BackupManager(region_name="ap-southeast-1",
                                period="day",
                                tag_name="Snapshot",
                                tag_value="True",
                                date_suffix="dd",
                                keep_count="2")
 
-        volumes = mgr.get_backable_resources()
+        volumes = list(mgr.get_backable_resources())
 
         assert len(volumes) == 1
 
+    @mock_ec2
+    def test_discovery_streams_pages(self):
+        region_name = "ap-southeast-1"
+        for _ in range(5):
+            add_volume("Snapshot", "True", region_name)
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        listings = []
+        mgr.conn.meta.events.register('before-call.ec2.DescribeVolumes',
+                                      lambda **kwargs: listings.append(kwargs))
+
+        volumes = mgr.get_backable_resources()
+        self.assertEqual(listings, [])
+
+        next(volumes)
+        self.assertEqual(len(listings), 1)
+        self.assertEqual(len(list(volumes)), 4)
+
+    @mock_ec2
+    def test_tagging_discovery(self):
+        region_name = "ap-southeast-1"
+        volumes = [add_volume("Snapshot", "True", region_name) for _ in range(3)]
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               discovery="tagging")
+        mgr._tagging_conn = FakeTaggingApi(region_name, [
+            {'ResourceARN': 'arn:aws:ec2:%s:123456789012:volume/%s' % (region_name, volume_id),
+             'Tags': [{'Key': 'Snapshot', 'Value': 'True'}]} for volume_id in volumes])
+
+        listings = []
+        mgr.conn.meta.events.register('before-call.ec2.DescribeVolumes',
+                                      lambda **kwargs: listings.append(kwargs))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(listings, [])
+        self.assertEqual(mgr._tagging_conn.calls[0]['ResourceTypeFilters'], ['ec2:volume'])
+        self.assertEqual(metrics["total_creates"], 3)
+        self.assertEqual(metrics["total_errors"], 0)
+
+    @mock_ec2
+    def test_tagging_discovery_fallback(self):
+        region_name = "ap-southeast-1"
+        add_volume("Snapshot", "True", region_name)
+        add_volume("Name", "Anotherone", region_name)
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               discovery="tagging")
+        error = ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'denied'}}, 'GetResources')
+        mgr._tagging_conn = FakeTaggingApi(region_name, [], error=error)
+
+        self.assertEqual(len(list(mgr.get_backable_resources())), 1)
+
+    @mock_ec2
+    def test_snapshot_inventory_single_listing(self):
+        region_name = "ap-southeast-1"
+        volumes = [add_volume("Snapshot", "True", region_name) for _ in range(3)]
+        for volume in volumes:
+            add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+            add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        listings = []
+        mgr.conn.meta.events.register('before-call.ec2.DescribeSnapshots',
+                                      lambda **kwargs: listings.append(kwargs))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(len(listings), 1)
+        self.assertEqual(metrics["total_resources"], 3)
+        self.assertEqual(metrics["total_creates"], 3)
+        self.assertEqual(metrics["total_deletes"], 3)
+        self.assertEqual(metrics["total_api_calls"], mgr.api_calls)
+        # Actions are only kept by a plan
+        self.assertEqual(mgr.plan, [])
+
+    @mock_ec2
+    def test_concurrent_backup_ordered_by_id(self):
+        region_name = "ap-southeast-1"
+        volumes = [add_volume("Snapshot", "True", region_name) for _ in range(6)]
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               workers=4)
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_resources"], 6)
+        self.assertEqual(metrics["total_creates"], 6)
+        self.assertEqual(metrics["total_errors"], 0)
+
+        creates = [record['resource_id'] for record in mgr.report_records() if record['action'] == 'create']
+        self.assertEqual(creates, sorted(volumes))
+
+    @mock_ec2
+    def test_resume_from_checkpoint(self):
+        region_name = "ap-southeast-1"
+        for _ in range(3):
+            add_volume("Snapshot", "True", region_name)
+
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir)
+        store = LocalFileCheckpointStore(checkpoint_dir)
+
+        def new_manager():
+            return EC2BackupManager(region_name=region_name,
+                                    period="day",
+                                    tag_name="Snapshot",
+                                    tag_value="True",
+                                    date_suffix="dd",
+                                    keep_count=2,
+                                    checkpoint_store=store)
+
+        # Run out of time after the first resource
+        mgr = new_manager()
+        checks = []
+        mgr.out_of_time = lambda: checks.append(1) or len(checks) > 1
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 1)
+        self.assertEqual(metrics["total_stopped_early"], 1)
+        self.assertEqual(len(store.load(mgr.checkpoint_key())["completed"]), 1)
+
+        mgr = new_manager()
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 2)
+        self.assertEqual(metrics["total_skipped"], 1)
+        self.assertEqual(metrics["total_stopped_early"], 0)
+        self.assertIsNone(store.load(mgr.checkpoint_key()))
+
+    @mock_ec2
+    def test_retry_skips_snapshotted_resources(self):
+        region_name = "ap-southeast-1"
+        for _ in range(3):
+            add_volume("Snapshot", "True", region_name)
+
+        def new_manager(date_suffix, ledger_store=None):
+            return EC2BackupManager(region_name=region_name,
+                                    period="day",
+                                    tag_name="Snapshot",
+                                    tag_value="True",
+                                    date_suffix=date_suffix,
+                                    keep_count=2,
+                                    ledger_store=ledger_store)
+
+        self.assertEqual(new_manager("Mon").process_backup()["total_creates"], 3)
+
+        # A retry with the same date suffix finds the snapshots in the inventory
+        metrics = new_manager("Mon").process_backup()
+        self.assertEqual(metrics["total_creates"], 0)
+        self.assertEqual(metrics["total_deletes"], 0)
+        self.assertEqual(metrics["total_errors"], 0)
+
+        self.assertEqual(new_manager("Tue").process_backup()["total_creates"], 3)
+
+        # The store covers snapshots the listing doesn't show yet
+        ledger_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ledger_dir)
+        store = LocalFileCheckpointStore(ledger_dir)
+        mgr = new_manager("Wed", ledger_store=store)
+        volume_id = sorted(mgr.resolve_backupable_id(volume) for volume in mgr.get_backable_resources())[0]
+        store.save(mgr.ledger_key(), {"entries": [["day", "Wed", volume_id], ["day", "Tue", "vol-old"]]})
+
+        self.assertEqual(mgr.process_backup()["total_creates"], 2)
+        entries = store.load(mgr.ledger_key())["entries"]
+        self.assertEqual(len(entries), 3)
+        self.assertNotIn(["day", "Tue", "vol-old"], entries)
+
+        # A weekly event keeps a ledger of its own in the same store
+        weekly = EC2BackupManager(region_name=region_name,
+                                  period="week",
+                                  tag_name="Snapshot",
+                                  tag_value="True",
+                                  date_suffix="week-01",
+                                  keep_count=2,
+                                  ledger_store=store)
+        self.assertNotEqual(weekly.ledger_key(), mgr.ledger_key())
+        weekly.process_backup()
+        self.assertEqual(store.load(mgr.ledger_key())["entries"], entries)
+        self.assertEqual(len(store.load(weekly.ledger_key())["entries"]), 3)
+
+    def test_template_date_suffixes_stable_within_day(self):
+        # A retried scheduled event runs minutes to hours later and has to work out the same date suffix
+        template = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloudformation.yaml')
+        with open(template) as f:
+            schedules = re.findall(r'"period_label": "(\w+)", "period_format": "([^"]+)"', f.read())
+        self.assertEqual([label for label, _ in schedules], ["day", "week"])
+
+        class FrozenDatetime(datetime):
+            frozen = None
+
+            @classmethod
+            def today(cls):
+                return cls.frozen
+
+        for label, period_format in schedules:
+            suffixes = set()
+            for hour, minute in ((0, 5), (0, 20), (13, 0), (23, 55)):
+                FrozenDatetime.frozen = datetime(2021, 1, 6, hour, minute)
+                with unittest.mock.patch('backuplambda.datetime', FrozenDatetime):
+                    event = {"period_label": label, "period_format": period_format, "keep_count": 2}
+                    suffixes.add(resolve_schedules(event)[0].date_suffix)
+            self.assertEqual(len(suffixes), 1, period_format)
+
+    def test_period_start(self):
+        # 6 January 2021 is a Wednesday in week 01
+        wednesday = datetime(2021, 1, 6, 13, 0)
+        self.assertEqual(period_start("%a", "Wed", wednesday), datetime(2021, 1, 6))
+        self.assertEqual(period_start("%a%H", "Wed13", wednesday), datetime(2021, 1, 6, 13))
+        self.assertEqual(period_start("week-%U", "week-01", wednesday), datetime(2021, 1, 3))
+        # A continuation after midnight carries the suffix of the day before
+        self.assertEqual(period_start("%a", "Wed", datetime(2021, 1, 7, 0, 5)), datetime(2021, 1, 6))
+        self.assertIsNone(period_start("%a", "dd", wednesday))
+        self.assertIsNone(period_start("daily", "daily", wednesday))
+
+    def test_same_suffix_of_earlier_window_due(self):
+        now = datetime.today()
+        date_suffix = now.strftime("%a")
+        mgr = EC2BackupManager(region_name="ap-southeast-1",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix=date_suffix,
+                               keep_count=2,
+                               schedules=[Schedule("day", date_suffix, 2,
+                                                   started=period_start("%a", date_suffix, now))])
+
+        def snapshot(age):
+            return {"SnapshotId": "snap-%s" % age.days, "VolumeId": "vol-a", "State": "completed",
+                    "StartTime": datetime.now(timezone.utc) - age,
+                    "Tags": [{"Key": PERIOD_TAG_PREFIX + "day", "Value": date_suffix}]}
+
+        self.assertEqual(mgr.due_schedules("vol-a", [snapshot(timedelta())]), [])
+        # The same weekday a week ago
+        self.assertEqual(len(mgr.due_schedules("vol-a", [snapshot(timedelta(days=7))])), 1)
+
+    def test_rds_snapshot_id_dated_by_period(self):
+        mgr = RDSBackupManager(region_name="ap-southeast-2",
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="Wed",
+                               keep_count=2,
+                               schedules=[Schedule("day", "Wed", 2, started=datetime(2021, 1, 6))])
+
+        self.assertEqual(mgr.build_snapshot_id({"DBInstanceIdentifier": "db-a"}, mgr.period_tags(mgr.schedules)),
+                         "day-db-a-06-01-2021-Wed")
+
+    @mock_ec2
+    def test_snapshot_tags_applied_on_create(self):
+        region_name = "ap-southeast-1"
+        volume = add_volume("Snapshot", "True", region_name)
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        ec2_boto.create_tags(Resources=[volume],
+                             Tags=[{"Key": "Name", "Value": "data"}, {"Key": "Team", "Value": "ops"}])
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        tag_calls = []
+        mgr.conn.meta.events.register('before-call.ec2.CreateTags', lambda **kwargs: tag_calls.append(kwargs))
+        mgr.conn.meta.events.register('before-call.ec2.DescribeTags', lambda **kwargs: tag_calls.append(kwargs))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(tag_calls, [])
+        # The describe_tags call and one create_tags per volume tag, the period tag saves nothing
+        self.assertEqual(metrics["total_api_calls_saved"], 4)
+
+        snapshot = ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": [volume]}])["Snapshots"][0]
+        self.assertEqual(dict((t['Key'], t['Value']) for t in snapshot['Tags']),
+                         {"Snapshot": "True", "Name": "data", "Team": "ops", "BackupPeriod:day": "dd"})
+
+    @mock_ec2
+    def test_snapshot_tags_kept_within_limit(self):
+        region_name = "ap-southeast-1"
+        volume = add_volume("Snapshot", "True", region_name)
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        ec2_boto.create_tags(Resources=[volume],
+                             Tags=[{"Key": "Tag%02d" % i, "Value": "x"} for i in range(49)])
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        mgr.process_backup()
+
+        snapshot = ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": [volume]}])["Snapshots"][0]
+        tags = dict((t['Key'], t['Value']) for t in snapshot['Tags'])
+        self.assertEqual(len(tags), MAX_SNAPSHOT_TAGS)
+        self.assertEqual(tags["BackupPeriod:day"], "dd")
+
+    @mock_ec2
+    def test_inventory_filtered_by_period(self):
+        region_name = "ap-southeast-1"
+        volume = add_volume("Snapshot", "True", region_name)
+        legacy = add_volume_snapshot(volume, description="day_snapshot legacy", region_name=region_name)
+        for i in range(3):
+            add_volume_snapshot(volume, description="week_snapshot %d" % i, region_name=region_name)
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        mgr.process_backup()
+
+        snapshots = mgr.list_snapshots_for_resource({"VolumeId": volume})
+        self.assertEqual(len(snapshots), 2)
+        self.assertIn(legacy['SnapshotId'], [mgr.resolve_snapshot_id(snap) for snap in snapshots])
+        self.assertEqual([mgr.snapshot_periods(snap) for snap in snapshots], [set(["day"])] * 2)
+
+
+    def test_snapshot_record(self):
+        mgr = EC2BackupManager(region_name="ap-southeast-1",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        started = datetime(2030, 1, 1, tzinfo=timezone.utc)
+        tagged = mgr.snapshot_record({'SnapshotId': 'snap-1', 'VolumeId': 'vol-1', 'Description': 'day_snapshot 1',
+                                      'StartTime': started, 'State': 'completed', 'VolumeSize': 100,
+                                      'Tags': [{'Key': 'BackupPeriod:day', 'Value': 'Mon'},
+                                               {'Key': 'Name', 'Value': 'data'}]})
+        legacy = mgr.snapshot_record({'SnapshotId': 'snap-2', 'VolumeId': 'vol-1', 'Description': 'day_snapshot 2',
+                                      'StartTime': started, 'State': 'pending'})
+
+        self.assertEqual((tagged.snapshot_id, tagged.resource_id, tagged.periods, tagged.created, tagged.state),
+                         ('snap-1', 'vol-1', (('day', 'Mon'),), int(started.timestamp()), 'completed'))
+        self.assertEqual(legacy.periods, (('day', ''),))
+        self.assertEqual(mgr.snapshot_periods(legacy), set(['day']))
+        self.assertEqual(mgr.resolve_snapshot_epoch(legacy), int(started.timestamp()))
+        self.assertFalse(hasattr(tagged, '__dict__'))
+
+    @mock_ec2
+    def test_volumes_grouped_by_instance(self):
+        region_name = "ap-southeast-1"
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        instance_id = ec2_boto.run_instances(ImageId='ami-12c6146b', MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+        attached = []
+        for device in ('/dev/sdf', '/dev/sdg'):
+            volume = add_volume("Snapshot", "True", region_name)
+            ec2_boto.attach_volume(VolumeId=volume, InstanceId=instance_id, Device=device)
+            attached.append(volume)
+        detached = add_volume("Snapshot", "True", region_name)
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               workers=3,
+                               group_by_instance=True)
+
+        calls = []
+        for operation in ('CreateSnapshots', 'CreateSnapshot'):
+            mgr.mutating_conn.meta.events.register('before-parameter-build.ec2.' + operation,
+                                                   lambda **kwargs: calls.append(kwargs))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 3)
+        self.assertEqual(metrics["total_errors"], 0)
+        self.assertEqual(sorted(call['model'].name for call in calls), ['CreateSnapshot', 'CreateSnapshots'])
+        # The untagged root volume is left out
+        self.assertEqual(calls[[call['model'].name for call in calls].index('CreateSnapshots')]['params']
+                         ['InstanceSpecification']['ExcludeBootVolume'], True)
+        for volume in attached + [detached]:
+            self.assertEqual(len(mgr.list_snapshots_for_resource({"VolumeId": volume})), 1)
+
+
+    @mock_ec2
+    def test_grouped_snapshot_leaves_out_volumes_not_due(self):
+        region_name = "ap-southeast-1"
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        instance_id = ec2_boto.run_instances(ImageId='ami-12c6146b', MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+
+        def attach_volume(device):
+            volume = add_volume("Snapshot", "True", region_name)
+            ec2_boto.attach_volume(VolumeId=volume, InstanceId=instance_id, Device=device)
+            return volume
+
+        def new_manager():
+            return EC2BackupManager(region_name=region_name,
+                                    period="day",
+                                    tag_name="Snapshot",
+                                    tag_value="True",
+                                    date_suffix="Mon",
+                                    keep_count=2,
+                                    workers=3,
+                                    group_by_instance=True)
+
+        done = [attach_volume('/dev/sdf'), attach_volume('/dev/sdg')]
+        self.assertEqual(new_manager().process_backup()["total_creates"], 2)
+
+        # A volume attached later is the only one due for the same date suffix
+        added = attach_volume('/dev/sdh')
+        mgr = new_manager()
+        calls = []
+        mgr.mutating_conn.meta.events.register('before-parameter-build.ec2.CreateSnapshots',
+                                               lambda **kwargs: calls.append(kwargs['params']))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 1)
+        self.assertEqual(metrics["total_errors"], 0)
+        # moto snapshots every volume of the instance, so check the call rather than the snapshots
+        self.assertEqual(sorted(calls[0]['InstanceSpecification']['ExcludeDataVolumeIds']), sorted(done))
+        self.assertEqual(len(mgr.list_snapshots_for_resource({"VolumeId": added})), 1)
+
+    @mock_ec2
+    def test_snapshots_shared_after_create(self):
+        region_name = "ap-southeast-1"
+        volumes = [add_volume("Snapshot", "True", region_name) for _ in range(3)]
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               share_accounts="111111111111, 222222222222")
+
+        share_snapshot = mgr.share_snapshot
+
+        def share_all_but_last(snapshot, accounts):
+            if snapshot['VolumeId'] == volumes[-1]:
+                raise ClientError({'Error': {'Code': 'InvalidSnapshot.InUse'}}, 'ModifySnapshotAttribute')
+            share_snapshot(snapshot, accounts)
+
+        mgr.share_snapshot = share_all_but_last
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 3)
+        self.assertEqual(metrics["total_errors"], 0)
+        self.assertEqual(metrics["total_shared"], 2)
+        self.assertEqual(metrics["total_share_errors"], 1)
+
+        snapshot = mgr.list_snapshots_for_resource({"VolumeId": volumes[0]})[0]
+        permissions = mgr.conn.describe_snapshot_attribute(SnapshotId=mgr.resolve_snapshot_id(snapshot),
+                                                           Attribute='createVolumePermission')
+        self.assertEqual(sorted(p['UserId'] for p in permissions['CreateVolumePermissions']),
+                         ["111111111111", "222222222222"])
+
+        failed = [record for record in mgr.report_records() if record['action'] == 'share_failed']
+        self.assertEqual([record['resource_id'] for record in failed], [volumes[-1]])
+
+        # The next run shares its new snapshots and the kept one the first run could not share
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="ee",
+                               keep_count=2,
+                               share_accounts="222222222222,111111111111")
+        shared = []
+        share_snapshot = mgr.share_snapshot
+        mgr.share_snapshot = lambda snapshot, accounts: shared.append(mgr.resolve_snapshot_id(snapshot)) or \
+            share_snapshot(snapshot, accounts)
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_shared"], 4)
+        self.assertEqual(metrics["total_share_errors"], 0)
+        self.assertIn(failed[0]['snapshot_id'], shared)
+
+
+class RDSBackupManagerTest(unittest.TestCase):
+    def setUp(self):
+        # Clients are cached across invocations, start every test from a cold container
+        clear_cache()
+
+    @mock_rds
+    def test_discovery_uses_inline_tags(self):
+        region_name = "ap-southeast-2"
+        add_db_instance("db-tagged", "MakeSnapshot", "True", region_name)
+        add_db_instance("db-other", "Name", "Anotherone", region_name)
+        add_db_cluster("cluster-tagged", "MakeSnapshot", "True", region_name)
+
+        mgr = RDSBackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        tag_lookups = []
+        mgr.conn.meta.events.register('before-call.rds.ListTagsForResource',
+                                      lambda **kwargs: tag_lookups.append(kwargs))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(tag_lookups, [])
+        self.assertEqual(metrics["total_resources"], 2)
+        self.assertEqual(metrics["total_creates"], 2)
+        self.assertEqual(metrics["total_errors"], 0)
+
+
+    @mock_rds
+    def test_tagging_discovery(self):
+        region_name = "ap-southeast-2"
+        add_db_instance("db-tagged", "MakeSnapshot", "True", region_name)
+        add_db_cluster("cluster-tagged", "MakeSnapshot", "True", region_name)
+        rds_boto = boto3.client('rds', region_name=region_name)
+        rds_boto.create_db_instance(DBInstanceIdentifier="cluster-tagged-1",
+                                    DBInstanceClass='db.r5.large',
+                                    Engine='aurora-postgresql',
+                                    DBClusterIdentifier="cluster-tagged",
+                                    Tags=[{"Key": "MakeSnapshot", "Value": "True"}])
+
+        mgr = RDSBackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               discovery="tagging")
+        mgr._tagging_conn = FakeTaggingApi(region_name, [
+            {'ResourceARN': 'arn:aws:rds:%s:123456789012:%s' % (region_name, name),
+             'Tags': [{'Key': 'MakeSnapshot', 'Value': 'True'}]}
+            for name in ('db:db-tagged', 'cluster:cluster-tagged', 'db:cluster-tagged-1')])
+
+        listings = []
+        for operation in ('DescribeDBClusters', 'ListTagsForResource'):
+            mgr.conn.meta.events.register('before-call.rds.%s' % operation,
+                                          lambda **kwargs: listings.append(kwargs))
+
+        resources = list(mgr.get_backable_resources())
+
+        self.assertEqual(listings, [])
+        self.assertEqual(sorted(mgr.resolve_backupable_id(resource) for resource in resources),
+                         ["cluster-tagged", "db-tagged"])
+        self.assertEqual(mgr._tagging_conn.calls[0]['ResourceTypeFilters'], ['rds:db', 'rds:cluster'])
+
+    @mock_rds
+    def test_snapshot_inventory_single_pass(self):
+        region_name = "ap-southeast-2"
+        rds_boto = boto3.client('rds', region_name=region_name)
+        for identifier in ("db-a", "db-b"):
+            add_db_instance(identifier, "MakeSnapshot", "True", region_name)
+            for i in range(3):
+                rds_boto.create_db_snapshot(DBInstanceIdentifier=identifier,
+                                            DBSnapshotIdentifier="day-%s-%d" % (identifier, i))
+        rds_boto.create_db_snapshot(DBInstanceIdentifier="db-a", DBSnapshotIdentifier="week-db-a")
+
+        mgr = RDSBackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        listings = []
+        mgr.conn.meta.events.register('before-call.rds.DescribeDBSnapshots',
+                                      lambda **kwargs: listings.append(kwargs))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(len(listings), 1)
+        self.assertEqual(metrics["total_creates"], 2)
+        self.assertEqual(metrics["total_errors"], 0)
+        # Each database keeps its new snapshot and the newest old one, the weekly one is left alone
+        self.assertEqual(metrics["total_deletes"], 4)
+        remaining = sorted(s["DBSnapshotIdentifier"] for s in rds_boto.describe_db_snapshots()["DBSnapshots"])
+        self.assertIn("week-db-a", remaining)
+        self.assertEqual(len(remaining), 5)
+
+    @mock_rds
+    @mock_sts
+    def test_existing_snapshot_id_not_taken_again(self):
+        region_name = "ap-southeast-2"
+        add_db_instance("db-a", "MakeSnapshot", "True", region_name)
+
+        mgr = RDSBackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               share_accounts="111111111111")
+
+        # Taken by a concurrent invocation of the same run, not yet tagged so the inventory can't tell
+        snapshot_id = mgr.build_snapshot_id({"DBInstanceIdentifier": "db-a"}, mgr.period_tags(mgr.schedules))
+        rds_boto = boto3.client('rds', region_name=region_name)
+        rds_boto.create_db_snapshot(DBInstanceIdentifier="db-a", DBSnapshotIdentifier=snapshot_id)
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 0)
+        self.assertEqual(metrics["total_errors"], 0)
+        self.assertIn('db-a exists', ''.join(mgr.render_report()))
+        self.assertEqual(len(rds_boto.describe_db_snapshots()["DBSnapshots"]), 1)
+
+        # The snapshot is still shared, and tagged as shared
+        self.assertEqual(metrics["total_shared"], 1)
+        snapshot = rds_boto.describe_db_snapshots()["DBSnapshots"][0]
+        tags = rds_boto.list_tags_for_resource(ResourceName=snapshot["DBSnapshotArn"])["TagList"]
+        self.assertIn({"Key": SHARED_TAG, "Value": "111111111111"}, tags)
+
+    def test_creating_snapshots_kept(self):
+        mgr = RDSBackupManager(region_name="ap-southeast-2",
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1)
+        creating = {'DBSnapshotIdentifier': 'day-db-a-new', 'DBInstanceIdentifier': 'db-a', 'Status': 'creating'}
+        done = {'DBSnapshotIdentifier': 'day-db-a-old', 'DBInstanceIdentifier': 'db-a', 'Status': 'available',
+                'SnapshotCreateTime': datetime(2030, 1, 1, tzinfo=timezone.utc)}
+
+        self.assertTrue(mgr.snapshot_in_progress(creating))
+        self.assertFalse(mgr.snapshot_in_progress(done))
+        self.assertGreater(mgr.rotation_epoch(creating), mgr.rotation_epoch(done))
+
+
+class ClientCacheTest(unittest.TestCase):
+    def setUp(self):
+        clear_cache()
+
+    def test_clients_reused_between_invocations(self):
+        first = get_client('ec2', 'ap-southeast-2')
+
+        self.assertIs(get_client('ec2', 'ap-southeast-2'), first)
+        self.assertIsNot(get_client('ec2', 'us-west-2'), first)
+
+    def test_metadata_expires(self):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return len(loads)
+
+        self.assertEqual(get_cached_metadata('key', loader), 1)
+        self.assertEqual(get_cached_metadata('key', loader), 1)
+
+        self.assertEqual(get_cached_metadata('expired', loader, ttl=-1), 2)
+        self.assertEqual(get_cached_metadata('expired', loader), 3)
+
+    def test_manager_connects_lazily(self):
+        mgr = EC2BackupManager(region_name="ap-southeast-2",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        self.assertIsNone(mgr._conn)
+        self.assertIs(mgr.conn, get_client('ec2', 'ap-southeast-2'))
+
+    @unittest.mock.patch.dict('os.environ', {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'})
+    def test_mutating_calls_retried_by_rate_limiter_only(self):
+        clock = FakeClock()
+        limiter = RateLimiter(max_attempts=3, clock=clock.time, sleep=clock.sleep, jitter=lambda: 0)
+        mgr = EC2BackupManager(region_name="ap-southeast-2",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               rate_limiter=limiter)
+
+        sends = []
+        mgr.mutating_conn.meta.events.register('before-send', lambda request, **kwargs: sends.append(1) or
+                                               AWSResponse(request.url, 503, {}, ThrottledBody()))
+
+        with self.assertRaises(ClientError):
+            mgr.call_mutating('delete_snapshot', SnapshotId='snap-1')
+
+        # One request per attempt of the limiter, each throttle counted
+        self.assertEqual(len(sends), 3)
+        self.assertEqual(limiter.throttle_count('ec2', 'ap-southeast-2'), 3)
+
+
+class ThrottledBody(object):
+    def stream(self, **kwargs):
+        yield (b'<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+               b'<Message>Request limit exceeded.</Message></Error></Errors></Response>')
+
+
+class ResultReportTest(unittest.TestCase):
+    def test_report_split_under_size_limit(self):
+        log = ResultLog(echo=False)
+        blocks = [log.write([{'resource_id': 'vol-%04d' % i, 'action': 'delete', 'snapshot_name': 'x' * 100}])
+                  for i in range(100)]
+
+        messages = list(render_report('Header', log.records(reversed(blocks)), max_bytes=2048))
+
+        self.assertGreater(len(messages), 1)
+        for message in messages:
+            self.assertTrue(message.startswith('Header\n'))
+            self.assertLessEqual(len(message.encode('utf-8')), 2048)
+
+        lines = [line for message in messages for line in message.splitlines()[1:]]
+        self.assertEqual(len(lines), 100)
+        self.assertIn('vol-0099', lines[0])
+        log.close()
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ThrottlingStub(object):
+    """
+    Stands in for an AWS API that throttles any call made less than 1/rate seconds after the previous one
+    """
+
+    def __init__(self, clock, rate):
+        self.clock = clock
+        self.interval = 1.0 / rate
+        self.last_call = None
+        self.calls = 0
+        self.throttles = 0
+
+    def create_snapshot(self, **kwargs):
+        now = self.clock.time()
+        if self.last_call is not None and now - self.last_call < self.interval - 1e-9:
+            self.throttles += 1
+            raise ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}},
+                              'CreateSnapshot')
+        self.last_call = now
+        self.calls += 1
+        return {'SnapshotId': 'snap-%d' % self.calls}
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_calls_within_rate_are_not_throttled(self):
+        clock = FakeClock()
+        stub = ThrottlingStub(clock, rate=2)
+        limiter = RateLimiter(rates={'ec2:create': 2}, clock=clock.time, sleep=clock.sleep)
+        limiter.bucket_for('ec2', 'ap-southeast-2', 'create').tokens = 1
+
+        for _ in range(20):
+            limiter.call('ec2', 'ap-southeast-2', 'create_snapshot', stub.create_snapshot, VolumeId='vol-1')
+
+        self.assertEqual(stub.calls, 20)
+        self.assertEqual(stub.throttles, 0)
+
+    def test_throttled_calls_are_retried(self):
+        clock = FakeClock()
+        stub = ThrottlingStub(clock, rate=1)
+        limiter = RateLimiter(rates={'ec2:create': 10}, clock=clock.time, sleep=clock.sleep, jitter=lambda: 1)
+
+        for _ in range(20):
+            limiter.call('ec2', 'ap-southeast-2', 'create_snapshot', stub.create_snapshot, VolumeId='vol-1')
+
+        self.assertEqual(stub.calls, 20)
+        self.assertGreater(stub.throttles, 0)
+        self.assertEqual(limiter.throttle_count('ec2', 'ap-southeast-2'), stub.throttles)
+        # The bucket backed off from the configured rate
+        self.assertLess(limiter.bucket_for('ec2', 'ap-southeast-2', 'create').rate, 10)
+
+    def test_retry_budget_exhausted(self):
+        clock = FakeClock()
+        stub = ThrottlingStub(clock, rate=0.001)
+        limiter = RateLimiter(rates={'ec2:create': 10}, retry_budget=3, clock=clock.time, sleep=clock.sleep,
+                              jitter=lambda: 0)
+
+        limiter.call('ec2', 'ap-southeast-2', 'create_snapshot', stub.create_snapshot)
+        with self.assertRaises(ClientError):
+            limiter.call('ec2', 'ap-southeast-2', 'create_snapshot', stub.create_snapshot)
+
+        self.assertEqual(stub.throttles, 4)
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        clear_cache()
+
+    @mock_ec2
+    def test_calls_and_phases_recorded(self):
+        region_name = "ap-southeast-1"
+        for _ in range(3):
+            volume = add_volume("Snapshot", "True", region_name)
+            for i in range(3):
+                add_volume_snapshot(volume, description="day_snapshot-%d" % i, region_name=region_name)
+
+        mgr = EC2BackupManager(region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        mgr.process_backup()
+
+        operations = mgr.instrumentation.operations
+        self.assertEqual(operations['DescribeVolumes'].calls, 1)
+        self.assertEqual(operations['CreateSnapshot'].calls, 3)
+        self.assertEqual(operations['DeleteSnapshot'].calls, 6)
+        self.assertEqual(sum(stats.calls for stats in operations.values()), mgr.api_calls)
+        self.assertEqual(sum(operations['DeleteSnapshot'].histogram), 6)
+
+        self.assertEqual(mgr.instrumentation.phases['create'][0], 3)
+        self.assertEqual(mgr.instrumentation.phases['delete'][0], 6)
+        # One timing per volume plus the end of the listing
+        self.assertEqual(mgr.instrumentation.phases['discovery'][0], 4)
+
+    @mock_ec2
+    def test_shared_client_calls_counted_by_caller(self):
+        region_name = "ap-southeast-1"
+        add_volume("Snapshot", "True", region_name)
+
+        # Two managers of one region, as with in process shards, on the one cached client
+        managers = [EC2BackupManager(region_name=region_name,
+                                     period="day",
+                                     tag_name="Snapshot",
+                                     tag_value="True",
+                                     date_suffix="dd",
+                                     keep_count=2) for _ in range(2)]
+        self.assertIs(managers[0].conn, managers[1].conn)
+
+        def describe(args):
+            mgr, count = args
+            for _ in range(count):
+                mgr.conn.describe_volumes()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(describe, [(managers[0], 5), (managers[1], 3)]))
+
+        self.assertEqual([mgr.api_calls for mgr in managers], [5, 3])
+        self.assertEqual([mgr.instrumentation.operations['DescribeVolumes'].calls for mgr in managers], [5, 3])
+
+    def test_emf_records(self):
+        clock = FakeClock()
+        instrumentation = Instrumentation(clock=clock.time)
+        instrumentation.record_call('CreateSnapshot', 40.0)
+        instrumentation.record_call('CreateSnapshot', 4000.0, retries=2, error_code='RequestLimitExceeded')
+        with instrumentation.phase('create'):
+            clock.sleep(1.5)
+
+        records = instrumentation.emf_records('Backups', OrderedDict([('Service', 'ec2'),
+                                                                      ('Region', 'ap-southeast-2')]))
+        by_operation = dict((record.get('Operation'), record) for record in records)
+        create = by_operation['CreateSnapshot']
+        self.assertEqual(create['_aws']['CloudWatchMetrics'][0]['Dimensions'],
+                         [['Service', 'Region', 'Operation']])
+        self.assertEqual(create['Calls'], 2)
+        self.assertEqual(create['Retries'], 2)
+        self.assertEqual(create['Throttles'], 1)
+        self.assertEqual(create['LatencyMax'], 4000.0)
+        self.assertEqual(create['LatencyHistogram']['le_50'], 1)
+        self.assertEqual(create['LatencyHistogram']['le_5000'], 1)
+
+        phase = [record for record in records if record.get('Phase') == 'create'][0]
+        self.assertEqual(phase['PhaseDuration'], 1.5)
+        # Every record is one line of JSON
+        json.loads(json.dumps(phase))
+
+
+class FakeEvents(object):
+    def register(self, *args, **kwargs):
+        pass
+
+    def unregister(self, *args, **kwargs):
+        pass
+
+
+class FakePaginator(object):
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        return [self.method(**kwargs)]
+
+
+class FakeTaggingApi(object):
+    """
+    Stands in for the Resource Groups Tagging API, returning the given resource tag mappings
+    """
+
+    def __init__(self, region_name, mappings, error=None):
+        self.meta = type('Meta', (object,), {'events': FakeEvents(), 'region_name': region_name})()
+        self.mappings = mappings
+        self.error = error
+        self.calls = []
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def get_resources(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise self.error
+        return {'ResourceTagMappingList': list(self.mappings)}
+
+
+class FakeSnapshotRegion(object):
+    """
+    Stands in for the EC2 snapshot API of one region. Snapshots are pending until they
+    have been described a number of times, then complete.
+    """
+
+    def __init__(self, region_name, polls_to_complete=2):
+        self.meta = type('Meta', (object,), {'events': FakeEvents(), 'region_name': region_name})()
+        self.polls_to_complete = polls_to_complete
+        self.snapshots = OrderedDict()
+        self.polls_left = {}
+        self.max_pending = 0
+        self.shared = []
+        self.lock = threading.RLock()
+
+    def add_snapshot(self, snapshot_id, volume_id, start_time, state='pending', tags=None,
+                     description='day_snapshot'):
+        with self.lock:
+            self._add_snapshot(snapshot_id, volume_id, start_time, state, tags, description)
+
+    def _add_snapshot(self, snapshot_id, volume_id, start_time, state, tags, description):
+        self.snapshots[snapshot_id] = {
+            'SnapshotId': snapshot_id,
+            'VolumeId': volume_id,
+            'Description': description,
+            'StartTime': start_time,
+            'State': state,
+            'Tags': [{'Key': k, 'Value': v} for k, v in (tags or {}).items()],
+        }
+        self.polls_left[snapshot_id] = self.polls_to_complete
+        pending = sum(1 for snap in self.snapshots.values() if snap['State'] == 'pending')
+        self.max_pending = max(self.max_pending, pending)
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def describe_snapshots(self, OwnerIds=None, Filters=()):
+        with self.lock:
+            return self._describe_snapshots(Filters)
+
+    def _describe_snapshots(self, Filters):
+        for snapshot_id, snap in self.snapshots.items():
+            if snap['State'] == 'pending':
+                self.polls_left[snapshot_id] -= 1
+                if self.polls_left[snapshot_id] <= 0:
+                    snap['State'] = 'completed'
+
+        snapshots = []
+        for snap in self.snapshots.values():
+            tags = dict((tag['Key'], tag['Value']) for tag in snap['Tags'])
+            matches = True
+            for flt in Filters:
+                if flt['Name'] == 'snapshot-id':
+                    matches = matches and snap['SnapshotId'] in flt['Values']
+                elif flt['Name'] == 'tag-key':
+                    matches = matches and any(key in tags for key in flt['Values'])
+                elif flt['Name'] == 'description':
+                    matches = matches and any(snap['Description'].startswith(v.rstrip('*')) for v in flt['Values'])
+            if matches:
+                snapshots.append(dict(snap))
+        return {'Snapshots': snapshots}
+
+    def copy_snapshot(self, SourceRegion, SourceSnapshotId, Description, TagSpecifications):
+        copy_id = 'copy-of-' + SourceSnapshotId
+        tags = dict((tag['Key'], tag['Value']) for tag in TagSpecifications[0]['Tags'])
+        self.add_snapshot(copy_id, 'vol-ffffffff', datetime.now(timezone.utc), tags=tags, description=Description)
+        return {'SnapshotId': copy_id}
+
+    def delete_snapshot(self, SnapshotId):
+        del self.snapshots[SnapshotId]
+
+    def modify_snapshot_attribute(self, SnapshotId, **kwargs):
+        if self.snapshots[SnapshotId]['State'] != 'completed':
+            raise ClientError({'Error': {'Code': 'IncorrectState'}}, 'ModifySnapshotAttribute')
+        self.shared.append(SnapshotId)
+
+    def create_tags(self, Resources, Tags):
+        with self.lock:
+            for snapshot_id in Resources:
+                self.snapshots[snapshot_id]['Tags'].extend(Tags)
+
+
+class ShareTest(unittest.TestCase):
+    def test_snapshots_shared_once_completed(self):
+        region = FakeSnapshotRegion('ap-southeast-2', polls_to_complete=3)
+        mgr = EC2BackupManager(region_name='ap-southeast-2',
+                               period='day',
+                               tag_name='Snapshot',
+                               tag_value='True',
+                               date_suffix='dd',
+                               keep_count=2,
+                               share_accounts='111111111111',
+                               conn=region)
+        mgr.share_poll_seconds = 0
+        mgr.start_run()
+
+        for i in range(3):
+            region.add_snapshot('snap-%d' % i, 'vol-%d' % i, datetime.now(timezone.utc))
+            mgr.queue_share(region.snapshots['snap-%d' % i])
+        region.add_snapshot('snap-stuck', 'vol-9', datetime.now(timezone.utc))
+        region.polls_left['snap-stuck'] = float('inf')
+        mgr.queue_share(region.snapshots['snap-stuck'])
+        mgr.share_wait_seconds = 0.2
+
+        records = mgr.wait_for_shares()
+
+        self.assertEqual(sorted(region.shared), ['snap-0', 'snap-1', 'snap-2'])
+        self.assertEqual(region.snapshots['snap-0']['Tags'], [{'Key': SHARED_TAG, 'Value': '111111111111'}])
+        self.assertEqual(region.snapshots['snap-stuck']['Tags'], [])
+        self.assertEqual([(record['snapshot_id'], record['action']) for record in records],
+                         [('snap-0', 'share'), ('snap-1', 'share'), ('snap-2', 'share'),
+                          ('snap-stuck', 'share_pending')])
+
+
+class CopyStageTest(unittest.TestCase):
+    def test_copies_bounded_and_rotated(self):
+        clock = FakeClock()
+        source = FakeSnapshotRegion("ap-southeast-2", polls_to_complete=2)
+        target = FakeSnapshotRegion("us-west-2", polls_to_complete=3)
+
+        mgr = EC2BackupManager(region_name="ap-southeast-2",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               copy_target=CopyTarget("us-west-2", max_in_flight=2, poll_seconds=5, wait_seconds=None,
+                                                      clock=clock.time, sleep=clock.sleep),
+                               conn=source)
+        mgr._copy_conn = target
+        mgr._copy_mutating_conn = target
+        mgr.start_run()
+
+        now = datetime.now(timezone.utc)
+        for i in range(5):
+            source.add_snapshot('snap-%d' % i, 'vol-%d' % i, now)
+        source.add_snapshot('snap-broken', 'vol-9', now, state='error')
+        for snapshot in source.snapshots.values():
+            mgr.queue_copy(dict(snapshot))
+
+        # Three older copies of vol-0, keep_count 2 leaves the new copy and the newest old one
+        for age in range(1, 4):
+            target.add_snapshot('old-%d' % age, 'vol-ffffffff', now, state='completed',
+                                tags={COPY_SOURCE_TAG: 'snap-old-%d' % age,
+                                      COPY_RESOURCE_TAG: 'vol-0',
+                                      COPY_TIME_TAG: str(int(now.timestamp()) - age * 86400),
+                                      PERIOD_TAG_PREFIX + 'day': 'dd'})
+
+        records = mgr.run_copy_stage(['vol-%d' % i for i in range(5)])
+        actions = dict((record['snapshot_id'], record['action']) for record in records)
+
+        self.assertEqual(sorted(k for k, v in actions.items() if v == 'copy'), ['snap-%d' % i for i in range(5)])
+        self.assertEqual(actions['snap-broken'], 'copy_failed')
+        self.assertEqual(sorted(k for k, v in actions.items() if v == 'copy_delete'), ['old-2', 'old-3'])
+        self.assertLessEqual(target.max_pending, 2)
+        self.assertGreater(clock.now, 1000.0)
+        self.assertEqual(sorted(target.snapshots), ['copy-of-snap-%d' % i for i in range(5)] + ['old-1'])
+
+    def test_backfill_limited_and_late_snapshots_left_pending(self):
+        clock = FakeClock()
+        source = FakeSnapshotRegion("ap-southeast-2")
+        target = FakeSnapshotRegion("us-west-2", polls_to_complete=2)
+
+        mgr = EC2BackupManager(region_name="ap-southeast-2",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               copy_target=CopyTarget("us-west-2", max_in_flight=1, poll_seconds=5, wait_seconds=200,
+                                                      clock=clock.time, sleep=clock.sleep),
+                               conn=source)
+        mgr._copy_conn = target
+        mgr._copy_mutating_conn = target
+        mgr.start_run()
+
+        now = datetime.now(timezone.utc)
+        source.add_snapshot('snap-new', 'vol-new', now)
+        source.polls_left['snap-new'] = float('inf')
+        mgr.queue_copy(dict(source.snapshots['snap-new']))
+        for i in range(5):
+            source.add_snapshot('snap-kept-%d' % i, 'vol-%d' % i, now, state='completed')
+            mgr.queue_copy(dict(source.snapshots['snap-kept-%d' % i]), candidate=True)
+
+        checked = []
+        describe_snapshots = source.describe_snapshots
+        source.describe_snapshots = lambda **kwargs: checked.append(kwargs['Filters'][0]['Values']) or \
+            describe_snapshots(**kwargs)
+
+        metrics = mgr.finish_run([])
+        actions = dict((record['snapshot_id'], record['action']) for record in mgr.report_records())
+
+        # Two kept snapshots per copy in flight, the new one did not complete in time
+        self.assertEqual(actions, {'snap-kept-0': 'copy', 'snap-kept-1': 'copy', 'snap-new': 'copy_pending'})
+        self.assertTrue(all(len(ids) <= 1 for ids in checked))
+        self.assertEqual(metrics['total_copies_pending'], 1)
+        self.assertEqual(metrics['total_copy_errors'], 0)
+        self.assertEqual(mgr.errmsg, '')
+
+    def test_copies_bounded_across_source_regions(self):
+        clock = FakeClock()
+        target = FakeSnapshotRegion("us-west-2", polls_to_complete=3)
+        copy_target = CopyTarget("us-west-2", max_in_flight=3, poll_seconds=5, wait_seconds=None,
+                                 clock=clock.time, sleep=clock.sleep)
+
+        managers = []
+        for region_name in ("ap-southeast-2", "eu-west-1"):
+            source = FakeSnapshotRegion(region_name, polls_to_complete=1)
+            mgr = EC2BackupManager(region_name=region_name,
+                                   period="day",
+                                   tag_name="Snapshot",
+                                   tag_value="True",
+                                   date_suffix="dd",
+                                   keep_count=2,
+                                   copy_target=copy_target,
+                                   conn=source)
+            mgr._copy_conn = target
+            mgr._copy_mutating_conn = target
+            mgr.start_run()
+            for i in range(6):
+                source.add_snapshot('snap-%s-%d' % (region_name, i), 'vol-%d' % i, datetime.now(timezone.utc))
+                mgr.queue_copy(dict(source.snapshots['snap-%s-%d' % (region_name, i)]))
+            managers.append(mgr)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(lambda mgr: mgr.run_copy_stage(['vol-%d' % i for i in range(6)]), managers))
+
+        self.assertEqual([sum(1 for record in records if record['action'] == 'copy') for records in results], [6, 6])
+        self.assertLessEqual(target.max_pending, 3)
+
+
+class RetentionPlanTest(unittest.TestCase):
+    def test_grandfather_father_son(self):
+        day = 86400
+        # 2021-01-04 is a Monday, one snapshot a day for 60 days before it
+        now = 1609718400
+        records = [("vol-1", "snap-%d" % i, now - i * day, None) for i in range(60)]
+        policy = RetentionPolicy.grandfather_father_son({"day": 7, "week": 4, "month": 3})
+
+        keep, delete = plan_retention(records, policy)
+
+        expected = set("snap-%d" % i for i in range(7))  # daily
+        expected.update(["snap-8", "snap-15"])  # newest of the weeks starting 21 and 14 December
+        expected.update(["snap-35"])  # newest of November
+        self.assertEqual(set(keep), expected)
+        self.assertEqual(len(keep) + len(delete), 60)
+
+    def test_label_tiers_skip_other_schedules(self):
+        records = [("vol-1", "a", 1, ("day",)),
+                   ("vol-1", "b", 2, ("day",)),
+                   ("vol-1", "c", 3, ("week",)),
+                   ("vol-2", "d", 1, ("day",))]
+        policy = RetentionPolicy.rotation({"day": 1})
+
+        keep, delete = plan_retention(records, policy)
+
+        self.assertEqual(sorted(keep), ["b", "d"])
+        self.assertEqual(delete, ["a"])
+
+
+class HashRingTest(unittest.TestCase):
+    def test_assignments_stable_when_growing(self):
+        keys = ['vol-%05d' % i for i in range(2000)]
+        ring = HashRing(4)
+
+        shards = ring.split(keys)
+        self.assertEqual(sorted(sum(shards, [])), keys)
+        self.assertTrue(all(300 < len(shard) < 700 for shard in shards))
+        self.assertEqual(HashRing(4).split(keys), shards)
+
+        # A fifth shard only takes keys over, none move between the first four
+        grown = HashRing(5)
+        moved = [key for key in keys if grown.shard_for(key) != ring.shard_for(key)]
+        self.assertTrue(all(grown.shard_for(key) == 4 for key in moved))
+        self.assertLess(len(moved), len(keys) * 0.3)
+
 
 class LambdaHandlerTest(unittest.TestCase):
+    def setUp(self):
+        # Clients are cached across invocations, start every test from a cold container
+        clear_cache()
+
     @mock_ec2
     @mock_sns
     def test_ec2_one_volume(self):
@@ -118,3 +1362,335 @@ class LambdaHandlerTest(unittest.TestCase):
         self.assertEqual(dajson["metrics"]["total_creates"], 1)
         self.assertEqual(dajson["metrics"]["total_deletes"], 2)
         self.assertEqual(dajson["metrics"]["total_errors"], 0)
+
+    @mock_ec2
+    def test_ec2_multiple_schedules(self):
+        region_name = "ap-southeast-2"
+
+        volume = add_volume("MakeSnapshot", "True", region_name)
+
+        listings = []
+        get_client('ec2', region_name).meta.events.register('before-call.ec2.DescribeSnapshots',
+                                                            lambda **kwargs: listings.append(kwargs))
+
+        event = {
+            "schedules": [
+                {"period_label": "day", "period_format": "%a", "keep_count": 1},
+                {"period_label": "week", "period_format": "%U", "keep_count": 2},
+            ],
+
+            "ec2_region_name": region_name,
+
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+        }
+
+        dajson = json.loads(lambda_handler(dict(event)))
+
+        # One listing, and one snapshot for both schedules
+        self.assertEqual(dajson["metrics"]["total_creates"], 1)
+        self.assertEqual(dajson["metrics"]["total_errors"], 0)
+        self.assertEqual(len(listings), 1)
+
+        snapshots = boto3.client('ec2', region_name=region_name).describe_snapshots(
+            Filters=[{'Name': 'volume-id', 'Values': [volume]}])['Snapshots']
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(sorted(t['Key'] for t in snapshots[0]['Tags'] if t['Key'].startswith('BackupPeriod:')),
+                         ['BackupPeriod:day', 'BackupPeriod:week'])
+
+        # Neither schedule is due again within the same day
+        dajson = json.loads(lambda_handler(dict(event)))
+        self.assertEqual(dajson["metrics"]["total_creates"], 0)
+        self.assertEqual(dajson["metrics"]["total_deletes"], 0)
+
+    @mock_ec2
+    def test_ec2_plan_then_apply(self):
+        region_name = "ap-southeast-2"
+
+        volume = add_volume("MakeSnapshot", "True", region_name)
+        add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+        add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "region_name": region_name,
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
+            "keep_count": 1,
+            "mode": "plan"
+        }
+
+        dajson = json.loads(lambda_handler(dict(event)))
+        actions = [json.loads(line) for line in dajson["plan"].splitlines()]
+
+        self.assertEqual([a["action"] for a in actions], ["create", "delete", "delete"])
+        self.assertEqual(dajson["metrics"]["total_creates"], 1)
+        self.assertEqual(dajson["metrics"]["total_deletes"], 2)
+
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        snapshots = ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": [volume]}])["Snapshots"]
+        self.assertEqual(len(snapshots), 2)
+
+        event["mode"] = "apply"
+        event["plan"] = dajson["plan"]
+        dajson = json.loads(lambda_handler(event))
+
+        self.assertEqual(dajson["metrics"]["total_creates"], 1)
+        self.assertEqual(dajson["metrics"]["total_deletes"], 2)
+        self.assertEqual(dajson["metrics"]["total_errors"], 0)
+        # The inventory listing checks the create is still due
+        self.assertEqual(dajson["metrics"]["total_api_calls"], 4)
+
+        snapshots = ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": [volume]}])["Snapshots"]
+        self.assertEqual([s["Description"][:12] for s in snapshots], ["day_snapshot"])
+        self.assertNotIn(snapshots[0]["Description"], ["day_snapshot-1", "day_snapshot-2"])
+
+    @mock_ec2
+    def test_plan_applied_twice_takes_one_snapshot(self):
+        region_name = "ap-southeast-2"
+        volume = add_volume("MakeSnapshot", "True", region_name)
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "region_name": region_name,
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
+            "keep_count": 2,
+            "mode": "plan"
+        }
+        plan = json.loads(lambda_handler(dict(event)))["plan"]
+
+        creates = []
+        for _ in range(2):
+            dajson = json.loads(lambda_handler(dict(event, mode="apply", plan=plan)))
+            creates.append(dajson["metrics"]["total_creates"])
+
+        self.assertEqual(creates, [1, 0])
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        snapshots = ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": [volume]}])["Snapshots"]
+        self.assertEqual(len(snapshots), 1)
+
+    @mock_ec2
+    def test_ec2_multiple_regions(self):
+        add_volume("MakeSnapshot", "True", "ap-southeast-2")
+        add_volume("MakeSnapshot", "True", "us-west-2")
+        add_volume("MakeSnapshot", "True", "us-west-2")
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "regions": ["us-west-2", "ap-southeast-2"],
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
+            "keep_count": 2
+        }
+
+        dajson = json.loads(lambda_handler(event))
+
+        self.assertEqual(dajson["regions"]["ap-southeast-2"]["ec2"]["total_creates"], 1)
+        self.assertEqual(dajson["regions"]["us-west-2"]["ec2"]["total_creates"], 2)
+        self.assertEqual(dajson["metrics"]["total_resources"], 3)
+        self.assertEqual(dajson["metrics"]["total_creates"], 3)
+        self.assertEqual(dajson["metrics"]["total_errors"], 0)
+
+    @mock_ec2
+    @mock_sns
+    def test_failed_region_reported_with_others(self):
+        add_volume("MakeSnapshot", "True", "ap-southeast-2")
+        add_volume("MakeSnapshot", "True", "us-west-2")
+
+        arn = boto3.client('sns', region_name="ap-southeast-2").create_topic(Name="datopic")["TopicArn"]
+        error_arn = boto3.client('sns', region_name="ap-southeast-2").create_topic(Name="errors")["TopicArn"]
+        publishes = []
+        get_client('sns', "ap-southeast-2").meta.events.register('before-parameter-build.sns.Publish',
+                                                                 lambda params, **kwargs: publishes.append(params))
+
+        get_backable_resources = EC2BackupManager.get_backable_resources
+
+        def opt_in_region_denied(mgr):
+            if mgr.region_name == "us-west-2":
+                raise ClientError({'Error': {'Code': 'AuthFailure'}}, 'DescribeVolumes')
+            return get_backable_resources(mgr)
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "regions": ["ap-southeast-2", "us-west-2"],
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
+            "arn": arn,
+            "error_arn": error_arn,
+            "keep_count": 2
+        }
+        with unittest.mock.patch.object(EC2BackupManager, 'get_backable_resources', opt_in_region_denied):
+            dajson = json.loads(lambda_handler(event))
+
+        self.assertEqual(dajson["regions"]["ap-southeast-2"]["ec2"]["total_creates"], 1)
+        self.assertEqual(dajson["regions"]["us-west-2"]["ec2"]["total_errors"], 1)
+        self.assertEqual(dajson["metrics"]["total_creates"], 1)
+        self.assertEqual(dajson["metrics"]["total_errors"], 1)
+
+        subjects = dict((p["Subject"], p["Message"]) for p in publishes)
+        self.assertEqual(sorted(subjects), ["Error with AWS Snapshot", "Finished AWS EC2 snapshotting"])
+        self.assertIn("volumes in us-west-2", subjects["Error with AWS Snapshot"])
+        self.assertIn("AuthFailure", subjects["Error with AWS Snapshot"])
+
+    @mock_ec2
+    @mock_rds
+    @mock_sns
+    def test_ec2_and_rds_one_report(self):
+        region_name = "ap-southeast-2"
+        add_volume("MakeSnapshot", "True", region_name)
+        add_db_instance("db-tagged", "MakeSnapshot", "True", region_name)
+
+        arn = boto3.client('sns', region_name=region_name).create_topic(Name="datopic")["TopicArn"]
+        publishes = []
+        get_client('sns', region_name).meta.events.register('before-parameter-build.sns.Publish',
+                                                            lambda params, **kwargs: publishes.append(params))
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "region_name": region_name,
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+            "arn": arn,
+            "keep_count": 2
+        }
+
+        dajson = json.loads(lambda_handler(event))
+
+        self.assertEqual(dajson["services"]["ec2"]["total_creates"], 1)
+        self.assertEqual(dajson["services"]["rds"]["total_creates"], 1)
+        self.assertEqual(dajson["metrics"]["total_resources"], 2)
+        self.assertEqual(dajson["metrics"]["total_creates"], 2)
+        self.assertEqual(dajson["metrics"]["total_errors"], 0)
+
+        self.assertEqual([p["Subject"] for p in publishes], ["Finished AWS EC2 and RDS snapshotting"])
+        self.assertIn("db-tagged create", publishes[0]["Message"])
+
+    @mock_ec2
+    def test_ec2_sharded(self):
+        region_name = "ap-southeast-2"
+        volumes = [add_volume("MakeSnapshot", "True", region_name) for _ in range(6)]
+        add_volume("Name", "Anotherone", region_name)
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "region_name": region_name,
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
+            "keep_count": 2,
+            "shards": 3
+        }
+
+        dajson = json.loads(lambda_handler(event, dispatcher=InProcessDispatcher()))
+
+        expected = [len(shard) for shard in HashRing(3).split(volumes) if shard]
+        self.assertEqual([r["resources"] for r in dajson["shard_results"]], expected)
+        self.assertEqual([r["metrics"]["total_creates"] for r in dajson["shard_results"]], expected)
+        self.assertEqual(dajson["services"]["ec2"]["total_creates"], 6)
+        self.assertEqual(dajson["metrics"]["total_creates"], 6)
+        self.assertEqual(dajson["metrics"]["total_errors"], 0)
+        self.assertEqual(dajson["metrics"]["total_shard_errors"], 0)
+
+    @mock_ec2
+    def test_grouped_volumes_sharded_by_instance(self):
+        region_name = "ap-southeast-2"
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        instances = OrderedDict()
+        for _ in range(4):
+            instance_id = ec2_boto.run_instances(ImageId='ami-12c6146b', MinCount=1,
+                                                 MaxCount=1)['Instances'][0]['InstanceId']
+            instances[instance_id] = []
+            for device in ('/dev/sdf', '/dev/sdg', '/dev/sdh'):
+                volume = add_volume("MakeSnapshot", "True", region_name)
+                ec2_boto.attach_volume(VolumeId=volume, InstanceId=instance_id, Device=device)
+                instances[instance_id].append(volume)
+
+        shards = discover_shards([(region_name, "ec2", "MakeSnapshot", "True")],
+                                 resolve_schedules({"period_label": "day", "period_format": "%a%H", "keep_count": 2}), 3,
+                                 event={"ec2_group_by_instance": True})
+
+        ring = HashRing(3)
+        for instance_id, volumes in instances.items():
+            shard_ids = shards[ring.shard_for(instance_id)]["ec2"][region_name]
+            self.assertTrue(all(volume in shard_ids for volume in volumes))
+
+    @mock_ec2
+    def test_shard_results_leave_out_inputs(self):
+        region_name = "ap-southeast-2"
+        for _ in range(6):
+            add_volume("MakeSnapshot", "True", region_name)
+
+        results = []
+
+        class RecordingDispatcher(InProcessDispatcher):
+            def invoke(self, event):
+                results.append(super(RecordingDispatcher, self).invoke(event))
+                return results[-1]
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "region_name": region_name,
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
+            "keep_count": 2,
+            "mode": "plan",
+            "shards": 3
+        }
+
+        dajson = json.loads(lambda_handler(event, dispatcher=RecordingDispatcher()))
+
+        self.assertTrue(results)
+        for result in results:
+            self.assertNotIn("shard_resources", result)
+            self.assertNotIn("plan", result)
+            self.assertNotIn("ec2_tag_name", result)
+        self.assertEqual(sum(result["plan_actions"] for result in results), 6)
+        self.assertEqual(dajson["plan_actions"], 6)
+
+    @mock_ec2
+    def test_shards_stop_by_coordinator_deadline(self):
+        region_name = "ap-southeast-2"
+        for _ in range(4):
+            add_volume("MakeSnapshot", "True", region_name)
+
+        events = []
+
+        class RecordingDispatcher(InProcessDispatcher):
+            def invoke(self, event):
+                events.append(event)
+                return super(RecordingDispatcher, self).invoke(event)
+
+        class Context(object):
+            def __init__(self, remaining_millis):
+                self.remaining_millis = remaining_millis
+
+            def get_remaining_time_in_millis(self):
+                return self.remaining_millis
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "region_name": region_name,
+            "ec2_tag_name": "MakeSnapshot",
+            "ec2_tag_value": "True",
+            "keep_count": 2,
+            "shards": 2
+        }
+
+        started = time.time()
+        lambda_handler(event, Context(300000), dispatcher=RecordingDispatcher())
+
+        # The coordinator leaves 30 seconds of its 300 to report
+        self.assertTrue(events)
+        for shard_event in events:
+            self.assertAlmostEqual(shard_event["coordinator_deadline"], started + 270, delta=5)
+            # A shard with a longer timeout still stops 30 seconds before that to return its result
+            self.assertAlmostEqual(resolve_deadline(shard_event, Context(900000)), started + 240, delta=5)
+            self.assertAlmostEqual(resolve_deadline(shard_event, None), started + 240, delta=5)